@@ -10,6 +10,7 @@ dirs = []
 def GetFiles(dir, files, outfile):
     for d in dirs:
         dirs.remove(d)
+    pathnames = []
     for f in os.listdir(dir):
         if f.find( '?' ) != -1 or f.find( 'System Volume Information' ) != -1 or f.find( 'RECYCLER' ) != -1:
             continue
@@ -18,13 +19,15 @@ def GetFiles(dir, files, outfile):
             if recurse == 1:
                 dirs.append( pathname )
         else:
-            chksum = hash_utils.md5sum(pathname)
-            if chksum in files:
-                filestr = pathname[2:len(pathname)] + ' == ' + (files[chksum])[2:len( (files[chksum]) )]
-                print(filestr)
-                outfile.write( filestr + '\n' )
-            else:
-                files[chksum] = pathname
+            pathnames.append( pathname )
+    for pathname, digests in hash_utils.hash_files(pathnames, ('md5',)):
+        chksum = digests['md5']
+        if chksum in files:
+            filestr = pathname[2:len(pathname)] + ' == ' + (files[chksum])[2:len( (files[chksum]) )]
+            print(filestr)
+            outfile.write( filestr + '\n' )
+        else:
+            files[chksum] = pathname
     return files    
 
 def FindDuplicates( dir, recurse, files, outfile ):
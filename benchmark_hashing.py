@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# vim:softtabstop=4:ts=4:sw=4:expandtab:tw=120
+import argparse
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import sys
+import time
+import traceback
+
+import custom_utils
+import dump_dir
+import hash_utils
+
+DEFAULT_WORK_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'benchmark_hashing')
+DEFAULT_HISTORY_PATH = os.path.join(DEFAULT_WORK_DIR, 'history.json')
+
+# name: (directory count, files per directory, file size, nesting depth)
+_TREES = {
+    'tiny': (50, 100, 1024, 1),
+    'huge': (1, 4, 64 * 1048576, 1),
+    'deep': (1, 5, 16 * 1024, 64),
+}
+
+_CASES = ['walk', 'hash_inproc', 'hash_shell', 'dump_dir']
+
+DEFAULT_CASE_TIMEOUT = 3600.0
+_POLL_INTERVAL = 1.0
+
+def _generate_tree(root, dir_count, files_per_dir, file_size, depth, scale):
+    '''Creates the synthetic tree once, a marker file next to it records the parameters so a changed scale regenerates
+    it.  The marker is outside the tree so every case sees exactly the generated files.'''
+    marker = root + '.benchmark'
+    old_marker = os.path.join(root, '.benchmark')
+    if os.path.isfile(old_marker):
+        os.remove(old_marker)
+    parameters = '{0} {1} {2} {3} {4}'.format(dir_count, files_per_dir, file_size, depth, scale)
+    if os.path.isfile(marker) and open(marker).read() == parameters:
+        return
+    chunk = os.urandom(min(file_size, 1048576)) if file_size else b''
+    index = 0
+    for dir_index in range(dir_count):
+        directory = os.path.join(root, 'dir{0:04}'.format(dir_index))
+        for level in range(depth):
+            directory = os.path.join(directory, 'level{0:03}'.format(level)) if level else directory
+            os.makedirs(directory, exist_ok=True)
+            for file_index in range(int(files_per_dir * scale) or 1):
+                index += 1
+                with open(os.path.join(directory, 'file{0:06}.bin'.format(file_index)), 'wb') as f:
+                    remaining = file_size
+                    # every file gets a distinct prefix so the tree does not hash to one digest
+                    f.write(index.to_bytes(8, 'little'))
+                    remaining -= min(remaining, 8)
+                    while remaining > 0:
+                        f.write(chunk[:remaining])
+                        remaining -= min(remaining, len(chunk))
+    with open(marker, 'w') as f:
+        f.write(parameters)
+
+def _read_proc_io():
+    '''Returns the read/write syscall counters of this process (Linux only, zeros elsewhere).
+
+    The kernel adds the counters of every child to its parent's when the child is waited for, so the md5sum processes
+    of hash_shell are included once they have exited.
+    '''
+    counters = {'syscr': 0, 'syscw': 0}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                if name in counters:
+                    counters[name] = int(value)
+    except OSError:
+        pass
+    return counters
+
+def _run_case(case, tree, workers):
+    files = list(custom_utils.get_files_in_directory(tree))
+    total_bytes = sum(os.path.getsize(file_name) for file_name in files)
+    for file_name in files:
+        hash_utils.drop_cached_pages(file_name)
+    before = _read_proc_io()
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    if case == 'walk':
+        total_bytes = 0
+        files = list(custom_utils.get_files_in_directory(tree))
+    elif case == 'hash_inproc':
+        for _ in hash_utils.hash_files(files, ('md5',), workers):
+            pass
+    elif case == 'hash_shell':
+        for file_name in files:
+            hash_utils.md5sum_shell(file_name)
+    elif case == 'dump_dir':
+        with open(os.devnull, 'w') as output_file:
+            dump_dir.dump_dir(tree, output_file, md5=True, timestamp=True, thread_count=workers)
+    elapsed = time.perf_counter() - start
+    after = _read_proc_io()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is kilobytes on linux and bytes on darwin
+    rss_kb = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return {'files': len(files),
+            'bytes': total_bytes,
+            'seconds': elapsed,
+            'files_per_sec': len(files) / elapsed if elapsed else 0.0,
+            'mb_per_sec': total_bytes / 1048576.0 / elapsed if elapsed else 0.0,
+            'peak_rss_kb': rss_kb,
+            'read_syscalls': after['syscr'] - before['syscr'],
+            'write_syscalls': after['syscw'] - before['syscw'],
+            'child_block_reads': children.ru_inblock - children_before.ru_inblock,
+            'child_cpu_sec': (children.ru_utime + children.ru_stime) -
+                             (children_before.ru_utime + children_before.ru_stime)}
+
+def _case_process(result_queue, case, tree, workers):
+    try:
+        result_queue.put(_run_case(case, tree, workers))
+    except Exception as err:
+        result_queue.put({'error': '{0}: {1}'.format(type(err).__name__, err)})
+
+def run_case(case, tree, workers, timeout=DEFAULT_CASE_TIMEOUT):
+    '''Runs one case in a child process so peak RSS and syscall counts belong to that case alone.  A child which dies
+    or runs longer than timeout seconds is reported as an error instead of waited on forever.'''
+    # spawned rather than forked, a forked child starts with the parent's peak RSS as its own
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=_case_process, args=(result_queue, case, tree, workers))
+    process.start()
+    deadline = time.monotonic() + timeout
+    result = None
+    while result is None:
+        try:
+            result = result_queue.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            if not process.is_alive():
+                result = {'error': 'the case process exited with {0}'.format(process.exitcode)}
+            elif time.monotonic() > deadline:
+                process.terminate()
+                result = {'error': 'timed out after {0:.0f} seconds'.format(timeout)}
+    process.join()
+    return result
+
+def run_benchmarks(work_dir, trees, cases, workers, scale, timeout=DEFAULT_CASE_TIMEOUT):
+    results = []
+    for tree_name in trees:
+        tree = os.path.join(work_dir, tree_name)
+        print('generating {0} tree in {1}...'.format(tree_name, tree))
+        _generate_tree(tree, *_TREES[tree_name], scale=scale)
+        for case in cases:
+            if case == 'hash_shell' and not custom_utils.is_binary_in_path('md5sum'):
+                print('skipping {0}/{1}: md5sum is not in the path'.format(tree_name, case))
+                continue
+            result = run_case(case, tree, workers, timeout)
+            result.update({'tree': tree_name, 'case': case, 'workers': workers})
+            results.append(result)
+            print(_format_result(result))
+    return results
+
+def _format_result(result):
+    if 'error' in result:
+        return '{0:<5} {1:<12} ERROR {2}'.format(result['tree'], result['case'], result['error'])
+    return ('{tree:<5} {case:<12} {files:>7} files {seconds:>8.3f} sec {files_per_sec:>10.1f} files/s '
+            '{mb_per_sec:>8.1f} MB/s {peak_rss_kb:>8} KB rss {read_syscalls:>8} reads {write_syscalls:>8} writes').format(**result)
+
+def _load_json(path, default):
+    if not os.path.isfile(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+def compare_to_baseline(results, baseline, threshold):
+    '''Prints the change in speed (throughput, positive is faster) against the baseline and returns the number of
+    regressions beyond threshold.'''
+    previous = {(result['tree'], result['case']): result for result in baseline['results'] if 'error' not in result}
+    regressions = 0
+    for result in results:
+        old = previous.get((result['tree'], result['case']))
+        if old is None or 'error' in result or not old['seconds']:
+            continue
+        change = old['seconds'] / result['seconds'] - 1.0 if result['seconds'] else 0.0
+        regressed = change < -threshold
+        regressions += int(regressed)
+        print('{0:<5} {1:<12} {2:>+8.1%} speed {3:>+8.1%} rss {4}'.format(
+            result['tree'], result['case'], change,
+            result['peak_rss_kb'] / float(old['peak_rss_kb']) - 1.0 if old['peak_rss_kb'] else 0.0,
+            'REGRESSION' if regressed else ''))
+    return regressions
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the directory walk, hashing and dump_dir primitives on synthetic trees')
+    parser.add_argument('-d', '--work-dir', default=DEFAULT_WORK_DIR, metavar='<DIR>', help='where the synthetic trees are generated')
+    parser.add_argument('-t', '--tree', dest='trees', action='append', choices=sorted(_TREES), help='tree to benchmark (default all)')
+    parser.add_argument('-c', '--case', dest='cases', action='append', choices=_CASES, help='case to benchmark (default all)')
+    parser.add_argument('-w', '--workers', type=int, default=hash_utils.DEFAULT_WORKERS, help='threads used by the in-process cases')
+    parser.add_argument('-s', '--scale', type=float, default=1.0, help='multiplies the number of files in every tree')
+    parser.add_argument('-H', '--history', default=DEFAULT_HISTORY_PATH, metavar='<JSON PATH>', help='json file the results are appended to')
+    parser.add_argument('-b', '--baseline', default=None, metavar='<JSON PATH>', help='compare the results against this baseline')
+    parser.add_argument('-S', '--save-baseline', default=None, metavar='<JSON PATH>', help='save the results as a baseline')
+    parser.add_argument('-r', '--threshold', type=float, default=0.10, help='slow down (fraction) reported as a regression')
+    parser.add_argument('-T', '--timeout', type=float, default=DEFAULT_CASE_TIMEOUT, metavar='<SECONDS>', help='longest a case may run before it is stopped')
+    args = parser.parse_args()
+    return (args.work_dir, args.trees or sorted(_TREES), args.cases or _CASES, max(1, args.workers), args.scale,
+            args.history, args.baseline, args.save_baseline, args.threshold, args.timeout)
+
+def main():
+    work_dir, trees, cases, workers, scale, history_path, baseline_path, save_baseline, threshold, timeout = _parse_args()
+    try:
+        results = run_benchmarks(work_dir, trees, cases, workers, scale, timeout)
+        run = {'date': datetime.now().isoformat(), 'host': platform.node(), 'python': platform.python_version(),
+               'scale': scale, 'results': results}
+        history = _load_json(history_path, [])
+        history.append(run)
+        _write_json(history_path, history)
+        print('results appended to {0}'.format(history_path))
+        if save_baseline:
+            _write_json(save_baseline, run)
+            print('baseline saved to {0}'.format(save_baseline))
+        if baseline_path:
+            return 2 if compare_to_baseline(results, _load_json(baseline_path, {'results': []}), threshold) else 0
+        return 0
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# vim: awa:sts=4:ts=4:sw=4:et:cin:fdm=manual:tw=120:ft=python
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import login_info_client
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_CASES = ['standalone', 'client', 'client_fallback']
+
+# how long the server gets to collect its first snapshot and start listening
+_SERVER_START_TIMEOUT = 30.0
+
+
+def _time_command(args, env, runs):
+    '''Returns the wall time in seconds of every run of args, the output is thrown away.'''
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _start_server(socket_path, env):
+    server = subprocess.Popen([sys.executable, os.path.join(_SCRIPT_DIR, 'login_info_server.py'), '-s', socket_path],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + _SERVER_START_TIMEOUT
+    while login_info_client.request_banner(socket_path, b'ping') != b'pong\n':
+        if server.poll() is not None or time.monotonic() > deadline:
+            server.kill()
+            raise RuntimeError('the login info server did not start')
+        time.sleep(0.1)
+    return server
+
+
+def run_benchmarks(cases, runs, socket_path=None):
+    '''Times every case, starting a server on a private socket unless socket_path names one already running.'''
+    env = dict(os.environ)
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        server = None
+        if socket_path is None and 'client' in cases:
+            socket_path = os.path.join(temp_dir, 'login_info.sock')
+            server = _start_server(socket_path, env)
+        try:
+            for case in cases:
+                if case == 'standalone':
+                    args = [sys.executable, os.path.join(_SCRIPT_DIR, 'login_info.py')]
+                    case_env = env
+                else:
+                    args = [sys.executable, os.path.join(_SCRIPT_DIR, 'login_info_client.py')]
+                    missing_socket = os.path.join(temp_dir, 'missing.sock')
+                    case_env = dict(env, LOGIN_INFO_SOCKET=socket_path if case == 'client' else missing_socket)
+                results[case] = _time_command(args, case_env, runs)
+                print(_format_result(case, results[case]))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+    return results
+
+
+def _format_result(case, timings):
+    to_ms = lambda seconds: seconds * 1000.0
+    return (f'{case:<16} {len(timings):>4} runs {to_ms(min(timings)):>9.2f} ms min {to_ms(statistics.median(timings)):>9.2f} ms median '
+            f'{to_ms(statistics.mean(timings)):>9.2f} ms mean {to_ms(max(timings)):>9.2f} ms max')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Compares the latency of login_info_client against running login_info.py on every login')
+    parser.add_argument('-n', '--runs', type=int, default=20, help='how many times every case is run')
+    parser.add_argument('-c', '--case', dest='cases', action='append', choices=_CASES, help='case to benchmark (default all)')
+    parser.add_argument('-s', '--socket', default=None, metavar='<SOCKET PATH>', help='use the server already listening on this socket instead of starting one')
+    args = parser.parse_args()
+    return max(1, args.runs), args.cases or _CASES, args.socket
+
+
+def main():
+    runs, cases, socket_path = _parse_args()
+    try:
+        results = run_benchmarks(cases, runs, socket_path)
+        if 'standalone' in results and 'client' in results:
+            speedup = statistics.median(results['standalone']) / statistics.median(results['client'])
+            print(f'the client is {speedup:.1f}x faster than the standalone script (median)')
+        return 0
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,9 +5,12 @@ from ansimarkup import AnsiMarkup, parse
 import argparse
 from app_settings import app_settings
 import configparser
+import json
 import os
 from pathlib import Path
+import sqlite3
 import sys
+import time
 import traceback
 
 user_tags = {
@@ -21,58 +24,198 @@ user_tags = {
 
 am = AnsiMarkup(tags=user_tags)
 
+# seconds each cached field stays fresh, the expensive (network or subprocess) login_info fields
+DEFAULT_TTLS = {'location': 86400,
+                'weather': 1800,
+                'public-ip': 3600,
+                'packages': 3600,
+                'quote': 300}
+
+# the daemon never busy loops on a failing field and never sleeps through a whole ttl
+_MIN_SLEEP = 60
+_MAX_SLEEP = 900
+
+_CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS fields (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated REAL NOT NULL,
+    ttl REAL NOT NULL)'''
+
 def _get_default_conf_path():
     return str(Path(os.path.expandvars('$HOME/.config/motd/motd.conf')))
 
 def _existing_conf_path(p):
     updated_path = Path(os.path.expandvars(p))
-    if not updated_path.is_file:
+    if not updated_path.is_file():
         raise argparse.ArgumentTypeError(f'ERROR: configuration file {p} must exist')
     return str(updated_path)
 
 def _new_conf_path(p):
     return str(Path(p))
 
+def read_motd_config(path=None):
+    '''Returns (database path, ttls) from the config, the defaults for anything it (or the file itself) is missing.'''
+    path = Path(path if path else _get_default_conf_path())
+    config = configparser.ConfigParser()
+    config.read(str(path))
+    database = config['DEFAULT'].get('database', str(path.with_name('motd.db')))
+    ttls = dict(DEFAULT_TTLS)
+    if config.has_section('ttl'):
+        ttls.update({name: float(value) for name, value in config['ttl'].items() if name in DEFAULT_TTLS})
+    return os.path.expanduser(os.path.expandvars(database)), ttls
+
+class MotdCache:
+    '''Login info fields stored as json in sqlite with the time they were collected and how long they stay fresh.
+
+    Opened read_only it never creates or writes the database, which is how login_info uses it on the login path.
+    '''
+    def __init__(self, db_path, read_only=False):
+        self.db_path = db_path
+        if read_only:
+            uri = Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+            self._connection = sqlite3.connect(uri, uri=True, timeout=0.05)
+        else:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(db_path, timeout=5.0)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(_CREATE_TABLE)
+            self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get_all(self):
+        '''Returns a dict of name to (value, fresh) for every cached field.'''
+        now = time.time()
+        rows = self._connection.execute('SELECT name, value, updated, ttl FROM fields').fetchall()
+        return {name: (json.loads(value), now - updated < ttl) for name, value, updated, ttl in rows}
+
+    def expirations(self):
+        '''Returns a dict of name to the time the field goes stale.'''
+        return dict(self._connection.execute('SELECT name, updated + ttl FROM fields').fetchall())
+
+    def set(self, name, value, ttl):
+        self._connection.execute('INSERT OR REPLACE INTO fields (name, value, updated, ttl) VALUES (?, ?, ?, ?)',
+                                 (name, json.dumps(value), time.time(), ttl))
+        self._connection.commit()
+
+def read_cached_fields(config_path=None, db_path=None):
+    '''Returns name to (value, fresh) for the fields cached so far, nothing when there is no cache yet.  db_path
+    overrides the database in the config, as -d/--database does here.'''
+    config_db_path, ttls = read_motd_config(config_path)
+    db_path = db_path or config_db_path
+    if not os.path.isfile(db_path):
+        return {}
+    try:
+        with MotdCache(db_path, read_only=True) as cache:
+            return cache.get_all()
+    except (sqlite3.Error, ValueError) as err:
+        app_settings.error(f'unable to read the motd cache {db_path}: {err}')
+        return {}
+
+def _is_cacheable(name, value):
+    # a failed lookup is left out so the next run tries again instead of showing the failure until the ttl runs out
+    if name == 'weather':
+        return value[1] != 'Unavailable'
+    if name in ('location', 'public-ip'):
+        return value not in (None, 'None')
+    return True
+
+def cache_motd_info(cache, ttls, force=False):
+    '''Collects the fields which are missing or stale (every field with force) and stores them, returns their names.'''
+    # login_info reads the cache on every login so only the refresher pays for these
+    from concurrent.futures import ThreadPoolExecutor
+    import login_info
+    cached = cache.get_all()
+    stale = [name for name in ttls if force or name not in cached or not cached[name][1]]
+    if not stale:
+        return []
+    app_settings.info(f'refreshing {", ".join(stale)}')
+
+    refreshed = []
+    def store(name, value):
+        if _is_cacheable(name, value):
+            cache.set(name, value, ttls[name])
+            refreshed.append(name)
+        else:
+            app_settings.warn(f'{name} could not be collected, it will be retried')
+
+    # the weather is looked up for the location so it is collected first
+    location = cached['location'][0] if 'location' in cached else None
+    if 'location' in stale:
+        import location_info
+        location = location_info.get_location()
+        store('location', location)
+    probes = login_info.get_cacheable_probes(location)
+    names = [name for name in stale if name in probes]
+    with ThreadPoolExecutor(max_workers=max(1, len(names))) as executor:
+        futures = [(name, executor.submit(probes[name])) for name in names]
+        for name, future in futures:
+            try:
+                value = future.result()
+            except Exception as err:
+                app_settings.error(f'{name} failed: {err}')
+                continue
+            store(name, list(value) if isinstance(value, tuple) else value)
+    return refreshed
+
+def run_refresher(cache, ttls):
+    '''Refreshes fields as they go stale, forever.'''
+    while True:
+        cache_motd_info(cache, ttls)
+        next_expiration = min(cache.expirations().values(), default=time.time())
+        delay = min(max(next_expiration - time.time(), _MIN_SLEEP), _MAX_SLEEP)
+        app_settings.info(f'sleeping {delay:.0f} seconds')
+        time.sleep(delay)
+
+def write_motd_config(path):
+    app_settings.info(f'creating new motd config in {path}')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = {'database': str(path.with_name('motd.db'))}
+    config['ttl'] = {name: str(ttl) for name, ttl in DEFAULT_TTLS.items()}
+    with open(path, 'w') as config_file:
+        config.write(config_file)
+
 def _parse_args():
-    default_conf_path = _get_default_conf_path()
     parser = argparse.ArgumentParser(description='Helper script which looks up login info and caches it in sqlite3 databse')
     config_group = parser.add_mutually_exclusive_group()
     parser.add_argument('-v', '--verbose', action='count', default=0, help='increase output verbosity')
-    parser.add_argument('-d', '--databse', metavar='<DB PATH>', help='directory to find and store databse')
-    config_group.add_argument('-c', '--config', default=argparse.SUPPRESS, type=_existing_conf_path, metavar='<CONFIG PATH>', help='config ini file to specify parameters')
-    config_group.add_argument('-w', '--write-default-config', dest='write_config', default=argparse.SUPPRESS, type=_new_conf_path, metavar='<CONFIG PATH>', help='write default ini file')
+    parser.add_argument('-d', '--database', '--databse', dest='database', default=None, metavar='<DB PATH>', help='databse to store the cached fields in (overrides the config)')
+    parser.add_argument('-f', '--force', action='store_true', help='refresh every field even when it is still fresh')
+    parser.add_argument('-D', '--daemon', action='store_true', help='keep running and refresh fields as they go stale (default is one pass for cron)')
+    config_group.add_argument('-c', '--config', default=None, type=_existing_conf_path, metavar='<CONFIG PATH>', help=f'config ini file to specify parameters (default {_get_default_conf_path()})')
+    config_group.add_argument('-w', '--write-default-config', dest='write_config', default=None, type=_new_conf_path, metavar='<CONFIG PATH>', help='write default ini file')
 
     args = parser.parse_args()
     app_settings.update(vars(args))
-    app_settings.print(f'config: {app_settings.config}')
-    app_settings.print(f'write config: {app_settings.write_config}')
+    app_settings.info(f'config: {app_settings.config}')
+    app_settings.info(f'write config: {app_settings.write_config}')
     app_settings.print_settings(print_always=False)
 
-def cache_motd_info():
-    pass
-
-def write_motd_config(path):
-    pass
-    '''
-    app_settings.verbose('creating new motd config in {path}')
-    path.parent.mkdir(parents=True, exist_ok=True)
-    config = configparser.ConfigParser()
-    config['DEFAULT'] = {}
-    config['DEFAULT']['database'] = str(path.with_name('motd.db'))
-    config['DEFAULT']['values'] = [
-    'computer-name', 'hostname', 'public-ip', 'mail',
-    'system-load', 'processes',
-    'root-usage', 'users-logged-in',
-    'memory-usage', 'swap-usage',
-    config[
-    '''
-
 def main():
     _parse_args()
     try:
         if app_settings.write_config:
             write_motd_config(Path(app_settings.write_config))
-        cache_motd_info()
+            return 0
+        db_path, ttls = read_motd_config(app_settings.config)
+        with MotdCache(app_settings.database or db_path) as cache:
+            if app_settings.daemon:
+                run_refresher(cache, ttls)
+            else:
+                refreshed = cache_motd_info(cache, ttls, app_settings.force)
+                app_settings.info(f'refreshed {len(refreshed)} fields in {cache.db_path}')
+    except KeyboardInterrupt:
+        return 0
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
@@ -8,16 +8,18 @@ import time
 import traceback
 
 import dump_dir
+import hash_cache
 
 def _parse_command_line():
     parser = argparse.ArgumentParser(description='Enumerates all files in a directory (with MD5\'s).')
     chksum_group = parser.add_mutually_exclusive_group(required=False)
-    chksum_group.add_argument('-c', '--crc32', dest='chksum', action='store_true', help='enables md5 chksum')
+    chksum_group.add_argument('-c', '--crc32', dest='crc32', action='store_true', help='enables crc32 chksum')
     chksum_group.add_argument('-m', '--md5', dest='md5', action='store_true', help='enables md5 chksum')
     parser.add_argument('-n', '--no-timestamp', dest='no_timestamp', action='store_true', help='disable timestamp output')
     parser.add_argument('-d', '--destination-volume', dest='destination', required=True, type=_directory_exists, help='destination volume')
     parser.add_argument('-s', '--source-volume', dest='source', required=True, type=_directory_exists, help='source volume')
     parser.add_argument('output_dir', type=_directory_exists, metavar='<output dir>', help='directory to output results')
+    parser.add_argument('-H', '--hash-cache', dest='hash_cache', nargs='?', const=hash_cache.DEFAULT_DB_PATH, default=None, metavar='<DB PATH>', help='reuse chksums of unchanged files from a hash cache database')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='enable verbose output')
     args = parser.parse_args()
 
@@ -28,26 +30,32 @@ def _parse_command_line():
     destination = os.path.abspath(args.destination)
     output_directory = args.output_dir
     
-    return crc32, md5, timestamp, source, destination, output_directory, args.verbose
+    return crc32, md5, timestamp, source, destination, output_directory, args.hash_cache, args.verbose
 
 def main():
-    crc32, md5, timestamp, source, destination, output_directory, verbose = _parse_command_line()
+    crc32, md5, timestamp, source, destination, output_directory, cache_path, verbose = _parse_command_line()
 
+    cache = hash_cache.HashCache(cache_path) if cache_path else None
     try:
         start = time.time()
         for entry_name in os.listdir(source):
             if entry_name.lower() in ['downloads', 'music', 'movies']:
-                with open(os.path.join(output_directory, 'source-{1}.txt'.format(entry_name)), 'w') as logfile:
-                    dump_dir.dump_dir(cur_dir, logfile, crc32=crc32, md5=md5, timestamp=timestamp, verbose=verbose)
+                with open(os.path.join(output_directory, 'source-{0}.txt'.format(entry_name)), 'w') as logfile:
+                    dump_dir.dump_dir(os.path.join(source, entry_name), logfile, crc32=crc32, md5=md5, timestamp=timestamp,
+                                      verbose=verbose, cache=cache)
         for entry_name in os.listdir(destination):
             if entry_name.lower() in ['downloads', 'music', 'movies']:
-                with open(os.path.join(output_directory, 'destination-{1}.txt'.format(entry_name)), 'w') as logfile:
-                    dump_dir.dump_dir(cur_dir, logfile, crc32=crc32, md5=md5, timestamp=timestamp, verbose=verbose)
+                with open(os.path.join(output_directory, 'destination-{0}.txt'.format(entry_name)), 'w') as logfile:
+                    dump_dir.dump_dir(os.path.join(destination, entry_name), logfile, crc32=crc32, md5=md5,
+                                      timestamp=timestamp, verbose=verbose, cache=cache)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stdout)
         return 1
     finally:
+        if cache is not None:
+            cache.close()
+            print(cache)
         print("Elapsed Time: {0}".format(time.time() - start))
         return 0
 
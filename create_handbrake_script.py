@@ -1,31 +1,44 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
+import argparse
 import os
 import sys
-from heapq import heappush, heappop
+import traceback
+
+import transcode_queue
+
+# the settings the old run.bat encoded with, the input and output are added per job
+_ENCODER_ARGS = ['-t', '1', '-c', '1', '-f', 'mp4', '-4', '-w', '640', '--loose-anamorphic', '-e', 'x264', '-b', '1000',
+                 '-r', '29.97', '--pfr', '-a', '1', '-E', 'faac', '-6', 'dpl2', '-R', 'Auto', '-B', '160', '-D', '0.0',
+                 '--verbose=1']
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Queue every .avi below the current directory for transcode_queue.py run')
+    parser.add_argument('-q', '--queue', default=transcode_queue.DEFAULT_QUEUE_PATH, metavar='<QUEUE PATH>', help='job queue file')
+    parser.add_argument('destination', metavar='<DIR>', help='destination directory')
+    args = parser.parse_args()
+    return args.queue, args.destination
+
+def _destination_name(path):
+    basename = os.path.splitext(os.path.basename(path))[0]
+    return (basename[:basename.find('[')].strip() if '[' in basename else basename) + '.m4v'
 
 def main():
-    paths = []
-    for root, dirs, files in os.walk(os.getcwd()):
-        for filename in files:
-            if filename.endswith('.avi'):
-                heappush(paths, os.path.join(root, filename))
-    
-    command = '"C:\Program Files (x86)\Handbrake\HandBrakeCLI.exe" ' \
-              '-i "{0}" -t 1 -c 1 -o "{1}" -f mp4 -4  -w 640 --loose-anamorphic ' \
-              '-e x264 -b 1000 -r 29.97 --pfr  -a 1 -E faac -6 dpl2 -R Auto -B ' \
-              '160 -D 0.0 --verbose=1'
-    
-    with open(r'd:\run.bat', 'w') as run_bat:
-        while paths:
-            path = heappop(paths)
-            source = path
-            basename, extension = os.path.splitext(path)
-            destination = (basename[:basename.find('[')].strip() if '[' in path else basename) + '.m4v'
-            destination = os.path.join('D:\media\Complete', os.path.basename(destination))
-            print(command.format(source, destination), file=run_bat)
-    
+    queue_path, destination = _parse_args()
+    try:
+        queue = transcode_queue.JobQueue(queue_path)
+        input_paths = transcode_queue.find_inputs([os.path.join(os.getcwd(), '**', '*.avi')])
+        added = 0
+        with queue.transaction():
+            for path in input_paths:
+                added += queue.add(path, os.path.abspath(os.path.join(destination, _destination_name(path))), '',
+                                   _ENCODER_ARGS)
+        print('queued {0} jobs in {1}, encode them with transcode_queue.py run'.format(added, queue_path))
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stdout)
+        return 1
+    return 0
+
 if __name__ == '__main__':
     sys.exit(main())
-
-
@@ -4,6 +4,8 @@
 import argparse
 import datetime
 import builtins
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
 import pep8
 import platform
@@ -109,28 +111,175 @@ def get_files_in_directory_old(start_dir, predicate=None, sort=False, recurse=Tr
         paths.sort(key=string.lower if os.name == 'nt' else None)
     return paths
 
-def get_files_in_directory(start_dir, predicate=None, sort=False, recurse=True):
-    paths = []
-    if not recurse:
-        for file_name in os.listdir(start_dir):
-            if os.path.isfile(os.path.join(start_dir, file_name)):
-                if predicate is None or predicate(os.path.join(start_dir, file_name)):
-                    if not sort:
-                        yield os.path.join(start_dir, file_name)
-                    else:
-                        paths.append(os.path.join(start_dir, file_name))
+DEFAULT_PRUNE_PATTERNS = ('.git/', '.DS_Store', '@eaDir/')
+
+class WalkEntry(object):
+    '''A file or directory found by walk_directory.
+
+    Wraps the os.DirEntry from the directory listing so is_dir/is_file come from the listing itself and stat is only
+    called once no matter how many times it is asked for.  relpath always uses / and depth is 1 for the entries
+    directly inside the top of the walk.
+    '''
+    __slots__ = ('_entry', 'relpath', 'depth')
+
+    def __init__(self, entry, relpath, depth):
+        self._entry = entry
+        self.relpath = relpath
+        self.depth = depth
+
+    def __fspath__(self):
+        return self._entry.path
+
+    def __repr__(self):
+        return '<WalkEntry {0!r}>'.format(self.relpath)
+
+    @property
+    def name(self):
+        return self._entry.name
+
+    @property
+    def path(self):
+        return self._entry.path
+
+    def is_dir(self, follow_symlinks=True):
+        return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self._entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self):
+        return self._entry.is_symlink()
+
+    def stat(self, follow_symlinks=True):
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+    @property
+    def size(self):
+        return self.stat().st_size
+
+    @property
+    def mtime(self):
+        return self.stat().st_mtime
+
+def _translate_prune_pattern(pattern):
+    '''Returns the regex for one gitignore style pattern, * and ? stop at a / while ** crosses directories.'''
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end].replace('\\', '\\\\')
+            regex += '[{0}]'.format('^' + chars[1:] if chars.startswith('!') else chars)
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r'\Z')
+
+def compile_prune_patterns(patterns):
+    '''Compiles gitignore style patterns for walk_directory.
+
+    A pattern ending in / only matches directories, a leading ! brings back what an earlier pattern pruned (the last
+    matching pattern wins) and a pattern containing a / is matched against the path relative to the top of the walk
+    rather than just the name.  Blank lines and # comments are skipped so the lines of a .gitignore can be passed in.
+    '''
+    compiled = []
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith('#'):
+            continue
+        negate = pattern.startswith('!')
+        pattern = pattern[1:] if negate else pattern
+        directory_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        compiled.append((_translate_prune_pattern(pattern.lstrip('/')), negate, directory_only, anchored))
+    return compiled
+
+def _is_pruned(patterns, name, relpath, is_dir):
+    pruned = False
+    for regex, negate, directory_only, anchored in patterns:
+        if (is_dir or not directory_only) and regex.match(relpath if anchored else name):
+            pruned = not negate
+    return pruned
+
+def walk_directory(start_dir, predicate=None, prune=DEFAULT_PRUNE_PATTERNS, max_depth=None, sort=False,
+                   include_dirs=False, follow_symlinks=False, workers=1, stat=False, on_error=None):
+    '''Yields a WalkEntry for every file under start_dir, and for every directory as well when include_dirs is set.
+
+    Anything matching one of the prune patterns is skipped and a pruned directory is never listed.  predicate gets
+    the WalkEntry so it can use the cached type and stat data, a directory it rejects is still descended into.
+    max_depth=1 only lists start_dir.  With sort the entries come out in the same order as sorting their full paths
+    (a directory comes right before its contents).  With workers > 1 the sibling directories of the one being walked
+    are listed ahead of time on a thread pool and stat also fetches every file's stat result on those threads.
+    on_error(path, err) is called for directories which can not be listed, by default they are skipped quietly.
+    '''
+    patterns = compile_prune_patterns(prune or ())
+
+    def list_directory(path, relpath, depth):
+        entries = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    entry_relpath = relpath + '/' + entry.name if relpath else entry.name
+                    try:
+                        is_dir = entry.is_dir()
+                        if patterns and _is_pruned(patterns, entry.name, entry_relpath, is_dir):
+                            continue
+                        descend = is_dir and (follow_symlinks or not entry.is_symlink())
+                        if stat and not is_dir:
+                            entry.stat()
+                    except OSError as err:
+                        if on_error is not None:
+                            on_error(entry.path, err)
+                        continue
+                    # directories sort as if they ended in a separator which makes the walk match a sort of full paths
+                    key = entry.name + os.sep if descend else entry.name
+                    entries.append((key, descend, WalkEntry(entry, entry_relpath, depth)))
+        except OSError as err:
+            if on_error is not None:
+                on_error(path, err)
+        if sort:
+            entries.sort(key=lambda item: os.path.normcase(item[0]))
+        return entries
+
+    def walk(listing, depth, submit):
+        entries = listing()
+        subdirectories = {}
+        if max_depth is None or depth < max_depth:
+            for key, descend, walk_entry in entries:
+                if descend:
+                    subdirectories[key] = submit(walk_entry.path, walk_entry.relpath, depth + 1)
+        for key, descend, walk_entry in entries:
+            if (include_dirs or not walk_entry.is_dir()) and (predicate is None or predicate(walk_entry)):
+                yield walk_entry
+            if key in subdirectories:
+                yield from walk(subdirectories[key], depth + 1, submit)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            submit = lambda *args: executor.submit(list_directory, *args).result
+            yield from walk(submit(start_dir, '', 1), 1, submit)
     else:
-        for root, dirs, files in os.walk(start_dir):
-            for file_name in files:
-                if predicate is None or predicate(os.path.join(root, file_name)):
-                    if not sort:
-                        yield os.path.join(root, file_name)
-                    else:
-                        paths.append(os.path.join(root, file_name))
-    if sort:
-        paths.sort(key=string.lower if os.name == 'nt' else None)
-        for path_name in paths:
-            yield path_name
+        submit = functools.partial(functools.partial, list_directory)
+        yield from walk(submit(start_dir, '', 1), 1, submit)
+
+def get_files_in_directory(start_dir, predicate=None, sort=False, recurse=True):
+    for entry in walk_directory(start_dir, prune=None, max_depth=None if recurse else 1, sort=sort):
+        if predicate is None or predicate(entry.path):
+            yield entry.path
 
 def _process():
     time.sleep(1)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+from collections import defaultdict, namedtuple
 from datetime import datetime
 import os
 import sys
@@ -10,8 +11,10 @@ import threading
 import traceback
 import time
 import queue
+import sqlite3
 
 import custom_utils
+import hash_cache
 import hash_utils
 
 def _internal_get_chksum(filename, crc_chk=False, md5_chk=True):
@@ -67,39 +70,256 @@ def _dump_file_out_of_proc(dirname, filename, show_last_modified, crc_chk, md5_c
 #            output = filepath
 #        return output
 
-class FileDumperThread(threading.Thread):
-    def __init__(self, dir, files, output, timestamp, quick, do_chksum):
-        threading.Thread.__init__(self)
-        self.dir_length = len(os.path.splitdrive(dir)[1]) + 1
-        self.files = files
-        self.output = output
-        self.timestamp = timestamp
-        self.quick = quick
-        self.do_chksum = do_chksum
-        self.file_lock = threading.Lock()
-        self.output_lock = threading.Lock()
+_QUEUE_SIZE = 256
+
+DumpEntry = namedtuple('DumpEntry', ['name', 'size', 'mtime_ns', 'chksum', 'output'])
+_DumpFailure = namedtuple('_DumpFailure', ['fullname', 'error'])
+
+class Manifest(object):
+    '''A sqlite snapshot of a dump_dir run holding the relative path, size, mtime_ns and chksum of every file.
+
+    Rows are stored in a WITHOUT ROWID table keyed by path so they come back sorted, which lets two manifests be diffed
+    with a merge join instead of loading either one into memory.  A manifest being written goes to a temporary file
+    which only replaces db_path once close() is called, so the previous manifest can be read while its replacement is
+    written to the same path.
+    '''
+    def __init__(self, db_path, create=False, algorithm=None, root=None):
+        self.db_path = db_path
+        self._temp_path = db_path + '.tmp' if create else None
+        if create and os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+        elif not create and not os.path.isfile(db_path):
+            raise IOError('manifest {0} does not exist'.format(db_path))
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self._temp_path or db_path, check_same_thread=False)
+        if create:
+            self._connection.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+            self._connection.execute('CREATE TABLE entries (path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                                     'mtime_ns INTEGER NOT NULL, chksum TEXT) WITHOUT ROWID')
+            self._connection.executemany('INSERT INTO info (key, value) VALUES (?, ?)',
+                                         [('algorithm', algorithm), ('root', root), ('created', datetime.now().isoformat())])
+        info = dict(self._connection.execute('SELECT key, value FROM info'))
+        self.algorithm = info.get('algorithm')
+        self.root = info.get('root')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close(commit=exc_type is None)
+
+    def close(self, commit=True):
+        if self._connection is None:
+            return
+        if commit:
+            self._connection.commit()
+        self._connection.close()
+        self._connection = None
+        if self._temp_path:
+            if commit:
+                os.replace(self._temp_path, self.db_path)
+            else:
+                os.remove(self._temp_path)
+
+    def commit(self):
+        self._connection.commit()
+
+    def add(self, entry):
+        self._connection.execute('INSERT INTO entries (path, size, mtime_ns, chksum) VALUES (?, ?, ?, ?)',
+                                 (entry.name, entry.size, entry.mtime_ns, entry.chksum))
 
-    def run(self):
+    def lookup(self, name):
+        '''Returns (size, mtime_ns, chksum) for a path or None, safe to call from the pipeline's worker threads.'''
+        with self._lock:
+            return self._connection.execute('SELECT size, mtime_ns, chksum FROM entries WHERE path = ?', (name,)).fetchone()
+
+    def entries(self):
+        '''Yields (path, size, mtime_ns, chksum) sorted by path.'''
+        cursor = self._connection.execute('SELECT path, size, mtime_ns, chksum FROM entries ORDER BY path')
         while True:
-            with self.file_lock:
-                if len(self.files) == 0:
-                    return
-                else:
-                    filename = self.files.pop()
-            with self.output_lock:
-                self.output[filename] = self._dump_file(filename)
-
-    def _dump_file(self, filename):
-        filepath = os.path.splitdrive(filename)[1][self.dir_length:]
-        output = ''
-        if self.timestamp:
-            output += '{0:%m/%d/%Y %I:%M:%S %p} '.format(datetime.fromtimestamp(os.path.getmtime(filename)))
-        if self.do_chksum:
-            if self.quick:
-                output += hash_utils.crc32(filename) + ' *'
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+def diff_manifests(old, new):
+    '''Returns dict of 'added', 'removed', 'modified' path lists and 'renamed' (old path, new path) pairs.
+
+    Paths are matched with a merge join of the two sorted manifests.  Files which only disappeared from one path and
+    appeared at another are reported as renamed when their chksum matches (or size and mtime when there are no
+    chksums), so moving a directory does not show up as every file being removed and added.
+    '''
+    compare_chksums = old.algorithm is not None and old.algorithm == new.algorithm
+    added, removed, modified = [], [], []
+    old_entries, new_entries = old.entries(), new.entries()
+    old_row, new_row = next(old_entries, None), next(new_entries, None)
+    while old_row is not None or new_row is not None:
+        if new_row is None or (old_row is not None and old_row[0] < new_row[0]):
+            removed.append(old_row)
+            old_row = next(old_entries, None)
+        elif old_row is None or new_row[0] < old_row[0]:
+            added.append(new_row)
+            new_row = next(new_entries, None)
+        else:
+            if compare_chksums:
+                changed = old_row[1] != new_row[1] or old_row[3] != new_row[3]
+            else:
+                changed = old_row[1] != new_row[1] or old_row[2] != new_row[2]
+            if changed:
+                modified.append(new_row[0])
+            old_row, new_row = next(old_entries, None), next(new_entries, None)
+
+    def identity(row):
+        return (row[1], row[3]) if compare_chksums else (row[1], row[2])
+
+    removed_by_identity = defaultdict(list)
+    for row in removed:
+        removed_by_identity[identity(row)].append(row[0])
+    renamed, still_added = [], []
+    for row in added:
+        candidates = removed_by_identity.get(identity(row))
+        if candidates:
+            renamed.append((candidates.pop(0), row[0]))
+        else:
+            still_added.append(row[0])
+    renamed_from = set(old_name for old_name, new_name in renamed)
+    still_removed = [row[0] for row in removed if row[0] not in renamed_from]
+    return {'added': still_added, 'removed': still_removed, 'modified': modified, 'renamed': renamed}
+
+def print_manifest_diff(diff, file=sys.stdout):
+    for name in diff['added']:
+        print('A {0}'.format(name), file=file)
+    for name in diff['removed']:
+        print('D {0}'.format(name), file=file)
+    for name in diff['modified']:
+        print('M {0}'.format(name), file=file)
+    for old_name, new_name in diff['renamed']:
+        print('R {0} -> {1}'.format(old_name, new_name), file=file)
+    print('{0} added, {1} removed, {2} modified, {3} renamed'.format(
+        len(diff['added']), len(diff['removed']), len(diff['modified']), len(diff['renamed'])), file=file)
+
+def _print_walk_error(path, err):
+    print('ERROR: {0}'.format(err), file=sys.stderr)
+
+def _is_dumped_file(entry):
+    return entry.is_file() and is_not_system_file(entry.name)
+
+def _walk_sorted(directory, recurse):
+    '''Yields (fullname, stat result) in the same order as sorting every path, holding one directory listing at a time.'''
+    for entry in custom_utils.walk_directory(directory, predicate=_is_dumped_file, prune=None,
+                                             max_depth=None if recurse else 1, sort=True, on_error=_print_walk_error):
+        try:
+            yield entry.path, entry.stat()
+        except OSError as err:
+            _print_walk_error(entry.path, err)
+
+class DumpPipeline(object):
+    '''Walks, hashes and formats files on separate threads while handing lines back in sorted order.
+
+    The walker thread feeds a bounded queue which the hashing threads drain.  Finished lines wait in a reorder buffer
+    until every line before them is finished.  A file is only queued once a slot is free and a slot is only freed once
+    its line has been handed back, so no more than queue_size files are held anywhere in the pipeline no matter how many
+    files are in the tree or how long one of them takes to hash.
+    '''
+    def __init__(self, directory, recurse=True, algorithm=None, timestamp=False, thread_count=1, cache=None,
+                 queue_size=_QUEUE_SIZE, previous=None, read_mode=hash_utils.DEFAULT_READ_MODE):
+        self.directory = directory
+        self.recurse = recurse
+        self.algorithm = algorithm
+        self.timestamp = timestamp
+        self.thread_count = max(1, thread_count)
+        self.cache = cache
+        self.read_mode = read_mode
+        self.queue_size = max(1, queue_size)
+        self.previous = previous if previous is not None and previous.algorithm == algorithm else None
+        self.reused = 0
+        self._work = queue.Queue(maxsize=self.queue_size)
+        self._slots = threading.Semaphore(self.queue_size)
+        self._ready = threading.Condition()
+        self._results = {}
+        self._total = None
+
+    def _walker(self):
+        count = 0
+        try:
+            for fullname, stat_result in _walk_sorted(self.directory, self.recurse):
+                self._slots.acquire()
+                self._work.put((count, fullname, stat_result))
+                count += 1
+        except Exception as err:
+            # after the lines walked so far the consumer raises it, like a worker failure, so a listing cut short by a
+            # broken walk never looks complete
+            with self._ready:
+                self._results[count] = _DumpFailure(self.directory, err)
+            count += 1
+        finally:
+            with self._ready:
+                self._total = count
+                self._ready.notify_all()
+            for i in range(self.thread_count):
+                self._work.put(None)
+
+    def _hash(self, fullname, stat_result):
+        if self.cache is not None:
+            # the walk already has the stat the cache validates its entries with
+            return self.cache.hash_file(fullname, (self.algorithm,), stat_result=stat_result,
+                                        read_mode=self.read_mode)[self.algorithm]
+        return hash_utils.hash_file(fullname, (self.algorithm,), read_mode=self.read_mode)[self.algorithm]
+
+    def _dump_file(self, fullname, stat_result):
+        name = fullname[len(self.directory) + 1:]
+        chksum = None
+        if self.algorithm:
+            known = self.previous.lookup(name) if self.previous is not None else None
+            if known is not None and known[0] == stat_result.st_size and known[1] == stat_result.st_mtime_ns and known[2]:
+                chksum = known[2]
+                with self._ready:
+                    self.reused += 1
             else:
-                output += hash_utils.md5sum(filename) + ' *'
-        return output + filepath
+                chksum = self._hash(fullname, stat_result)
+        output = _format_file_entry(name, stat_result.st_mtime, self.timestamp, chksum)
+        return DumpEntry(name, stat_result.st_size, stat_result.st_mtime_ns, chksum, output)
+
+    def _worker(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            index, fullname, stat_result = item
+            try:
+                output = self._dump_file(fullname, stat_result)
+            except OSError as err:
+                print('ERROR: {0}'.format(err), file=sys.stderr)
+                output = None
+            except Exception as err:
+                # anything else is a bug or a broken hash cache, the consumer raises it rather than waiting forever
+                output = _DumpFailure(fullname, err)
+            with self._ready:
+                self._results[index] = output
+                self._ready.notify_all()
+
+    def __iter__(self):
+        threads = [threading.Thread(target=self._walker, daemon=True)]
+        threads += [threading.Thread(target=self._worker, daemon=True) for i in range(self.thread_count)]
+        for thread in threads:
+            thread.start()
+        index = 0
+        while True:
+            with self._ready:
+                while index not in self._results and (self._total is None or index < self._total):
+                    self._ready.wait()
+                if index not in self._results:
+                    break
+                output = self._results.pop(index)
+            self._slots.release()
+            index += 1
+            if isinstance(output, _DumpFailure):
+                raise RuntimeError('unable to dump {0}: {1}'.format(output.fullname, output.error)) from output.error
+            if output is not None:
+                yield output
+        for thread in threads:
+            thread.join()
 
 def _directory_exists(dir):
     if not os.path.isdir(dir):
@@ -114,6 +334,11 @@ def _parse_command_line():
     parser.add_argument('-s', '--no-timestamp', dest='no_timestamp', action='store_true', help='disable timestamp output')
     parser.add_argument('-q', '--quick', dest='quick', action='store_true', help='use crc32 instead of md5sum')
     parser.add_argument('-t', '--thread', dest='thread_count', required=False, type=int, default=1, help='thread count for chksum')
+    parser.add_argument('-Q', '--queue-size', dest='queue_size', required=False, type=int, default=_QUEUE_SIZE, help='maximum number of files held in the pipeline at once')
+    parser.add_argument('-H', '--hash-cache', dest='hash_cache', nargs='?', const=hash_cache.DEFAULT_DB_PATH, default=None, metavar='<DB PATH>', help='reuse chksums of unchanged files from a hash cache database')
+    parser.add_argument('-r', '--read-mode', dest='read_mode', required=False, default=hash_utils.DEFAULT_READ_MODE, choices=hash_utils.READ_MODES, help='how files are read for chksums (nocache/direct keep a scan from flushing the page cache)')
+    parser.add_argument('-m', '--manifest', dest='manifest', required=False, default=None, metavar='<DB PATH>', help='save the listing as a sqlite manifest')
+    parser.add_argument('-p', '--previous', dest='previous', required=False, default=None, metavar='<DB PATH>', help='previous manifest to reuse chksums of unchanged files from and to diff against')
     parser.add_argument('-d', '--directory', dest='directory', required=False, type=_directory_exists, help='destination directory')
     parser.add_argument('output_file', type=argparse.FileType('w'), metavar='<output file>', help='file to output results')
     args = parser.parse_args()
@@ -124,28 +349,73 @@ def _parse_command_line():
     thread_count = args.thread_count if args.thread_count > 0 else 1
     output_file = args.output_file
     directory = os.path.abspath(args.directory) if args.directory else os.getcwd()
-    return norecurse, do_chksum, timestamp, args.quick, thread_count, output_file, directory
+    return (norecurse, do_chksum, timestamp, args.quick, thread_count, args.queue_size, output_file, directory, args.hash_cache,
+            args.manifest, args.previous, args.read_mode)
 
 def is_not_system_file(filename):
     return not filename.lower().endswith('.ds_store')
 
-def dump_dir(directory, output_file, recurse=True, crc32=False, md5=False, timestamp=False, verbose=False):
-    for fullname in custom_utils.get_files_in_directory(directory, predicate=is_not_system_file, sort=True, recurse=recurse):
-        dirname = fullname[:len(directory)]
-        filename = fullname[len(dirname) + 1:]
-        output = _dump_file_out_of_proc(dirname, filename, timestamp, crc32, md5)
-        if verbose:
-            print(output)
-        print(output, file=output_file)
+def _format_file_entry(filename, mtime, show_last_modified, chksum):
+    output = ''
+    if show_last_modified:
+        output += '{0:%m/%d/%Y %I:%M:%S %p} '.format(datetime.fromtimestamp(mtime))
+    if chksum:
+        output += chksum + ' *'
+    return output + filename
+
+def dump_dir(directory, output_file, recurse=True, crc32=False, md5=False, timestamp=False, verbose=False, thread_count=1,
+             cache=None, queue_size=_QUEUE_SIZE, manifest_path=None, previous_path=None,
+             read_mode=hash_utils.DEFAULT_READ_MODE):
+    '''Writes the listing to output_file, optionally saving it as a manifest and reusing/diffing a previous manifest.
+
+    Returns the diff against the previous manifest (see diff_manifests) or None.
+    '''
+    algorithm = 'crc32' if crc32 else 'md5' if md5 else None
+    previous = Manifest(previous_path) if previous_path else None
+    manifest = None
+    if manifest_path or previous is not None:
+        # without a manifest path the new snapshot is only kept long enough to diff it
+        manifest = Manifest(manifest_path or previous_path + '.new', create=True, algorithm=algorithm, root=directory)
+    diff = None
+    try:
+        pipeline = DumpPipeline(directory, recurse, algorithm, timestamp, thread_count, cache, queue_size, previous,
+                                read_mode)
+        for entry in pipeline:
+            if verbose:
+                print(entry.output)
+            print(entry.output, file=output_file)
+            if manifest is not None:
+                manifest.add(entry)
+        if previous is not None:
+            print('reused {0} chksums from {1}'.format(pipeline.reused, previous_path))
+            manifest.commit()
+            diff = diff_manifests(previous, manifest)
+    finally:
+        if previous is not None:
+            previous.close(commit=False)
+        if manifest is not None:
+            manifest.close(commit=bool(manifest_path) and sys.exc_info()[0] is None)
+    return diff
 
 def main():
-    norecurse, do_chksum, timestamp, quick, thread_count, output_file, directory = _parse_command_line()
+    (norecurse, do_chksum, timestamp, quick, thread_count, queue_size, output_file, directory, cache_path, manifest_path,
+     previous_path, read_mode) = _parse_command_line()
 
     try:
         start = time.time()
         crc_chk = do_chksum and quick
         md5_chk = do_chksum and not quick
-        dump_dir(directory, output_file, recurse=not norecurse, md5=md5_chk, crc32=crc_chk, timestamp=timestamp, verbose=True)
+        cache = hash_cache.HashCache(cache_path) if cache_path else None
+        try:
+            diff = dump_dir(directory, output_file, recurse=not norecurse, md5=md5_chk, crc32=crc_chk, timestamp=timestamp,
+                            verbose=True, thread_count=thread_count, cache=cache, queue_size=queue_size,
+                            manifest_path=manifest_path, previous_path=previous_path, read_mode=read_mode)
+            if diff is not None:
+                print_manifest_diff(diff)
+        finally:
+            if cache is not None:
+                cache.close()
+                print(cache)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stdout)
@@ -154,42 +424,5 @@ def main():
         print("Elapsed Time: {0}".format(time.time() - start))
         return 0
 
-def main1():
-    start = time.time()
-    norecurse, do_chksum, timestamp, quick, thread_count, output_file, directory = parse_command_line()
-
-    files = custom_utils.get_files_in_directory(directory, predicate=is_not_system_file, sort=True, recurse=not norecurse)
-    #files.sort(key=str.lower)
-
-    #file_queue = Queue.Queue()
-    #for file in files:
-    #    file_queue.put(file)
-
-    #output_queue = Queue.Queue()
-    threads = []
-    output = {}
-    for i in range(thread_count):
-        thread = FileDumperThread(directory, files, output, timestamp, quick, do_chksum)
-        thread.setDaemon(True)
-        thread.start()
-        threads.append(thread)
-    for thread in threads:
-        thread.join()
-    #file_queue.join()
-
-    filenames = list(output.keys())
-    filenames.sort(key=str.lower)
-    for filename in filenames:
-        print(output[filename])
-        print(output[filename], file=output_file)
-    #assert len(files) == output_queue.qsize()
-    #for i in range(len(files)):
-    #    file_str = file_str_queue.get_nowait()
-    #    print(file_str)
-    #    print(file_str, file=output_file)
-
-    print("Elapsed Time: {0}".format(time.time() - start))
-    return 0
-
 if __name__ == '__main__':
     sys.exit(main())
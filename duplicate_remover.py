@@ -2,77 +2,232 @@
 # vim:softtabstop=4:ts=4:sw=4:expandtab:tw=120
 
 import argparse
-import hashlib
+from datetime import datetime
+import fcntl
+import filecmp
+import json
 import os
-import stat
+import shutil
 import sys
 import traceback
 from functools import reduce
 
+import hash_cache
+import hash_utils
 
-def _sum_sha1_file(fobj, size):
-    hashobj = hashlib.sha1()
-    while True:
-        data = fobj.read(size)
-        if not data:
-            break
-        hashobj.update(data)
-    return hashobj.hexdigest()
+# linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
 
-def get_sha1_hash(filename):
-    size = min(os.stat(filename)[stat.ST_SIZE], 16 * 1048576)
-    with open(filename, 'rb') as fobj:
-        return _sum_sha1_file(fobj, size)
+_LINK_METHODS = ['hardlink', 'reflink']
 
-def _find_duplicates_impl(path, verbose):
-    hashes = {}
+def _walk_files(path):
     for dirpath, dirnames, filenames in os.walk(path):
         for filename in filenames:
-            full_path = os.path.join(dirpath, filename)
-            try:
-                full_path = os.path.realpath(full_path)
-                sha1sum = get_sha1_hash(full_path)
-            except OSError as err:
-                print('OS ERROR: {0}'.format(err), file=sys.stderr)
-                continue
+            yield os.path.realpath(os.path.join(dirpath, filename))
 
-            if sha1sum in hashes:
-                hashes[sha1sum].append(full_path)
-            else:
-                hashes[sha1sum] = []
-                hashes[sha1sum].append(full_path)
+def _print_os_error(filename, err):
+    print('OS ERROR: {0}'.format(err), file=sys.stderr)
 
+def _find_duplicate_groups(path, verbose, workers=hash_utils.DEFAULT_WORKERS, cache=None):
+    '''Returns lists of files with the same sha1, the first file of each list is the one to keep.'''
+    hashes = {}
+    hasher = cache.hash_file if cache is not None else hash_utils.hash_file
+    for full_path, digests in hash_utils.hash_files(_walk_files(path), ('sha1',), workers, _print_os_error, hasher):
+        sha1sum = digests['sha1']
+        if sha1sum in hashes:
+            hashes[sha1sum].append(full_path)
+        else:
+            hashes[sha1sum] = []
+            hashes[sha1sum].append(full_path)
+
+    return [filenames for filenames in hashes.values() if len(filenames) > 1]
+
+def _find_duplicates_impl(path, verbose, workers=hash_utils.DEFAULT_WORKERS, cache=None):
     # this one seems to work??? except it adds one???
     # duplicates = reduce(lambda x, y: x + y[1:], hashes.values())
 
     duplicates = []
-    for filenames in hashes.values():
+    for filenames in _find_duplicate_groups(path, verbose, workers, cache):
         assert filenames 
         for filename in filenames[1:]:
             duplicates.append(filename)
     return duplicates
 
+def _temp_name(path):
+    return os.path.join(os.path.dirname(path), '.{0}.dedupe-{1}'.format(os.path.basename(path), os.getpid()))
+
+def _hardlink(original, duplicate):
+    temp = _temp_name(duplicate)
+    os.link(original, temp)
+    try:
+        os.replace(temp, duplicate)
+    except:
+        os.remove(temp)
+        raise
+
+def _reflink(original, duplicate):
+    temp = _temp_name(duplicate)
+    try:
+        with open(original, 'rb') as src, open(temp, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        shutil.copystat(duplicate, temp)
+        os.replace(temp, duplicate)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+class RollbackJournal(object):
+    '''A write-ahead journal of the linked duplicates, one json object per line.
+
+    Every entry is on disk (fsynced) before its file is replaced, so whatever stops a run part way through the journal
+    lists every file which may have been linked.  A replacement which then fails is followed by a "failed" record.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.entries = 0
+        self._file = open(path, 'a')
+        self._append({'created': datetime.now().isoformat()})
+
+    def _append(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add(self, entry):
+        self._append(entry)
+        self.entries += 1
+
+    def failed(self, path):
+        self._append({'failed': path})
+        self.entries -= 1
+
+    def close(self):
+        self._file.close()
+
+def _read_journal(journal_path):
+    '''Returns the entries of the files which were linked, in the order they were linked.'''
+    entries = []
+    with open(journal_path) as journal_file:
+        for line in journal_file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of a journal whose run was killed while writing it
+                print('ERROR: skipping the incomplete journal line {0!r}'.format(line), file=sys.stderr)
+                continue
+            if 'failed' in record:
+                entries = [entry for entry in entries if entry['path'] != record['failed']]
+            elif 'path' in record:
+                entries.append(record)
+    return entries
+
+def _link_duplicates(groups, method, journal, verbose):
+    '''Replaces every confirmed duplicate with a hard link or reflink clone of the first file in its group.
+
+    Each replacement is recorded in journal (a RollbackJournal) beforehand with the stat data needed to give the file
+    back its own copy.
+    '''
+    reclaimed = 0
+    for group in groups:
+        original = group[0]
+        original_stat = os.stat(original)
+        for duplicate in group[1:]:
+            duplicate_stat = os.stat(duplicate)
+            if (duplicate_stat.st_dev, duplicate_stat.st_ino) == (original_stat.st_dev, original_stat.st_ino):
+                if verbose:
+                    print('  skipped {} (already linked to {})'.format(duplicate, original))
+                continue
+            if duplicate_stat.st_dev != original_stat.st_dev:
+                print('  skipped {} (different file system than {})'.format(duplicate, original))
+                continue
+            if not filecmp.cmp(original, duplicate, shallow=False):
+                print('  skipped {} (contents differ from {})'.format(duplicate, original))
+                continue
+            journal.add({'path': duplicate, 'original': original, 'method': method, 'size': duplicate_stat.st_size,
+                         'mode': duplicate_stat.st_mode, 'uid': duplicate_stat.st_uid, 'gid': duplicate_stat.st_gid,
+                         'atime_ns': duplicate_stat.st_atime_ns, 'mtime_ns': duplicate_stat.st_mtime_ns})
+            try:
+                if method == 'hardlink':
+                    _hardlink(original, duplicate)
+                else:
+                    _reflink(original, duplicate)
+            except OSError as err:
+                print('OS ERROR: {0}'.format(err), file=sys.stderr)
+                journal.failed(duplicate)
+                continue
+            reclaimed += duplicate_stat.st_size
+            print('  {} {} -> {}'.format(method, duplicate, original))
+    return reclaimed
+
+def _rollback(journal_path, verbose):
+    '''Gives every file in the journal its own copy of the data again, restoring its mode, owner and times.'''
+    for entry in reversed(_read_journal(journal_path)):
+        path = entry['path']
+        temp = _temp_name(path)
+        try:
+            shutil.copyfile(path, temp)
+            os.chmod(temp, entry['mode'] & 0o7777)
+            try:
+                os.chown(temp, entry['uid'], entry['gid'])
+            except PermissionError:
+                pass
+            os.utime(temp, ns=(entry['atime_ns'], entry['mtime_ns']))
+            os.replace(temp, path)
+        except OSError as err:
+            print('OS ERROR: {0}'.format(err), file=sys.stderr)
+            if os.path.exists(temp):
+                os.remove(temp)
+            continue
+        print('  restored {}'.format(path))
+
 def _parse_args():
     parser = argparse.ArgumentParser(description='Remove all duplicate files from a directory or directory tree')
     parser.add_argument('-v', '--verbose', action="store_true", help='increase output verbosity')
     parser.add_argument('-d', '--dry-run', action="store_true", help='run the script without deleting anything')
-    parser.add_argument('dirs', nargs='+', action='append', help='specifiy the directories to query')
+    parser.add_argument('-w', '--workers', type=int, default=hash_utils.DEFAULT_WORKERS, help='number of threads used for hashing')
+    parser.add_argument('-H', '--hash-cache', nargs='?', const=hash_cache.DEFAULT_DB_PATH, default=None, metavar='<DB PATH>', help='reuse hashes of unchanged files from a hash cache database')
+    parser.add_argument('-l', '--link', choices=_LINK_METHODS, default=None, help='replace duplicates with hard links or reflink clones instead of deleting them')
+    parser.add_argument('-j', '--journal', metavar='<JOURNAL PATH>', default=None, help='where to record linked duplicates so they can be rolled back')
+    parser.add_argument('-r', '--rollback', metavar='<JOURNAL PATH>', default=None, help='undo the links recorded in a journal')
+    parser.add_argument('dirs', nargs='*', action='append', help='specifiy the directories to query')
     args = parser.parse_args()
 
     dirs = reduce(lambda x, y: x + y, args.dirs)
-    print('INFO: args:\n  verbose: {}\n  dry run: {}\n  dirs: {}'.format(args.verbose, args.dry_run, dirs))
-    return args.verbose, args.dry_run, dirs 
+    if not dirs and not args.rollback:
+        parser.error('the following arguments are required: dirs')
+    journal = args.journal
+    if args.link and not journal:
+        journal = 'duplicate_remover-{0:%Y%m%d-%H%M%S}.jsonl'.format(datetime.now())
+    print('INFO: args:\n  verbose: {}\n  dry run: {}\n  workers: {}\n  link: {}\n  journal: {}\n  dirs: {}'.format(args.verbose, args.dry_run, args.workers, args.link, journal, dirs))
+    return args.verbose, args.dry_run, args.workers, args.hash_cache, args.link, journal, args.rollback, dirs 
 
 def main():
-    verbose, dry_run, dirs = _parse_args()
+    verbose, dry_run, workers, cache_path, link, journal_path, rollback, dirs = _parse_args()
+    if rollback:
+        _rollback(rollback, verbose)
+        return 0
+    cache = hash_cache.HashCache(cache_path) if cache_path else None
+    journal = None
     try:
         for dir in dirs:
             print('Duplicates in {}:'.format(dir))
-            duplicates = _find_duplicates_impl(dir, verbose)
+            groups = _find_duplicate_groups(dir, verbose, workers, cache)
+            duplicates = [filename for group in groups for filename in group[1:]]
             for i, duplicate in enumerate(duplicates, 1):
                 print('{}  {}'.format(i, duplicate))
             print('')
-            if not dry_run:
+            if not dry_run and link:
+                print('Linking duplicates in {}:'.format(dir))
+                if journal is None:
+                    journal = RollbackJournal(journal_path)
+                reclaimed = _link_duplicates(groups, link, journal, verbose)
+                print('  reclaimed {:,} bytes'.format(reclaimed))
+                print('')
+            elif not dry_run:
                 print('Deleting duplicates in {}:'.format(dir))
                 for duplicate in duplicates:
                     #os.remove(duplicate)
@@ -82,6 +237,13 @@ def main():
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
         return 1
+    finally:
+        if journal is not None:
+            journal.close()
+            print('{} links recorded in the journal {}'.format(journal.entries, journal_path))
+        if cache is not None:
+            cache.close()
+            print(cache)
     return 0 
 
 if __name__ == '__main__':
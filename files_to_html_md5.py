@@ -26,15 +26,18 @@ def CloseIndexPhp(outfile):
 
 if __name__ == '__main__':
     with open('index.php', 'w') as outfile:
-        StartIndexPhp()
+        StartIndexPhp(outfile)
+        names = []
         for f in os.listdir('.'):
             if f == 'index.php' or f.find( '?' ) != -1 or f.find( 'System Volume Information' ) != -1 or f.find( 'RECYCLER' ) != -1:
                 continue
-            if os.path.isdir(f):
-                md5str = hash_utils.md5sum(f)
-                print(f + ' - ' + md5str)
-                outfile.write( '\t<tr>\n' )
-                outfile.write( '\t\t<td align=center><a href="' + f + '">' + f + '</a></td>\n' )
-                outfile.write( '\t\t<td align=center>' + md5str + '</td>\n' )
-                outfile.write( '\t</tr>\n' )
+            if os.path.isfile(f):
+                names.append(f)
+        for f, digests in hash_utils.hash_files(names, ('md5',)):
+            md5str = digests['md5']
+            print(f + ' - ' + md5str)
+            outfile.write( '\t<tr>\n' )
+            outfile.write( '\t\t<td align=center><a href="' + f + '">' + f + '</a></td>\n' )
+            outfile.write( '\t\t<td align=center>' + md5str + '</td>\n' )
+            outfile.write( '\t</tr>\n' )
         CloseIndexPhp( outfile )
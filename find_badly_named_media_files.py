@@ -8,6 +8,8 @@ import sys
 import re
 import traceback
 
+import custom_utils
+
 def enum(**enums):
     return type('Enum', (), enums)
 
@@ -105,9 +107,8 @@ class AudioSong(object):
 
 
 def _walk_directory(directory):
-    for root, dirs, files in os.walk(directory):
-        for filename in files:
-            yield os.path.join(root, filename)
+    for entry in custom_utils.walk_directory(directory):
+        yield entry.path
 
 def _split_file_extension(filename):
     index = filename.rfind('.')
@@ -206,9 +207,6 @@ def _scan_media_directory_impl(directory, regex, media_type, verbose, find_prere
                 print('Found invalid name: %s' % fullname)
             continue
 
-        if os.path.isdir(fullname):
-            continue
-
         relative_name = fullname[len(directory) + 1:]
         match = re.match(regex, relative_name)
         if not match:
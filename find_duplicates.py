@@ -2,10 +2,18 @@
 
 import argparse
 import binascii
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+import gzip
+import heapq
+import itertools
 import os
+import platform
+import re
 import sys
+import tempfile
+import threading
 
+import hash_cache
 import hash_utils
 
 print( sys.version)
@@ -32,36 +40,212 @@ def _clear_progress(newline=True):
 #    def __eq__(self, other):
 #        return self.hash == other.hash
 
+_COMPARE_CHUNK = 1024 * 1024
+
+def _read_chunk(file, filename):
+    try:
+        return file.read(_COMPARE_CHUNK)
+    except OSError as err:
+        err.filename = filename
+        raise
+
+def _compare_files(filename1, filename2):
+    '''Returns (equal, bytes read), an OSError names the file which could not be read.'''
+    bytes_read = 0
+    with open(filename1, 'rb') as file1, open(filename2, 'rb') as file2:
+        while True:
+            chunk1, chunk2 = _read_chunk(file1, filename1), _read_chunk(file2, filename2)
+            bytes_read += len(chunk1) + len(chunk2)
+            if chunk1 != chunk2:
+                return False, bytes_read
+            if not chunk1:
+                return True, bytes_read
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.candidates = 0
+        self.eliminated = 0
+        self.bytes_read = 0
+
+    def __str__(self):
+        return '{0:<8} {1:>10} candidates {2:>10} eliminated {3:>16,} bytes read'.format(
+            self.name, self.candidates, self.eliminated, self.bytes_read)
+
 class DuplicateFinder(object):
-    def __init__(self, match, unique, src_dir, dst_dir):
+    '''Finds duplicates in stages so only files which could still be duplicates are read any further.
+
+    Files are grouped by size first, then same size files by a hash of their first and last 64 KiB, then the survivors
+    by a full md5 and finally (optionally) by comparing the bytes.  A file which ends up alone in its group at any
+    stage is unique and is not read again.
+    '''
+    def __init__(self, match, unique, src_dir, dst_dir, workers=hash_utils.DEFAULT_WORKERS, cache=None, verify=False):
         self.src_dir = src_dir
+        self.workers = workers
+        self.cache = cache
+        self.verify = verify
         self.dst_dir = dst_dir
         self.src_files = defaultdict(list)
         self.dst_files = defaultdict(list) if dst_dir else None
         self.matches = defaultdict(list) if match else None
         self.uniques = [] if unique else None
+        self.unreadable = []
+        self.stats = []
+        self._files_read = set()
+        self._files_read_lock = threading.Lock()
 
-    def hash_files(self):
-        i = _clear_progress(False)
-        print('Collecting source files in {0}...'.format(self.src_dir))
-        for root, dirs, files in os.walk(self.src_dir):
-            for filename in files:
-                hash = hash_utils.md5sum_shell(os.path.join(root, filename))
-                self.src_files[hash].append(os.path.join(root, filename))
-                i = _display_progress(i)
-
-        if self.dst_dir == None:
-            return
-        
-        i = _clear_progress()
-        print('Collecting destination files in {0}...'.format(self.dst_dir))
-        for root, dirs, files in os.walk(self.dst_dir):
-            for filename in files:
-                hash = hash_utils.md5sum_shell(os.path.join(root, filename))
-                self.dst_files[hash].append(os.path.join(root, filename))
-                i = _display_progress(i)
+    @staticmethod
+    def _scan_files(directory):
+        '''Yields (filename, size) for every file under directory using the stat data scandir already has.'''
+        pending = [directory]
+        while pending:
+            try:
+                entries = list(os.scandir(pending.pop()))
+            except OSError as err:
+                print('ERROR: {0}'.format(err), file=sys.stderr)
+                continue
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path, entry.stat().st_size
+                except OSError as err:
+                    print('ERROR: {0}'.format(err), file=sys.stderr)
+
+    def _add_file(self, key, filename, is_source):
+        files = self.src_files if is_source else self.dst_files
+        files[key].append(filename)
+
+    def _retire_singletons(self, groups, stats):
+        '''Files alone in their group can not have a duplicate so they are published with a stage specific key.'''
+        survivors = {}
+        for key, members in groups.items():
+            if len(members) == 1:
+                filename, is_source, size = members[0]
+                self._add_file('{0}:{1}'.format(stats.name, key), filename, is_source)
+                stats.eliminated += 1
+            else:
+                survivors[key] = members
+        return survivors
 
+    def _report_unreadable(self, filename, err):
+        '''A file which can not be read is neither a duplicate nor unique, it is listed on its own.'''
+        print('ERROR: unable to read {0}: {1}'.format(filename, err), file=sys.stderr)
+        self.unreadable.append((filename, str(err)))
+
+    def _full_hash(self, filename, algorithms):
+        '''hash_file, through the cache when there is one, noting the files which were actually read.'''
+        if self.cache is None:
+            digests = hash_utils.hash_file(filename, algorithms)
+        else:
+            st = os.stat(filename)
+            cached = self.cache.lookup(filename, algorithms, st)
+            digests = self.cache.hash_file(filename, algorithms, stat_result=st)
+            if cached is not None and len(cached) == len(algorithms):
+                return digests
+        with self._files_read_lock:
+            self._files_read.add(filename)
+        return digests
+
+    def _hash_stage(self, groups, stats, sample):
+        members_by_name = defaultdict(list)
+        filenames = []
+        new_groups = defaultdict(list)
+        for key, members in groups.items():
+            for filename, is_source, size in members:
+                stats.candidates += 1
+                if not sample and size <= 2 * hash_utils.SAMPLE_SIZE:
+                    # the sample hash of a small file already covers every byte
+                    new_groups[key[1]].append((filename, is_source, size))
+                    continue
+                if filename not in members_by_name:
+                    filenames.append(filename)
+                members_by_name[filename].append((key, is_source, size))
+
+        hasher = hash_utils.hash_file_sample if sample else self._full_hash
+        i = _clear_progress(False)
+        for filename, digests in hash_utils.hash_files(filenames, ('md5',), self.workers, self._report_unreadable, hasher):
+            for key, is_source, size in members_by_name[filename]:
+                if sample:
+                    stats.bytes_read += min(size, 2 * hash_utils.SAMPLE_SIZE)
+                elif filename in self._files_read:
+                    # a digest from the hash cache did not read anything
+                    stats.bytes_read += size
+                new_key = (key, digests['md5']) if sample else digests['md5']
+                new_groups[new_key].append((filename, is_source, size))
+            i = _display_progress(i)
         _clear_progress()
+        return self._retire_singletons(new_groups, stats)
+
+    def _verify_stage(self, groups, stats):
+        new_groups = {}
+        for key, members in groups.items():
+            stats.candidates += len(members)
+            subgroups = []
+            for member in members:
+                placed = False
+                i = 0
+                while not placed and i < len(subgroups):
+                    subgroup = subgroups[i]
+                    try:
+                        equal, bytes_read = _compare_files(subgroup[0][0], member[0])
+                    except OSError as err:
+                        if err.filename == subgroup[0][0]:
+                            # the rest of the subgroup already compared equal with it so the next one leads it
+                            self._report_unreadable(subgroup[0][0], err)
+                            del subgroup[0]
+                            if not subgroup:
+                                del subgroups[i]
+                        else:
+                            self._report_unreadable(member[0], err)
+                            placed = True
+                        continue
+                    stats.bytes_read += bytes_read
+                    if equal:
+                        subgroup.append(member)
+                        placed = True
+                    i += 1
+                if not placed:
+                    subgroups.append([member])
+            for i, subgroup in enumerate(subgroups):
+                new_groups[key if i == 0 else '{0}-{1}'.format(key, i)] = subgroup
+        return self._retire_singletons(new_groups, stats)
+
+    def hash_files(self):
+        stats = StageStats('size')
+        self.stats.append(stats)
+        groups = defaultdict(list)
+        directories = [(self.src_dir, True)] + ([(self.dst_dir, False)] if self.dst_dir != None else [])
+        for directory, is_source in directories:
+            print('Collecting files in {0}...'.format(directory))
+            for filename, size in DuplicateFinder._scan_files(directory):
+                groups[size].append((filename, is_source, size))
+                stats.candidates += 1
+        groups = self._retire_singletons(groups, stats)
+
+        print('Hashing the first and last {0} bytes of same sized files...'.format(hash_utils.SAMPLE_SIZE))
+        stats = StageStats('partial')
+        self.stats.append(stats)
+        groups = self._hash_stage(groups, stats, sample=True)
+
+        print('Hashing the remaining candidates...')
+        stats = StageStats('full')
+        self.stats.append(stats)
+        groups = self._hash_stage(groups, stats, sample=False)
+
+        if self.verify:
+            print('Comparing the contents of the remaining candidates...')
+            stats = StageStats('verify')
+            self.stats.append(stats)
+            groups = self._verify_stage(groups, stats)
+
+        for key, members in groups.items():
+            for filename, is_source, size in members:
+                self._add_file(key, filename, is_source)
+
+        for stats in self.stats:
+            print(stats)
 
     @staticmethod
     def _find_matches_template(src_files, dst_files):
@@ -140,8 +324,153 @@ class DuplicateFinder(object):
             for filename in self.uniques:
                 output.append('{0}'.format(filename))
             output.append('\n')
+        if self.unreadable:
+            output.append('The following files could not be read:\n')
+            for filename, err in self.unreadable:
+                output.append('{0}: {1}'.format(filename, err))
+            output.append('\n')
         return '\n'.join(output)
 
+_MANIFEST_HEADER = '#find_duplicates manifest'
+_MANIFEST_CHUNK = 200000
+_UNESCAPES = {'n': '\n', 't': '\t'}
+
+# sorted by content first so manifests can be merge-joined on (md5, size)
+ManifestEntry = namedtuple('ManifestEntry', ['md5', 'size', 'path'])
+
+def _escape_path(path):
+    return path.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+def _unescape_path(path):
+    return re.sub(r'\\(.)', lambda match: _UNESCAPES.get(match.group(1), match.group(1)), path)
+
+def _write_entries(file, entries):
+    for entry in entries:
+        file.write('{0}\t{1}\t{2}\n'.format(entry.md5, entry.size, _escape_path(entry.path)))
+
+def _read_entries(file):
+    for line in file:
+        fields = line.rstrip('\n').split('\t')
+        # manifests exported before the partial hash was dropped have it as the third field
+        md5, size, path = fields[0], fields[1], fields[-1]
+        yield ManifestEntry(md5, int(size), _unescape_path(path))
+
+def _external_sort(entries, chunk_size=_MANIFEST_CHUNK):
+    '''Sorts entries holding no more than chunk_size of them in memory, full chunks are sorted and spilled to temporary
+    files which are then merged.'''
+    runs = []
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            run = tempfile.TemporaryFile('w+', encoding='utf-8', newline='\n')
+            _write_entries(run, sorted(chunk))
+            run.seek(0)
+            runs.append(run)
+            chunk = []
+    chunk.sort()
+    try:
+        yield from heapq.merge(chunk, *[_read_entries(run) for run in runs])
+    finally:
+        for run in runs:
+            run.close()
+
+def export_manifest(directory, manifest_path, label=None, workers=hash_utils.DEFAULT_WORKERS, cache=None,
+                    chunk_size=_MANIFEST_CHUNK):
+    '''Writes a gzip'd manifest of every file under directory sorted by content hash, returns the number of entries.
+
+    Each line holds the full md5, size and the path relative to directory.  The header records label (the host name by
+    default) and directory so results from another machine can be reported with where the file actually lives.
+
+    Unlike the staged search every file is fully hashed: the files in the other manifests can not be read when they
+    are joined, so a size or partial hash match could never be confirmed.
+    '''
+    hasher = cache.hash_file if cache is not None else hash_utils.hash_file
+
+    def manifest_hasher(filename, algorithms):
+        size = os.stat(filename).st_size
+        return {'size': size, 'md5': hasher(filename, ('md5',))['md5']}
+
+    def on_error(filename, err):
+        print('ERROR: unable to read {0}: {1}'.format(filename, err), file=sys.stderr)
+
+    filenames = (filename for filename, size in DuplicateFinder._scan_files(directory))
+    entries = (ManifestEntry(digests['md5'], digests['size'], os.path.relpath(filename, directory))
+               for filename, digests in hash_utils.hash_files(filenames, ('md5',), workers, on_error, manifest_hasher))
+    count = 0
+    with gzip.open(manifest_path, 'wt', encoding='utf-8', newline='\n') as manifest:
+        manifest.write('{0}\t{1}\t{2}\n'.format(_MANIFEST_HEADER, label or platform.node(), _escape_path(directory)))
+        for entry in _external_sort(entries, chunk_size):
+            _write_entries(manifest, [entry])
+            count += 1
+    return count
+
+def read_manifest_header(manifest_path):
+    '''Returns the (label, directory) a manifest was exported with.'''
+    with gzip.open(manifest_path, 'rt', encoding='utf-8', newline='\n') as manifest:
+        header = manifest.readline().rstrip('\n').split('\t')
+    if len(header) != 3 or header[0] != _MANIFEST_HEADER:
+        raise ValueError('{0} is not a find_duplicates manifest'.format(manifest_path))
+    return header[1], _unescape_path(header[2])
+
+def read_manifest(manifest_path):
+    '''Yields the ManifestEntry records of a manifest in sorted order without loading the manifest.'''
+    read_manifest_header(manifest_path)
+    with gzip.open(manifest_path, 'rt', encoding='utf-8', newline='\n') as manifest:
+        manifest.readline()
+        yield from _read_entries(manifest)
+
+def merge_manifests(manifest_paths):
+    '''Merge-joins the manifests yielding (md5, [(manifest index, entry), ...]) for every distinct content.
+
+    Only one line per manifest and the members of the current group are held in memory.
+    '''
+    def tagged(index, path):
+        for entry in read_manifest(path):
+            yield entry, index
+
+    sources = [tagged(index, path) for index, path in enumerate(manifest_paths)]
+    for key, members in itertools.groupby(heapq.merge(*sources), key=lambda item: (item[0].md5, item[0].size)):
+        yield key[0], [(index, entry) for entry, index in members]
+
+def find_manifest_matches(manifest_paths):
+    '''Yields (md5, members) for content found more than once across all of the manifests.'''
+    for md5, members in merge_manifests(manifest_paths):
+        if len(members) > 1:
+            yield md5, members
+
+def find_manifest_uniques(manifest_paths):
+    '''Yields (index, entry) for content found in only one manifest, or found only once when there is one manifest.'''
+    for md5, members in merge_manifests(manifest_paths):
+        if len(manifest_paths) == 1 and len(members) == 1:
+            yield members[0]
+        elif len(manifest_paths) > 1 and len(set(index for index, entry in members)) == 1:
+            yield from members
+
+def print_manifest_results(manifest_paths, match, output):
+    '''Streams the matches (or uniques) of the manifests to output, returns how many were found.'''
+    locations = [read_manifest_header(path) for path in manifest_paths]
+
+    def location(index, entry):
+        label, directory = locations[index]
+        return '{0}:{1}'.format(label, os.path.join(directory, entry.path))
+
+    found = 0
+    if match:
+        print('The following are duplicate files:\n', file=output)
+        for md5, members in find_manifest_matches(manifest_paths):
+            found += 1
+            print('unique id: {0}'.format(md5), file=output)
+            for index, entry in members:
+                print('\t{0}'.format(location(index, entry)), file=output)
+            print('\n', file=output)
+    else:
+        print('The following are unique files:\n', file=output)
+        for index, entry in find_manifest_uniques(manifest_paths):
+            found += 1
+            print(location(index, entry), file=output)
+    return found
+
 def _directory_exists(dir):
     if not os.path.isdir(dir):
         msg = "{0} is not a valid directory".format(dir)
@@ -156,20 +485,53 @@ def parse_command_line():
     operation_group = parser.add_mutually_exclusive_group(required=True)
     operation_group.add_argument('-m', '--match', default=False, action='store_true', help='find files which match')
     operation_group.add_argument('-u', '--unique', default=False, action='store_true', help='find files which are unique')
-    parser.add_argument('-s', '--source', metavar='<directory>', required=True, type=_directory_exists, help='source directory')
+    operation_group.add_argument('-e', '--export', metavar='<manifest>', default=None, help='write a manifest of the source directory to compare on another machine')
+    parser.add_argument('-s', '--source', metavar='<directory>', required=False, type=_directory_exists, help='source directory')
     parser.add_argument('-d', '--destination', metavar='<directory>', required=False, type=_directory_exists, help='destination directory')
+    parser.add_argument('-w', '--workers', metavar='<count>', default=hash_utils.DEFAULT_WORKERS, type=int, help='number of threads used for hashing')
+    parser.add_argument('-H', '--hash-cache', metavar='<DB PATH>', nargs='?', const=hash_cache.DEFAULT_DB_PATH, default=None, help='reuse hashes of unchanged files from a hash cache database')
+    parser.add_argument('-V', '--verify', default=False, action='store_true', help='compare the contents of files with matching hashes byte for byte')
+    parser.add_argument('-M', '--manifest', metavar='<manifest>', dest='manifests', action='append', default=[], help='compare exported manifests (repeatable), the source and destination are exported and compared along with them')
+    parser.add_argument('-L', '--label', metavar='<label>', default=None, help='name recorded in an exported manifest (default the host name)')
     parser.add_argument('-o', '--output', metavar='<output>', default=sys.stdout, required=False, type=argparse.FileType('w'), help='file to output results')
     args = parser.parse_args()
+    if args.source is None and not (args.manifests and not args.export):
+        parser.error('the following arguments are required: -s/--source')
     
     source = args.source
     destination = args.destination if args.destination != args.source else None
-    return args.match, args.unique, source, destination, args.output
+    return (args.match, args.unique, args.export, source, destination, args.workers, args.hash_cache, args.verify,
+            args.manifests, args.label, args.output)
+
+def _compare_manifests(manifests, directories, workers, cache, label, match, output):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        manifests = list(manifests)
+        for i, directory in enumerate(directories):
+            manifest_path = os.path.join(temp_dir, '{0}.tsv.gz'.format(i))
+            print('Exporting {0}...'.format(directory))
+            export_manifest(directory, manifest_path, label, workers, cache)
+            manifests.append(manifest_path)
+        found = print_manifest_results(manifests, match, output)
+    print('{0} {1} found'.format(found, 'duplicate groups' if match else 'unique files'))
 
 def main():
-    match, unique, src_dir, dst_dir, output = parse_command_line()
+    match, unique, export, src_dir, dst_dir, workers, cache_path, verify, manifests, label, output = parse_command_line()
     
-    finder = DuplicateFinder(match, unique, src_dir, dst_dir)
+    cache = hash_cache.HashCache(cache_path) if cache_path else None
+    if export or manifests:
+        if export:
+            print('Exported {0} entries to {1}'.format(export_manifest(src_dir, export, label, workers, cache), export))
+        else:
+            _compare_manifests(manifests, [dir for dir in (src_dir, dst_dir) if dir], workers, cache, label, match, output)
+        if cache is not None:
+            cache.close()
+            print(cache)
+        return 0
+    finder = DuplicateFinder(match, unique, src_dir, dst_dir, workers, cache, verify)
     finder.hash_files()
+    if cache is not None:
+        cache.close()
+        print(cache)
     finder.process_files()
     print(finder, file=output)
     return 0
@@ -16,12 +16,15 @@ def _parse_args():
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-d', '--directory', metavar='<DIRECTORY>', required=True, type=_is_directory, help='directory to scan for media')
     parser.add_argument('-f', '--filename', metavar='<FILENAME>', required=True, type=str, help='file to backup file names into')
+    parser.add_argument('-i', '--index', nargs='?', const=True, default=None, metavar='<DB PATH>', help='read the bit rates from the media index (default ~/.cache/media_index/media.db), only new or changed files are parsed')
     sub_parsers = parser.add_subparsers(help='commands', dest='command')
     unknown_files = sub_parsers.add_parser('find-unknown-files', help='identify all unknown files within the repository')
+    check_bit_rates = sub_parsers.add_parser('check-bit-rates', help='report the bit rate of every album and the albums with mixed bit rates')
 
     args = parser.parse_args()
     find_unknown_files = args.command == 'find-unknown-files'
-    return args.directory, args.filename, find_unknown_files
+    check_bit_rates = args.command == 'check-bit-rates'
+    return args.directory, args.filename, find_unknown_files, check_bit_rates, args.index
 
 def _is_media_file(filename):
     return filename.endswith('.mp3') or \
@@ -39,14 +42,14 @@ def _is_ignorable_file(filename):
            filename.lower().endswith('folder.jpg')
 
 _BIT_RATES = {}
-def _process_directory(root, files):
+def _process_directory(root, files, index=None):
     media_found = False
     for filename in files:
         #if media_found: break
         if _is_media_file(filename):
             media_found = True
             pathname = os.path.join(root, filename)
-            info = mediainfo(pathname)
+            info = index.get_tag_info(pathname) if index is not None else mediainfo(pathname)
             bit_rate = int(float(info['bit_rate']) / 1000)
             global _BIT_RATES
             if root in _BIT_RATES:
@@ -88,16 +91,34 @@ def _find_all_files(directory, filename):
             file.write(json.dumps(data, sort_keys=True, indent=4, separators=(',', ': ')))
     return all_files
 
+def _check_bit_rates(files, index=None):
+    files_by_directory = {}
+    for pathname in files:
+        files_by_directory.setdefault(os.path.dirname(pathname), []).append(os.path.basename(pathname))
+    for root in sorted(files_by_directory):
+        _process_directory(root, files_by_directory[root], index)
+
 def _main():
-    directory, filename, find_unknown_files = _parse_args()
+    directory, filename, find_unknown_files, check_bit_rates, index_path = _parse_args()
+    index = None
     try:
         files = _find_all_files(directory, filename)
+        if index_path:
+            # pymediainfo is only needed when the index is used
+            import media_index
+            index = media_index.MediaIndex(index_path if index_path is not True else media_index.DEFAULT_DB_PATH)
+            index.refresh([pathname for pathname in files if _is_media_file(pathname)])
         if find_unknown_files:
             _find_unknown_files(files)
+        if check_bit_rates:
+            _check_bit_rates(files, index)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stdout)
         return 1
+    finally:
+        if index is not None:
+            index.close()
     return 0
 
 if __name__ == '__main__':
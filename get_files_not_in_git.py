@@ -12,6 +12,8 @@ import os
 import sys
 import traceback
 
+import custom_utils
+
 def _update_logger(verbosity):
     if verbosity == 0:
         _log.setLevel(logging.ERROR)
@@ -75,16 +77,12 @@ def _get_repository_files(directory):
 
 def _get_all_files(directory):
     _log.info('getting all files within %s' % directory)
-    all_files = {}
-    for root, dirs, files in os.walk(directory):
-        if root.startswith(os.path.abspath(os.path.join(directory, '.git'))):
-            continue
-        dir_entry = {}
-        for filename in files:
-            if not filename.endswith('.swp'):
-                fullname = os.path.join(root, filename)
-                dir_entry[_gethash(fullname)] = fullname
-        all_files[root] = dir_entry
+    all_files = {directory: {}}
+    for entry in custom_utils.walk_directory(directory, prune=['/.git/', '*.swp'], include_dirs=True):
+        if entry.is_dir():
+            all_files[entry.path] = {}
+        else:
+            all_files[os.path.dirname(entry.path)][_gethash(entry.path)] = entry.path
     return all_files
 
 def _collapse_directories(filenames):
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# vim:softtabstop=4:ts=4:sw=4:expandtab:tw=120
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+import hash_utils
+
+DEFAULT_DB_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'hash_cache', 'hashes.db')
+
+_COMMIT_INTERVAL = 500
+
+_CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS hashes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    {0},
+    last_used REAL NOT NULL,
+    PRIMARY KEY (device, inode))'''.format(',\n    '.join('{0} TEXT'.format(name) for name in hash_utils.ALGORITHMS))
+
+class HashCache(object):
+    '''Content hashes stored in sqlite keyed by (device, inode) and validated against the file's size and mtime_ns.
+
+    Any change to the stat data throws away every digest stored for the file.  Digests are stored per algorithm so
+    asking for sha256 on a file only md5'd so far reads the file once more for sha256 and keeps the md5.  The object can
+    be shared by the threads in hash_utils.hash_files, i.e. hash_utils.hash_files(names, hasher=cache.hash_file).
+    '''
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        if db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._pending_writes = 0
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(_CREATE_TABLE)
+        self._connection.execute('CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)')
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        ratio = float(self.hits) / lookups if lookups else 0.0
+        return 'hash cache {0}: {1} hits, {2} misses, {3} invalidated ({4:.1%} hit rate)'.format(
+            self.db_path, self.hits, self.misses, self.invalidations, ratio)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.commit()
+                self._connection.close()
+                self._connection = None
+
+    def _write(self, statement, parameters):
+        '''Must be called with the lock held; commits in batches so a big walk is not one fsync per file.'''
+        self._connection.execute(statement, parameters)
+        self._pending_writes += 1
+        if self._pending_writes >= _COMMIT_INTERVAL:
+            self._connection.commit()
+            self._pending_writes = 0
+
+    def lookup(self, file_name, algorithms=hash_utils.ALGORITHMS, stat_result=None):
+        '''Returns the cached digests for the requested algorithms which are still valid for the file.'''
+        st = stat_result if stat_result is not None else os.stat(file_name)
+        query = 'SELECT size, mtime_ns, {0} FROM hashes WHERE device = ? AND inode = ?'.format(', '.join(hash_utils.ALGORITHMS))
+        with self._lock:
+            row = self._connection.execute(query, (st.st_dev, st.st_ino)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return None
+        stored = dict(zip(hash_utils.ALGORITHMS, row[2:]))
+        return {algorithm: stored[algorithm] for algorithm in algorithms if stored[algorithm]}
+
+    def hash_file(self, file_name, algorithms=hash_utils.ALGORITHMS, stat_result=None,
+                  read_mode=hash_utils.DEFAULT_READ_MODE):
+        '''Returns a dict of algorithm name to hex digest, only reading the file for digests not already cached.'''
+        st = stat_result if stat_result is not None else os.stat(file_name)
+        cached = self.lookup(file_name, algorithms, st)
+        missing = [algorithm for algorithm in algorithms if cached is None or algorithm not in cached]
+        now = time.time()
+        if not missing:
+            with self._lock:
+                self.hits += 1
+                self._write('UPDATE hashes SET last_used = ?, path = ? WHERE device = ? AND inode = ?',
+                            (now, file_name, st.st_dev, st.st_ino))
+            return cached
+
+        digests = hash_utils.hash_file(file_name, missing, read_mode=read_mode)
+        with self._lock:
+            self.misses += 1
+            if cached is not None:
+                assignments = ', '.join('{0} = ?'.format(algorithm) for algorithm in missing)
+                statement = 'UPDATE hashes SET {0}, last_used = ?, path = ? WHERE device = ? AND inode = ?'.format(assignments)
+                self._write(statement, [digests[algorithm] for algorithm in missing] + [now, file_name, st.st_dev, st.st_ino])
+            else:
+                # a stale row (different size/mtime) is replaced wholesale which drops digests of the old contents
+                columns = ', '.join(missing)
+                placeholders = ', '.join('?' for _ in missing)
+                key = (st.st_dev, st.st_ino)
+                self.invalidations += self._connection.execute('DELETE FROM hashes WHERE device = ? AND inode = ?', key).rowcount
+                self._write('INSERT INTO hashes (device, inode, size, mtime_ns, path, {0}, last_used) '
+                            'VALUES (?, ?, ?, ?, ?, {1}, ?)'.format(columns, placeholders),
+                            [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, file_name] +
+                            [digests[algorithm] for algorithm in missing] + [now])
+        if cached:
+            digests.update(cached)
+        return {algorithm: digests[algorithm] for algorithm in algorithms}
+
+    def hash_files(self, file_names, algorithms=hash_utils.ALGORITHMS, workers=hash_utils.DEFAULT_WORKERS,
+                   on_error=None, read_mode=None):
+        '''Same as hash_utils.hash_files except digests come from the cache when the file has not changed.'''
+        return hash_utils.hash_files(file_names, algorithms, workers, on_error, self.hash_file, read_mode)
+
+    def prune(self, max_entries=None, max_age=None):
+        '''Removes entries for files which no longer exist, then the least recently used beyond max_entries or older
+        than max_age seconds.  Returns the number of entries removed.'''
+        with self._lock:
+            rows = self._connection.execute('SELECT device, inode, path FROM hashes').fetchall()
+        deleted = []
+        for device, inode, path in rows:
+            try:
+                st = os.stat(path)
+                if st.st_dev == device and st.st_ino == inode:
+                    continue
+            except OSError:
+                pass
+            deleted.append((device, inode))
+
+        with self._lock:
+            removed = 0
+            for key in deleted:
+                removed += self._connection.execute('DELETE FROM hashes WHERE device = ? AND inode = ?', key).rowcount
+            if max_age is not None:
+                cutoff = time.time() - max_age
+                removed += self._connection.execute('DELETE FROM hashes WHERE last_used < ?', (cutoff,)).rowcount
+            if max_entries is not None:
+                removed += self._connection.execute('DELETE FROM hashes WHERE rowid NOT IN '
+                                                    '(SELECT rowid FROM hashes ORDER BY last_used DESC LIMIT ?)',
+                                                    (max_entries,)).rowcount
+            self._connection.commit()
+            self._pending_writes = 0
+        return removed
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Maintains the content hash cache shared by the hashing scripts')
+    parser.add_argument('-d', '--database', default=DEFAULT_DB_PATH, metavar='<DB PATH>', help='hash cache database')
+    parser.add_argument('-p', '--prune', action='store_true', help='remove entries for files which no longer exist')
+    parser.add_argument('-n', '--max-entries', type=int, default=None, help='when pruning keep only the most recently used entries')
+    parser.add_argument('-a', '--max-age', type=float, default=None, metavar='<DAYS>', help='when pruning remove entries unused for this many days')
+    parser.add_argument('input', nargs='*', metavar='<input>', help='files or directories to hash through the cache')
+    args = parser.parse_args()
+    max_age = args.max_age * 86400 if args.max_age is not None else None
+    return args.database, args.prune, args.max_entries, max_age, args.input
+
+def _walk_input(input_names):
+    for name in input_names:
+        if os.path.isdir(name):
+            for root, dirs, files in os.walk(name):
+                for file_name in sorted(files):
+                    yield os.path.join(root, file_name)
+        elif os.path.isfile(name):
+            yield name
+
+def main():
+    db_path, prune, max_entries, max_age, input_names = _parse_args()
+    try:
+        with HashCache(db_path) as cache:
+            for file_name, digests in cache.hash_files(_walk_input(input_names), ('md5',)):
+                print('{0} {1}'.format(digests['md5'], os.path.abspath(file_name)))
+            if prune:
+                print('pruned {0} entries'.format(cache.prune(max_entries, max_age)))
+            print('{0} ({1} entries)'.format(cache, len(cache)), file=sys.stderr)
+        return 0
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 # vim:softtabstop=4:ts=4:sw=4:expandtab:tw=120
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import functools
 import os
 import hashlib
+import mmap
 import re
 import stat
 import string
 import subprocess
 import sys
+import threading
+import time
 import traceback
 import zlib
 
@@ -20,6 +27,21 @@ import custom_utils
 
 _HASH_FUNCTIONS = [hashlib.md5]
 
+ALGORITHMS = ('md5', 'sha1', 'sha256', 'crc32')
+_BUFFER_SIZE = 4 * 1048576
+SAMPLE_SIZE = 64 * 1024
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# readinto: one preallocated buffer per thread
+# mmap: map large files and hash straight out of the page cache (smaller files use readinto)
+# nocache: readinto with posix_fadvise SEQUENTIAL and DONTNEED behind the reader so a scan does not evict hot pages
+# direct: O_DIRECT reads into a page aligned buffer which bypasses the page cache (falls back to nocache if unsupported)
+READ_MODES = ('readinto', 'mmap', 'nocache', 'direct')
+DEFAULT_READ_MODE = 'readinto'
+_MMAP_THRESHOLD = 64 * 1048576
+
+_thread_buffers = threading.local()
+
 class Hasher(object):
     def __init__(self, hash_type):
         self.mHashObject = hash_type
@@ -49,10 +71,207 @@ def CreateHasher(hash_type):
 #        self.mHashObj = hashlib.md5() if hash_obj is None else hash_obj
 #        self.mShell = 'md'
 
+class _Crc32Hasher(object):
+    '''Wraps zlib.crc32 in the same update()/hexdigest() interface hashlib uses.'''
+    def __init__(self):
+        self._value = 0
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+    def hexdigest(self):
+        return '%08x' % (self._value & 0xFFFFFFFF)
+
+def _create_hashers(algorithms):
+    '''Returns a dict of algorithm name to a new hash object for each requested algorithm.'''
+    hashers = {}
+    for algorithm in algorithms:
+        if algorithm not in ALGORITHMS:
+            raise ValueError('unsupported hash algorithm {0}, expected one of {1}'.format(algorithm, ', '.join(ALGORITHMS)))
+        hashers[algorithm] = _Crc32Hasher() if algorithm == 'crc32' else hashlib.new(algorithm)
+    return hashers
+
+def _get_thread_buffer(size):
+    '''Returns a buffer which is allocated once per thread and reused for every file it hashes.'''
+    buffer = getattr(_thread_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = bytearray(size)
+        _thread_buffers.buffer = buffer
+    return buffer
+
+def _get_thread_aligned_buffer(size):
+    '''Returns a page aligned (anonymous mmap) buffer per thread as O_DIRECT reads require.'''
+    buffer = getattr(_thread_buffers, 'aligned_buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = mmap.mmap(-1, size)
+        _thread_buffers.aligned_buffer = buffer
+    return buffer
+
+def _update_all(hashers, data):
+    for hasher in hashers:
+        hasher.update(data)
+
+def _feed_readinto(f, hashers, buffer_size, drop_cache=False):
+    fd = f.fileno()
+    drop_cache = drop_cache and hasattr(os, 'posix_fadvise')
+    if drop_cache:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    buffer = _get_thread_buffer(buffer_size)
+    with memoryview(buffer) as view:
+        offset = 0
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            with view[:count] as data:
+                _update_all(hashers, data)
+            if drop_cache:
+                os.posix_fadvise(fd, offset, count, os.POSIX_FADV_DONTNEED)
+            offset += count
+
+def _feed_mmap(f, hashers, buffer_size):
+    size = os.fstat(f.fileno()).st_size
+    if size < _MMAP_THRESHOLD:
+        return _feed_readinto(f, hashers, buffer_size)
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for offset in range(0, size, buffer_size):
+                with view[offset:offset + buffer_size] as data:
+                    _update_all(hashers, data)
+
+def _open_direct(file_name):
+    '''Returns an O_DIRECT descriptor for file_name, None when the platform or file system (i.e. tmpfs) has none.'''
+    try:
+        return os.open(file_name, os.O_RDONLY | getattr(os, 'O_DIRECT'))
+    except AttributeError:
+        return None
+    except OSError as err:
+        if err.errno != errno.EINVAL:
+            raise
+        return None
+
+def _feed_direct(fd, hashers, buffer_size):
+    buffer = _get_thread_aligned_buffer(buffer_size)
+    with memoryview(buffer) as view:
+        while True:
+            count = os.readv(fd, [buffer])
+            if not count:
+                break
+            with view[:count] as data:
+                _update_all(hashers, data)
+
+def hash_file(file_name, algorithms=ALGORITHMS, buffer_size=_BUFFER_SIZE, read_mode=DEFAULT_READ_MODE):
+    '''Reads a file once and feeds every requested algorithm, returning a dict of algorithm name to hex digest.
+
+    read_mode picks how the file is read, see READ_MODES.
+    '''
+    if read_mode not in READ_MODES:
+        raise ValueError('unsupported read mode {0}, expected one of {1}'.format(read_mode, ', '.join(READ_MODES)))
+    hashers = _create_hashers(algorithms)
+    # the file is opened once, the buffered open is only the fallback when O_DIRECT is not supported
+    fd = _open_direct(file_name) if read_mode == 'direct' else None
+    if fd is not None:
+        try:
+            _feed_direct(fd, hashers.values(), buffer_size)
+        finally:
+            os.close(fd)
+    else:
+        with open(file_name, 'rb', buffering=0) as f:
+            if read_mode == 'mmap':
+                _feed_mmap(f, hashers.values(), buffer_size)
+            else:
+                _feed_readinto(f, hashers.values(), buffer_size, drop_cache=read_mode in ('nocache', 'direct'))
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+def hash_file_sample(file_name, algorithms=('md5',), sample_size=SAMPLE_SIZE):
+    '''Hashes only the first and last sample_size bytes of a file (the whole file when it is not bigger than both).
+
+    For files no larger than 2 * sample_size the result is identical to hash_file so it can stand in for the full hash.
+    '''
+    hashers = list(_create_hashers(algorithms).items())
+    with open(file_name, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= 2 * sample_size:
+            chunks = [f.read()]
+        else:
+            chunks = [f.read(sample_size)]
+            f.seek(size - sample_size)
+            chunks.append(f.read(sample_size))
+    for chunk in chunks:
+        for _, hasher in hashers:
+            hasher.update(chunk)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers}
+
+def hash_files(file_names, algorithms=ALGORITHMS, workers=DEFAULT_WORKERS, on_error=None, hasher=hash_file,
+               read_mode=None):
+    '''Hashes files over a thread pool, yielding (file name, digests) tuples in the order the files were given.
+
+    Only a bounded number of files are in flight at once so arbitrarily long file lists (or generators) can be passed
+    in.  If on_error is given it is called with (file name, exception) for files which can not be read and those files
+    are skipped, otherwise the error is raised.  hasher is called as hasher(file name, algorithms) for every file and
+    can be replaced by anything with the same signature as hash_file (i.e. hash_cache.HashCache.hash_file).  A read_mode
+    other than None is passed along to the hasher as a keyword.
+    '''
+    algorithms = tuple(algorithms)
+    if read_mode is not None:
+        hasher = functools.partial(hasher, read_mode=read_mode)
+    _create_hashers(algorithms)
+    workers = max(1, workers)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def drain_one():
+            file_name, future = pending.popleft()
+            try:
+                return file_name, future.result()
+            except OSError as err:
+                if on_error is None:
+                    raise
+                on_error(file_name, err)
+                return file_name, None
+
+        for file_name in file_names:
+            pending.append((file_name, executor.submit(hasher, file_name, algorithms)))
+            if len(pending) >= workers * 4:
+                file_name, digests = drain_one()
+                if digests is not None:
+                    yield file_name, digests
+        while pending:
+            file_name, digests = drain_one()
+            if digests is not None:
+                yield file_name, digests
+
+def drop_cached_pages(file_name):
+    '''Asks the kernel to forget a file's clean pages so the next read of it comes from disk.'''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(file_name, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def measure_read_modes(file_names, algorithms=('md5',), workers=1, read_modes=READ_MODES):
+    '''Hashes the files once per read mode and returns a list of (read mode, bytes, seconds, MB/s).
+
+    The page cache for the files is dropped before each mode (where posix_fadvise exists) so every mode reads cold.
+    '''
+    file_names = list(file_names)
+    total = sum(os.path.getsize(file_name) for file_name in file_names)
+    results = []
+    for read_mode in read_modes:
+        for file_name in file_names:
+            drop_cached_pages(file_name)
+        start = time.perf_counter()
+        for _ in hash_files(file_names, algorithms, workers, read_mode=read_mode):
+            pass
+        elapsed = time.perf_counter() - start
+        results.append((read_mode, total, elapsed, total / 1048576.0 / elapsed if elapsed else 0.0))
+    return results
+
 def _md5sum_shell(file_name):
     '''Calls the md5sum shell binary to calculate the hash of a file.'''
     command = 'md5sum {0}'.format(custom_utils.prepare_filename_for_shell(file_name))
-    process = subprocess.Popen(command, shell=True, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    process = subprocess.Popen(command, shell=True, bufsize=1, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     stdoutdata, stderrdata = process.communicate()
     if process.wait() != 0:
         raise Exception('md5sum returned an error processing file {0}'.format(file_name))
@@ -70,26 +289,13 @@ def md5sum_shell(file_name):
 def _sumstr(s):
     '''Returns a md5 hash for a string.'''
     m = hashlib.md5()
-    m.update(str)
+    m.update(s.encode() if isinstance(s, str) else s)
     return m.hexdigest()
     
-def _sumfile(fobj, size):
-    '''Returns a md5 hash for an object with read() method.'''
-    m = hashlib.md5()
-    while True:
-        d = fobj.read(size)
-        if not d:
-            break
-        m.update(d)
-    return m.hexdigest()
-
 def md5sum(fname_or_str):
     '''Returns a md5 hash for a file or a string.'''
     if os.path.isfile(fname_or_str):
-        fname = fname_or_str
-        size = min(os.stat(fname)[stat.ST_SIZE], 16 * 1048576)
-        with open(fname, 'rb') as f:
-            return _sumfile(f, size)
+        return hash_file(fname_or_str, ('md5',))['md5']
     else:
         s = fname_or_str
         return _sumstr(s)
@@ -97,7 +303,7 @@ def md5sum(fname_or_str):
 def _crc32_shell(file_name):
     '''Calls the crc32 shell binary to calculate the crc of a file.'''
     command = 'crc32 {0}'.format(custom_utils.prepare_filename_for_shell(file_name))
-    process = subprocess.Popen(command, shell=True, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    process = subprocess.Popen(command, shell=True, bufsize=1, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     stdoutdata, stderrdata = process.communicate()
     if process.wait() != 0:
         raise Exception('crc32 failed processing file {0}'.format(file_name))
@@ -106,7 +312,7 @@ def _crc32_shell(file_name):
 def _crc_shell(file_name):
     '''Calls the Windows crc shell binary to calculate the crc of a file.'''
     command = 'crc {0}'.format(custom_utils.prepare_filename_for_shell(file_name))
-    process = subprocess.Popen(command, shell=True, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    process = subprocess.Popen(command, shell=True, bufsize=1, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     stdoutdata, stderrdata = process.communicate()
     if process.wait() != 0:
         raise Exception('crc failed processing file {0}'.format(file_name))
@@ -124,26 +330,13 @@ def crc32_shell(file_name):
 
 def _crcstr(s):
     '''Returns a crc hash for a string.'''
-    ret = zlib.crc32(data)
+    ret = zlib.crc32(s.encode() if isinstance(s, str) else s)
     return '%08x' % (ret & 0xFFFFFFFF)
 
-def _crcfile(fobj, size):
-    '''Returns a crc hash for a file.'''
-    ret = None
-    while True:
-        data = fobj.read(size)
-        if not data:
-            break
-        ret = zlib.crc32(data) if not ret else zlib.crc32(data, ret) 
-    return '%08x' % ((0 if not ret else ret) & 0xFFFFFFFF)
-
 def crc32(fname_or_str):
     '''Returns a crc hash for a file or a string.'''
     if os.path.isfile(fname_or_str):
-        fname = fname_or_str
-        size = min(os.stat(fname)[stat.ST_SIZE], 16 * 1048576)
-        with open(fname, 'rb') as f:
-            return _crcfile(f, size)
+        return hash_file(fname_or_str, ('crc32',))['crc32']
     else:
         s = fname_or_str
         return _crcstr(s)
@@ -155,13 +348,20 @@ def _parse_args():
     parser.add_argument('-cs', '--crc32-shell', dest='crc32_shell', default=False, action='store_true', help='hash input using shell crc32 program')
     parser.add_argument('-m', '--md5sum', dest='md5sum', default=False, action='store_true', help='hash input using python hashlib md5')
     parser.add_argument('-ms', '--md5sum-shell', dest='md5sum_shell', default=False, action='store_true', help='hash input using shell md5sum program')
+    parser.add_argument('-a', '--algorithm', dest='algorithms', default=[], action='append', choices=ALGORITHMS, help='hash input in-process with this algorithm (may be repeated, all are computed in one read)')
+    parser.add_argument('-w', '--workers', dest='workers', default=DEFAULT_WORKERS, type=int, help='number of threads used to hash files in-process')
+    parser.add_argument('-r', '--read-mode', dest='read_mode', default=DEFAULT_READ_MODE, choices=READ_MODES, help='how files are read when hashing in-process')
+    parser.add_argument('-b', '--benchmark', dest='benchmark', default=False, action='store_true', help='hash the input with every read mode and report MB/s for each')
     parser.add_argument('input', nargs='+', metavar='<input>', help='input to use for creating hash')
     args = parser.parse_args()
 
     md5sum = args.md5sum
-    if not args.crc32 and not args.crc32_shell and not args.md5sum and not args.md5sum_shell:
+    if not args.crc32 and not args.crc32_shell and not args.md5sum and not args.md5sum_shell and not args.algorithms:
         md5sum = True
 
+    algorithms = [algorithm for algorithm in ALGORITHMS if algorithm in args.algorithms or
+                  (algorithm == 'md5' and md5sum) or (algorithm == 'crc32' and args.crc32)]
+
     input_files = []
     input_names = args.input
     for name in input_names:
@@ -169,23 +369,28 @@ def _parse_args():
             input_files += custom_utils.get_files_in_directory(name)
         elif os.path.isfile(name):
             input_files.append(name)
-    input_files.sort(key=string.lower)
+    input_files.sort(key=str.lower)
 
     if len(input_files) == 0:
         raise argparse.ArgumentError('input', 'must specify either one or more files/directories to hash')
 
-    return input_files, md5sum, args.md5sum_shell, args.crc32, args.crc32_shell
+    return input_files, algorithms, args.workers, args.read_mode, args.benchmark, args.md5sum_shell, args.crc32_shell
 
 def main():
-    input_files, calc_md5sum, calc_md5sum_shell, calc_crc32, calc_crc32_shell = _parse_args()
+    input_files, algorithms, workers, read_mode, benchmark, calc_md5sum_shell, calc_crc32_shell = _parse_args()
     try:
+        if benchmark:
+            for mode, total, elapsed, rate in measure_read_modes(input_files, algorithms, workers):
+                print('%-8s %14d bytes %8.2f sec %10.1f MB/s' % (mode, total, elapsed, rate))
+            return 0
+        if algorithms:
+            for input_file, digests in hash_files(input_files, algorithms, workers, read_mode=read_mode):
+                for algorithm in algorithms:
+                    prefix = '%s ' % algorithm if len(algorithms) > 1 else ''
+                    print(('%s%s %s' % (prefix, digests[algorithm], os.path.abspath(input_file))))
         for input_file in input_files:
-            if calc_md5sum:
-                print(('%s %s' % (md5sum(input_file), os.path.abspath(input_file))))
             if calc_md5sum_shell:
                 print(('%s %s' % (md5sum_shell(input_file), os.path.abspath(input_file))))
-            if calc_crc32:
-                print(('%s %s' % (crc32(input_file), os.path.abspath(input_file))))
             if calc_crc32_shell:
                 print(('%s %s' % (crc32_shell(input_file), os.path.abspath(input_file))))
         return 0
@@ -195,9 +400,5 @@ def main():
         return 1
 
 if __name__ == '__main__':
-    hasher = CreateHasher(_HASH_FUNCTIONS[0])
-    os.system('md5 .bazaar/ignore')
-    hasher.update('asdfasdfasdf')
-    os.system('internal hasher: {0}'.format(hasher.hexdigest))
     sys.exit(main())
 
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# vim:softtabstop=4:ts=4:sw=4:expandtab:tw=120
+import argparse
+import atexit
+from collections import namedtuple
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from urllib.parse import urlparse
+
+DEFAULT_DB_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'http_cache', 'responses.db')
+
+# ttl: seconds a response is used as is, stale: seconds after that it is still used while it is refetched in the
+# background, negative: seconds a failed call is remembered so a dead endpoint is not called on every shell open
+CachePolicy = namedtuple('CachePolicy', ['ttl', 'stale', 'negative'])
+
+DEFAULT_POLICY = CachePolicy(300, 3600, 60)
+
+# keyed by host name
+ENDPOINT_POLICIES = {
+    'ipinfo.io': CachePolicy(3600, 86400, 300),
+    'wttr.in': CachePolicy(900, 3600, 300),
+}
+
+# the public ip services answer with the same address for hours
+PUBLIC_IP_POLICY = CachePolicy(1800, 86400, 600)
+
+# how long a short lived process (login_info) waits at exit for the refetches of the stale responses it used, so they
+# are actually stored rather than killed with the process and every expiry turning into a blocking miss
+REVALIDATION_EXIT_TIMEOUT = 1.0
+
+_CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    body TEXT,
+    fetched REAL NOT NULL)'''
+
+_enabled = True
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_policy(uri):
+    return ENDPOINT_POLICIES.get(urlparse(uri).hostname or '', DEFAULT_POLICY)
+
+class _Call(object):
+    '''One in flight fetch which every caller asking for the same uri waits on.'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+
+class HttpCache(object):
+    '''Response bodies stored in sqlite keyed by a hash of the uri (so api keys in query strings are not stored).
+
+    A failed call is stored with no body and counts as a negative entry.  Identical calls made at the same time from
+    several threads are coalesced into one request.  The object is safe to share between threads and the database
+    between processes.  A stale response is refetched on a background thread, wait_for_revalidations() lets a process
+    finish those before it exits (the process wide cache does so at exit).
+    '''
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        if db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._revalidations = set()
+        self._connection = sqlite3.connect(db_path, timeout=1.0, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(_CREATE_TABLE)
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __str__(self):
+        return 'http cache {0}: {1} hits, {2} stale hits, {3} negative hits, {4} misses'.format(
+            self.db_path, self.hits, self.stale_hits, self.negative_hits, self.misses)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @staticmethod
+    def _key(uri):
+        return hashlib.sha1(uri.encode('utf-8')).hexdigest()
+
+    def _open_connection(self):
+        '''The connection for a call made while holding the lock, a closed cache is a bug in the caller.'''
+        if self._connection is None:
+            raise RuntimeError('the http cache {0} is closed'.format(self.db_path))
+        return self._connection
+
+    def _lookup(self, uri):
+        with self._lock:
+            return self._open_connection().execute('SELECT body, fetched FROM responses WHERE key = ?', (self._key(uri),)).fetchone()
+
+    def _store(self, uri, body, policy):
+        with self._lock:
+            if self._connection is None:
+                return
+            if body is None:
+                # a failed revalidation keeps the good body for the rest of its stale window
+                row = self._connection.execute('SELECT body, fetched FROM responses WHERE key = ?', (self._key(uri),)).fetchone()
+                if row is not None and row[0] is not None and time.time() - row[1] < policy.ttl + policy.stale:
+                    return
+            self._connection.execute('INSERT OR REPLACE INTO responses (key, host, body, fetched) VALUES (?, ?, ?, ?)',
+                                     (self._key(uri), urlparse(uri).hostname or '', body, time.time()))
+            self._connection.commit()
+
+    def _fetch(self, uri, fetch, policy):
+        '''Calls fetch() unless a call for uri is already in flight, in which case its result is waited for.'''
+        with self._lock:
+            call = self._in_flight.get(uri)
+            owner = call is None
+            if owner:
+                call = self._in_flight[uri] = _Call()
+        if not owner:
+            call.done.wait()
+            return call.body
+        try:
+            call.body = fetch()
+            self._store(uri, call.body, policy)
+        finally:
+            with self._lock:
+                del self._in_flight[uri]
+            call.done.set()
+        return call.body
+
+    def get(self, uri, fetch, policy=None):
+        '''Returns the body for uri, calling fetch() (which returns the body or None on failure) only when needed.'''
+        policy = policy if policy is not None else get_policy(uri)
+        row = self._lookup(uri)
+        if row is not None:
+            body, fetched = row
+            age = time.time() - fetched
+            if body is None and age < policy.negative:
+                with self._lock:
+                    self.negative_hits += 1
+                return None
+            if body is not None and age < policy.ttl:
+                with self._lock:
+                    self.hits += 1
+                return body
+            if body is not None and age < policy.ttl + policy.stale:
+                thread = threading.Thread(target=self._revalidate, args=(uri, fetch, policy), daemon=True)
+                with self._lock:
+                    self.stale_hits += 1
+                    self._revalidations.add(thread)
+                thread.start()
+                return body
+        with self._lock:
+            self.misses += 1
+        return self._fetch(uri, fetch, policy)
+
+    def _revalidate(self, uri, fetch, policy):
+        try:
+            self._fetch(uri, fetch, policy)
+        finally:
+            with self._lock:
+                self._revalidations.discard(threading.current_thread())
+
+    def wait_for_revalidations(self, timeout=REVALIDATION_EXIT_TIMEOUT):
+        '''Waits up to timeout seconds in all for the background refetches of stale responses, returns how many are
+        still running.'''
+        end = time.monotonic() + timeout
+        with self._lock:
+            threads = list(self._revalidations)
+        for thread in threads:
+            thread.join(max(0.0, end - time.monotonic()))
+        return sum(1 for thread in threads if thread.is_alive())
+
+    def clear(self, max_age=None):
+        '''Removes every response (or only those fetched more than max_age seconds ago), returns how many.'''
+        with self._lock:
+            connection = self._open_connection()
+            if max_age is None:
+                removed = connection.execute('DELETE FROM responses').rowcount
+            else:
+                removed = connection.execute('DELETE FROM responses WHERE fetched < ?', (time.time() - max_age,)).rowcount
+            connection.commit()
+        return removed
+
+    def entries(self):
+        '''Returns (host, ok, age in seconds) for every stored response.'''
+        now = time.time()
+        with self._lock:
+            rows = self._open_connection().execute('SELECT host, body IS NOT NULL, fetched FROM responses ORDER BY host').fetchall()
+        return [(host, bool(ok), now - fetched) for host, ok, fetched in rows]
+
+def set_enabled(enabled):
+    global _enabled
+    _enabled = enabled
+
+def get_default_cache():
+    '''Returns the process wide cache, None when caching is disabled or the database can not be opened.'''
+    global _default_cache, _enabled
+    if not _enabled:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            try:
+                _default_cache = HttpCache()
+                atexit.register(_default_cache.wait_for_revalidations)
+            except (sqlite3.Error, OSError) as err:
+                print('ERROR: unable to open the http cache: {0}'.format(err), file=sys.stderr)
+                _enabled = False
+        return _default_cache
+
+def cached_get(uri, fetch, policy=None):
+    '''Same as HttpCache.get on the process wide cache, or just fetch() when caching is disabled.'''
+    cache = get_default_cache()
+    return cache.get(uri, fetch, policy) if cache is not None else fetch()
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Shows or clears the http response cache shared by the location and weather scripts')
+    parser.add_argument('-d', '--database', default=DEFAULT_DB_PATH, metavar='<DB PATH>', help='http cache database')
+    parser.add_argument('-c', '--clear', action='store_true', help='remove the cached responses')
+    parser.add_argument('-a', '--max-age', type=float, default=None, metavar='<SECONDS>', help='when clearing only remove responses older than this')
+    args = parser.parse_args()
+    return args.database, args.clear, args.max_age
+
+def main():
+    db_path, clear, max_age = _parse_args()
+    try:
+        with HttpCache(db_path) as cache:
+            if clear:
+                print('removed {0} responses'.format(cache.clear(max_age)))
+            for host, ok, age in cache.entries():
+                print('{0:<30} {1:<8} {2:>10.0f} sec old'.format(host, 'ok' if ok else 'failed', age))
+        return 0
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
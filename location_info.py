@@ -8,13 +8,18 @@ import json
 import os
 import requests
 import sys
+import threading
+import time
 import traceback
 
+import http_cache
+
 _VERBOSE = False
+_RACE = True
 
 _EXTERNAL_IPV4_URLS = ['http://v4.showip.spamt.net/',
                        'http://ipecho.net/plain',
-                       'http://ident.me/v4'
+                       'http://ident.me/v4',
                        'http://ipv4.icanhazip.com',
                        'http://checkip.amazonaws.com',
                        'http://ifconfigme.com',]
@@ -26,6 +31,14 @@ _EXTERNAL_IPV6_URLS = ['http://smart-ip.net/myip',
 
 _LOCATION_INFO_URI = 'https://ipinfo.io/json'
 
+_ENDPOINT_STATS_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'location_info', 'endpoint_stats.json')
+
+# seconds between starting one endpoint of the race and the next, the whole race gives up after _RACE_TIMEOUT
+_RACE_STAGGER = 0.05
+_RACE_TIMEOUT = 1.0
+# weight of the newest sample in the moving average of each endpoint's latency
+_LATENCY_WEIGHT = 0.3
+
 _IP_ADDRESS_V4 = 1
 _IP_ADDRESS_V6 = 2
 _IP_ADDRESS_EITHER = 4
@@ -39,11 +52,18 @@ def _is_verbose_mode_on():
 def _parse_args():
     parser = argparse.ArgumentParser(description='Query various location information about where this script is running')
     parser.add_argument('-v', '--verbose', action="store_true", help='increase output verbosity')
-    parser.add_argument('-i', '--info', nargs='+', action='append', required=True, choices=['ip', 'location', 'zip-code', 'gps'],
+    parser.add_argument('-n', '--no-cache', action="store_true", help='always call the web services instead of using the http cache')
+    parser.add_argument('-s', '--sequential', action="store_true", help='ask the public ip services one at a time instead of racing them')
+    parser.add_argument('-S', '--endpoint-stats', action="store_true", help='show the latency and success rate of the public ip services')
+    parser.add_argument('-i', '--info', nargs='+', action='append', required=False, default=[], choices=['ip', 'location', 'zip-code', 'gps'],
                         help='Specify which information should to be queried.')
     args = parser.parse_args()
-    global _VERBOSE
+    global _VERBOSE, _RACE
     _VERBOSE = args.verbose
+    _RACE = not args.sequential
+    if not args.info and not args.endpoint_stats:
+        parser.error('the following arguments are required: -i/--info')
+    http_cache.set_enabled(not args.no_cache)
 
     requested_info = list(itertools.chain(*args.info))
     ip_address = 'ip' in requested_info
@@ -58,9 +78,9 @@ def _parse_args():
                    f'  location: {location}\n' \
                    f'  zip code: {zip_code}\n' \
                    f'  gps: {gps}')
-    return ip_address, location, zip_code, gps
+    return ip_address, location, zip_code, gps, args.endpoint_stats
 
-def _make_http_call(uri, printable_uri=None):
+def _http_get(uri, printable_uri=None):
     try:
         response = requests.get(uri, timeout=0.5)
         response.raise_for_status()
@@ -72,6 +92,9 @@ def _make_http_call(uri, printable_uri=None):
         _verbose_print(f'ERROR: {e}')
     return None
 
+def _make_http_call(uri, printable_uri=None, policy=None):
+    return http_cache.cached_get(uri, lambda: _http_get(uri, printable_uri), policy)
+
 def _get_location_info_url(hide_key=True):
     if 'IPINFO_API_KEY' in os.environ:
         api_key = '*' * len(os.environ['IPINFO_API_KEY']) if hide_key else os.environ['IPINFO_API_KEY']
@@ -86,28 +109,142 @@ def _request_location_info():
     return None if not response else json.loads(response)
 
 
-def get_public_ip_address(version=_IP_ADDRESS_V4):
+def _get_ip_urls(version):
     if version == _IP_ADDRESS_V4:
-        addresses = _EXTERNAL_IPV4_URLS[:]
+        return _EXTERNAL_IPV4_URLS[:]
     elif version == _IP_ADDRESS_V6:
-        addresses = _EXTERNAL_IPV6_URLS[:]
-    elif version == _IP_ADDRESS_EITHER:
-        addresses = _EXTERNAL_IPV4_URLS[:] + _EXTERNAL_IPV6_URLS[:]
-
-    for url in addresses:
-        response = _make_http_call(url)
-        if not response:
-            _verbose_print('ERROR: error querying ip address while calling {}'.format(url))
-            continue
+        return _EXTERNAL_IPV6_URLS[:]
+    return _EXTERNAL_IPV4_URLS[:] + _EXTERNAL_IPV6_URLS[:]
+
+def _parse_ip_response(url, response, version):
+    '''Returns the address in response when it is an address of the requested version, otherwise None.'''
+    if not response:
+        _verbose_print('ERROR: error querying ip address while calling {}'.format(url))
+        return None
+    try:
         ip = ipaddress.ip_address(response)
-        if version == _IP_ADDRESS_V4 and ip.version == 6:
-            _verbose_print('ERROR: ip ({}) returned from {} is an IPv6 when IPv4 was requested'.format(ip, url))
-            continue
-        elif version == _IP_ADDRESS_V6 and ip.version == 4:
-            _verbose_print('ERROR: ip ({}) returned from {} is an IPv4 when IPv6 was requested'.format(ip, url))
-            continue
-        else:
-            _verbose_print('INFO: successfully found {} version IPv{} from {}'.format(ip, ip.version, url))
+    except ValueError:
+        _verbose_print('ERROR: {} did not return an ip address'.format(url))
+        return None
+    if version == _IP_ADDRESS_V4 and ip.version == 6:
+        _verbose_print('ERROR: ip ({}) returned from {} is an IPv6 when IPv4 was requested'.format(ip, url))
+        return None
+    elif version == _IP_ADDRESS_V6 and ip.version == 4:
+        _verbose_print('ERROR: ip ({}) returned from {} is an IPv4 when IPv6 was requested'.format(ip, url))
+        return None
+    _verbose_print('INFO: successfully found {} version IPv{} from {}'.format(ip, ip.version, url))
+    return ip
+
+class EndpointStats:
+    '''Latency and success counts of the public ip services, kept in a json file between runs.
+
+    Endpoints are ranked by their expected time to a good answer, a failure costing a whole race timeout, so the slow
+    and unreliable ones drift to the back of the race on their own.  An endpoint still running when the race is won
+    counts as a failure.  Endpoints without history rank first so they get measured.
+    '''
+    def __init__(self, path=_ENDPOINT_STATS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as stats_file:
+                self._stats = json.load(stats_file)
+        except (OSError, ValueError):
+            self._stats = {}
+
+    def record(self, url, latency, success):
+        with self._lock:
+            stats = self._stats.setdefault(url, {'attempts': 0, 'successes': 0, 'latency': latency})
+            stats['attempts'] += 1
+            stats['successes'] += int(success)
+            stats['latency'] += _LATENCY_WEIGHT * (latency - stats['latency'])
+
+    def _expected_latency(self, url):
+        stats = self._stats.get(url)
+        if not stats or not stats['attempts']:
+            return 0.0
+        success_rate = stats['successes'] / stats['attempts']
+        return (stats['latency'] + (1.0 - success_rate) * _RACE_TIMEOUT) / max(success_rate, 0.05)
+
+    def rank(self, urls):
+        with self._lock:
+            return sorted(urls, key=self._expected_latency)
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._stats, indent=2, sort_keys=True)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = '{}.{}'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as stats_file:
+                stats_file.write(data)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            _verbose_print('ERROR: unable to save the endpoint stats to {}: {}'.format(self.path, e))
+
+    def __str__(self):
+        lines = []
+        with self._lock:
+            urls = sorted(self._stats, key=self._expected_latency)
+            for url in urls:
+                stats = self._stats[url]
+                lines.append('{:<40} {:>6} attempts {:>7.1%} success {:>8.1f} ms'.format(
+                    url, stats['attempts'], stats['successes'] / stats['attempts'] if stats['attempts'] else 0.0,
+                    stats['latency'] * 1000.0))
+        return '\n'.join(lines)
+
+def _race_public_ip_address(version, stats):
+    '''Asks every endpoint for the public ip at (nearly) the same time and returns the first valid answer.
+
+    The endpoints start _RACE_STAGGER seconds apart in rank order so the usual winner is asked first and the rest only
+    add load when it is slow.  Once an answer is in the endpoints which have not started yet never do and the ones
+    still running are left behind, they are recorded as having taken at least as long as the race.
+    '''
+    urls = stats.rank(_get_ip_urls(version))
+    condition = threading.Condition()
+    finished = {}
+    answer = []
+    start = time.perf_counter()
+
+    def racer(index, url):
+        delay = index * _RACE_STAGGER - (time.perf_counter() - start)
+        with condition:
+            if delay > 0:
+                condition.wait_for(lambda: answer, timeout=delay)
+            if answer:
+                return
+        request_start = time.perf_counter()
+        ip = _parse_ip_response(url, _http_get(url), version)
+        latency = time.perf_counter() - request_start
+        with condition:
+            finished[url] = (latency, ip is not None)
+            if ip is not None and not answer:
+                answer.append(ip)
+            condition.notify_all()
+
+    for index, url in enumerate(urls):
+        threading.Thread(target=racer, args=(index, url), name=f'ip-race-{index}', daemon=True).start()
+    with condition:
+        condition.wait_for(lambda: answer or len(finished) == len(urls), timeout=_RACE_TIMEOUT)
+        elapsed = time.perf_counter() - start
+        for index, url in enumerate(urls):
+            if url in finished:
+                stats.record(url, *finished[url])
+            elif index * _RACE_STAGGER < elapsed:
+                stats.record(url, elapsed - index * _RACE_STAGGER, False)
+        ip = answer[0] if answer else None
+    stats.save()
+    return ip
+
+def get_public_ip_address(version=_IP_ADDRESS_V4, race=True):
+    if race:
+        key = 'race://public-ip/v{}'.format({_IP_ADDRESS_V4: 4, _IP_ADDRESS_V6: 6}.get(version, 'any'))
+        response = http_cache.cached_get(key, lambda: str(_race_public_ip_address(version, EndpointStats()) or '') or None,
+                                         http_cache.PUBLIC_IP_POLICY)
+        return ipaddress.ip_address(response) if response else None
+
+    for url in _get_ip_urls(version):
+        ip = _parse_ip_response(url, _make_http_call(url, policy=http_cache.PUBLIC_IP_POLICY), version)
+        if ip:
             return ip
 
 def _parse_location_json(json_data, parse_ip=False, parse_location=False, parse_zip_code=False, parse_gps=False):
@@ -139,7 +276,7 @@ def _get_ip_address(json_data):
     parsed_data = _parse_location_json(json_data, parse_ip=True)
     public_ip = parsed_data['ip'] if 'ip' in parsed_data else None
     if not public_ip or public_ip.version == 6:
-        updated_ip = get_public_ip_address()
+        updated_ip = get_public_ip_address(race=_RACE)
         if updated_ip:
             public_ip = updated_ip
     _verbose_print('public ip: {}'.format(public_ip))
@@ -176,7 +313,7 @@ def get_gps_location():
     json_data = _request_location_info()
     if not json_data:
         return None
-    return _get_gps_location(_request_location_info())
+    return _get_gps_location(json_data)
 
 def get_information(want_ip_address, want_location, want_zip_code, want_gps):
     json_data = _request_location_info()
@@ -201,9 +338,11 @@ def get_information(want_ip_address, want_location, want_zip_code, want_gps):
             print(gps_location)
 
 def main():
-    want_ip_address, want_location, want_zip_code, want_gps = _parse_args()
+    want_ip_address, want_location, want_zip_code, want_gps, want_endpoint_stats = _parse_args()
     try:
         get_information(want_ip_address, want_location, want_zip_code, want_gps)
+        if want_endpoint_stats:
+            print(EndpointStats())
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
@@ -1,27 +1,69 @@
 #!/usr/bin/env python3
 # vim: awa:sts=4:ts=4:sw=4:et:cin:fdm=manual:tw=120:ft=python
 
+import builtins
+import sys
+import threading
+import time
+
+
+class ImportTimer:
+    '''Wraps __import__ to record how long every module took to import the first time, nested like -X importtime.'''
+    def __init__(self):
+        self.timings = []
+        self._original_import = builtins.__import__
+        self._local = threading.local()
+
+    def install(self):
+        builtins.__import__ = self
+
+    def uninstall(self):
+        builtins.__import__ = self._original_import
+
+    def __call__(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level != 0 or name in sys.modules:
+            return self._original_import(name, globals, locals, fromlist, level)
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            self._local.depth = depth
+            self.timings.append((depth, name, time.perf_counter() - start))
+
+
+# the hook has to be in place before anything else is imported for --profile-startup to see the imports, it is only
+# installed when this is the script being run, importing login_info (the server does) never wraps __import__
+_STARTUP_TIME = time.perf_counter()
+_IMPORT_TIMER = ImportTimer() if __name__ == '__main__' and '--profile-startup' in sys.argv else None
+if _IMPORT_TIMER is not None:
+    _IMPORT_TIMER.install()
+
+# only what every banner needs is imported here, psutil and the network modules (requests) are imported by the
+# probes which use them so a banner served from the cache never loads them
 from ansimarkup import AnsiMarkup, parse
 from app_settings import app_settings
 import argparse
+import contextlib
 import datetime
+import getpass
 import math
 import os
+import pathlib
 import platform
-import pprint
-import psutil
-from psutil._common import bytes2human
+import pwd
 import random
 import re
-import shlex
-import subprocess
-import sys
+import socket
+import sqlite3
+import struct
 import traceback
 
-import location_info
-import network_info
-from network_info import NetworkInfo, NetworkInfos, SystemInfo
-import weather_info
+import cache_motd_info
+import login_info_template
+
+_IMPORTS_DONE_TIME = time.perf_counter()
 
 
 user_tags = {
@@ -76,10 +118,17 @@ TIME_OF_DAY = {MORNING_LABEL: random.choice(MORNING_EMOJIS),
                EVENING_LABEL: random.choice(EVENING_EMOJIS),
                NIGHT_LABEL: random.choice(NIGHT_EMOJIS)}
 
-COLUMN_LH_WIDTH_1 = 15
-COLUMN_RH_WIDTH_1 = 20
-COLUMN_LH_WIDTH_2 = 25
-COLUMN_RH_WIDTH_2 = 14
+WTMP_PATH = '/var/log/wtmp'
+MAIL_SPOOL_DIRS = ['/var/mail', '/var/spool/mail']
+DEFAULT_FORTUNE_DB_PATH = '$HOME/.config/motd/fortune.db'
+FORTUNE_SUBJECT = 'softwareengineering'
+
+# glibc struct utmp: type, pid, line, id, user, host, exit status, session, seconds, microseconds, address, unused
+_UTMP_STRUCT = struct.Struct('<h2xi32s4s32s256shhiii16s20s')
+_UTMP_BOOT_TIME = 2
+_UTMP_USER_PROCESS = 7
+_UTMP_DEAD_PROCESS = 8
+_WTMP_BLOCK_RECORDS = 256
 
 
 def _get_time_of_day():
@@ -114,84 +163,6 @@ def _get_greeting(user_name):
         return f'{user_name} stop working already... it\'s the middle of the night! {emoji}'
 
 
-def _print_time_of_daygreeting(message):
-    am.ansiprint(f'<greeting>{message}</greeting>\n')
-
-
-def _print_system_info_time(sys_info):
-    am.ansiprint(f'  <sysinfo>{sys_info}</sysinfo>\n')
-
-
-def _print_columns(label1, value1, label2, value2):
-    label1 = label1 + ':' if len(label1) > 0 else label1
-    label2 = label2 + ':' if len(label2) > 0 else label2
-    col1_lh = am.ansistring(f'<label>{label1}</label>')
-    col1_rh = am.ansistring(f'<value>{value1}</value>')
-    col2_lh = am.ansistring(f'<label>{label2}</label>')
-    col2_rh = am.ansistring(f'<value>{value2}</value>')
-    lh_width1 = COLUMN_LH_WIDTH_1 + col1_lh.delta
-    rh_width1 = COLUMN_RH_WIDTH_1 + col1_rh.delta
-    lh_width2 = COLUMN_LH_WIDTH_2 + col2_lh.delta
-    rh_width2 = COLUMN_RH_WIDTH_2 + col2_rh.delta
-    print(f'  {col1_lh:{lh_width1}} {col1_rh:{rh_width1}}   {col2_lh:{lh_width2}} {col2_rh:{rh_width2}}')
-
-
-def _print_boot_time(boot_time):
-    lh = am.ansistring('<label>Boot Time:</label>')
-    rh = am.ansistring(f'<value>{boot_time}</value>')
-    lh_width = COLUMN_LH_WIDTH_1 + lh.delta
-    rh_width = COLUMN_RH_WIDTH_1 + rh.delta
-    print(f'  {lh:{lh_width}} {rh:{rh_width}}\n')
-
-
-def _print_last_login(values):
-    if len(values) == 0:
-        app_settings.error('last login message must be at least one line long')
-        return
-    rhs = []
-    rhs_widths = []
-    for value in values:
-        if value.startswith('Log in:'):
-            s = am.ansistring(f'<loginout>Log in:<loginout> <value>{value[len("Log in: "):]}</value>')
-        elif value.startswith('Log out:'):
-            s = am.ansistring(f'<loginout>Log out:<loginout> <value>{value[len("Log out: "):]}</value>')
-        else:
-            s = am.ansistring(f'<value>{value}</value>')
-        rhs_widths.append(COLUMN_RH_WIDTH_1 + s.delta)
-        rhs.append(s)
-    lh = am.ansistring('<label>Last Login:</label>')
-    lh_width = COLUMN_LH_WIDTH_1 + lh.delta
-    for index, (rh, rh_width) in enumerate(zip(rhs, rhs_widths)):
-        if index == 0:
-            print(f'  {lh:{lh_width}} {rh:{rh_width}}')
-        else:
-            print(f'                  {rh:{rh_width}}')
-
-
-def _print_weather(location, weather):
-    location = location + ':' if len(location) > 0 else location
-    lh = am.ansistring(f'<location>{location}</location>')
-    rh = am.ansistring(f'<weather>{weather}</weather>')
-    lh_width = COLUMN_LH_WIDTH_1 + lh.delta
-    rh_width = COLUMN_RH_WIDTH_1 + rh.delta
-    print(f'  {lh:{lh_width}} {rh:{rh_width}}')
-
-
-def _print_quote(quote):
-    if quote and len(quote) > 0:
-        am.ansiprint(f'\n<quote>{quote}</quote>')
-
-
-def _print_packages_available(message):
-    if message:
-        am.ansiprint(f'\n<apt>{message}</apt>')
-
-
-def _print_reboot_required(message):
-    if message:
-        am.ansiprint(f'\n<reboot>{message}</reboot>')
-
-
 def _get_timezone_info():
     return datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
 
@@ -218,6 +189,7 @@ def _convert_date_time(dt):
 
 
 def _run_external_shell_command(cmd):
+    import subprocess
     try:
         completed_process = subprocess.run(cmd, shell=True, check=True, encoding='utf-8', capture_output=True)
         return completed_process.stdout
@@ -230,6 +202,8 @@ def _run_external_shell_command(cmd):
 
 
 def _run_external_command(cmd, show_error=True):
+    import shlex
+    import subprocess
     args = shlex.split(cmd)
     try:
         completed_process = subprocess.run(args, check=True, encoding='utf-8', capture_output=True)
@@ -343,10 +317,20 @@ def _get_macosx_user_first_name():
     return _run_external_shell_command('dscacheutil -q user -a name $USER | grep \'gecos:\' | awk \'{ print $2 }\'').strip()
 
 
-def _get_user_first_name():
+def _get_user_first_name_command():
     return _get_macosx_user_first_name() if sys.platform == 'darwin' else _get_linux_user_first_name()
 
 
+def _get_user_first_name():
+    try:
+        gecos = pwd.getpwnam(getpass.getuser()).pw_gecos
+    except KeyError:
+        return _get_user_first_name_command()
+    # the full name is the first comma separated field of the gecos, the first name the first word of that
+    names = gecos.split(',')[0].split()
+    return names[0] if names else ''
+
+
 def _get_time_of_day_greeting():
     os_name = _get_os_name()
     user_name = _get_user_first_name()
@@ -356,15 +340,19 @@ def _get_time_of_day_greeting():
 
 
 def _get_load_average():
+    import psutil
     load_average = psutil.getloadavg()[0]
     return f'{load_average / 100.0:.2%}'
 
 
 def _get_process_count():
+    import psutil
     return str(len(psutil.pids()))
 
 
 def _get_root_partition_usage():
+    import psutil
+    from psutil._common import bytes2human
     partitions = [partition for partition in psutil.disk_partitions() if partition.mountpoint == '/']
     assert len(partitions) == 1, app_settings.assertion(f'found {len(partitions)} partitions with the "/" mount point')
     partition = partitions[0]
@@ -375,15 +363,18 @@ def _get_root_partition_usage():
 
 
 def _get_user_count():
+    import psutil
     return str(len(psutil.users()))
 
 
 def _get_virtual_memory_usage():
+    import psutil
     virtual_memory = psutil.virtual_memory()
     return f'{virtual_memory.percent / 100:.0%}'
 
 
 def _get_swap_memory_usage():
+    import psutil
     swap_memory = psutil.swap_memory()
     return f'{swap_memory.percent / 100:.0%}'
 
@@ -397,6 +388,7 @@ def _is_reboot_required():
 
 
 def _get_boot_time():
+    import psutil
     boot_timestamp = psutil.boot_time()
     boot_time = datetime.datetime.fromtimestamp(boot_timestamp, _get_timezone_info())
     return f'{boot_time:%a, %d-%b-%Y %I:%M:%S%p %Z}'.replace('AM', 'am').replace('PM', 'pm')
@@ -416,7 +408,7 @@ def _get_macosx_available_mail():
     return 1
 
 
-def _get_linux_available_mail():
+def _get_linux_available_mail_command():
     cmd = f'pam_tally --file /var/mail/{os.getlogin()} --user {os.getlogin()}'
     output = _run_external_command(cmd, False)
     if not output:
@@ -427,20 +419,94 @@ def _get_linux_available_mail():
         return 0
 
 
+def _get_linux_available_mail():
+    '''Returns 1 when the mail spool was written after it was last read, the same test the shells use, else 0.
+
+    The spool is only stat'ed, reading it would update its access time and mark the mail as seen.
+    '''
+    user = getpass.getuser()
+    for spool_dir in MAIL_SPOOL_DIRS:
+        try:
+            spool = os.stat(os.path.join(spool_dir, user))
+        except OSError:
+            continue
+        return 1 if spool.st_size > 0 and spool.st_mtime > spool.st_atime else 0
+    return 0
+
+
 def _get_unopened_mail():
-    mail_items = _get_macosx_available_mail() if sys.platform == 'darwin' else _get_linux_available_mail()
-    if mail_items > 0:
-        return am.ansistring(f'<mail>{mail_items}</mail> Unread Mail Items')
-    else:
-        return f'{mail_items} Unread Mail Items'
+    return _get_macosx_available_mail() if sys.platform == 'darwin' else _get_linux_available_mail()
 
 
-def _get_quote():
-    quote = _run_external_command('fortune softwareengineering', False)
+def _get_quote_command():
+    quote = _run_external_command(f'fortune {FORTUNE_SUBJECT}', False)
     return quote if quote and len(quote) > 1 else ''
 
 
+def _get_fortune_db_path():
+    return os.path.expanduser(os.path.expandvars(os.environ.get('FORTUNE_DB', DEFAULT_FORTUNE_DB_PATH)))
+
+
+def _get_quote():
+    '''Picks a random quote from the database create_fortune_db.py builds, running fortune when there is none.'''
+    db_path = _get_fortune_db_path()
+    if not os.path.isfile(db_path):
+        return _get_quote_command()
+    uri = pathlib.Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+    with contextlib.closing(sqlite3.connect(uri, uri=True)) as connection:
+        query = 'FROM fortunes JOIN subject ON fortunes.subject_id = subject.id WHERE subject.name = ?'
+        count = connection.execute(f'SELECT COUNT(*) {query}', (FORTUNE_SUBJECT,)).fetchone()[0]
+        if count == 0:
+            return ''
+        row = connection.execute(f'SELECT quote, author {query} LIMIT 1 OFFSET ?',
+                                 (FORTUNE_SUBJECT, random.randrange(count))).fetchone()
+    quote, author = row
+    for index, author_part in enumerate(author.splitlines() if author else []):
+        quote += f'\n        ― {author_part}' if index == 0 else f'\n           {author_part}'
+    return quote
+
+
+def _read_wtmp_records(path):
+    '''Yields the (type, line, user, host, time) of each wtmp record, newest first, reading the file in blocks.'''
+    record_size = _UTMP_STRUCT.size
+    with open(path, 'rb') as wtmp:
+        end = wtmp.seek(0, os.SEEK_END) // record_size * record_size
+        while end > 0:
+            start = max(0, end - record_size * _WTMP_BLOCK_RECORDS)
+            wtmp.seek(start)
+            block = wtmp.read(end - start)
+            for offset in range(len(block) - record_size, -1, -record_size):
+                fields = _UTMP_STRUCT.unpack_from(block, offset)
+                decode = lambda value: value.split(b'\0', 1)[0].decode('utf-8', 'replace')
+                yield fields[0], decode(fields[2]), decode(fields[4]), decode(fields[5]), fields[9] + fields[10] / 1000000.0
+            end = start
+
+
 def _get_last_login():
+    '''Same as `last -1` read straight from wtmp, falls back to running last where there is no wtmp (macOS).'''
+    if not os.path.isfile(WTMP_PATH):
+        return _get_last_login_command()
+    tz = _get_timezone_info()
+    # walking backwards the last logout/reboot seen on a line is the first one after a login on that line
+    logouts = {}
+    reboot = None
+    for record_type, line, user, host, timestamp in _read_wtmp_records(WTMP_PATH):
+        if record_type == _UTMP_DEAD_PROCESS:
+            logouts[line] = timestamp
+        elif record_type == _UTMP_BOOT_TIME:
+            reboot = timestamp
+        elif record_type == _UTMP_USER_PROCESS and user:
+            login_time = datetime.datetime.fromtimestamp(timestamp, tz)
+            logout = logouts.get(line, reboot)
+            logout_time_str = _convert_date_time(datetime.datetime.fromtimestamp(logout, tz)) if logout else 'still logged in'
+            last_login = [f'{user} logged into {line} from {host}' if host else f'{user} logged into {line}']
+            last_login.append(f'Log in: {_convert_date_time(login_time)}')
+            last_login.append(f'Log out: {logout_time_str}')
+            return last_login
+    return []
+
+
+def _get_last_login_command():
     output = _run_external_command('last -1')
     assert output, app_settings.assertion('system command "last" did not return anything')
     for line in output.splitlines():
@@ -480,8 +546,10 @@ def _get_last_login():
     return []
 
 
-def _get_weather_info():
-    location = location_info.get_location()
+def _get_weather_info(location=None):
+    import location_info
+    import weather_info
+    location = location if location else location_info.get_location()
     weather = weather_info.get_one_line_weather(location)
     if weather:
         index = weather.find(':')
@@ -497,40 +565,260 @@ def _get_weather_info():
         return 'Lehi Utah US', 'Unavailable'
 
 
-def output_login_info():
-    _print_time_of_daygreeting(_get_time_of_day_greeting())
-    _print_system_info_time(_get_system_information_time())
-
-    location, weather = _get_weather_info()
-    _print_weather(location, weather)
-    _print_last_login(_get_last_login())
-    _print_boot_time(_get_boot_time())
-
-    system_info = SystemInfo()
-    _print_columns('Computer Name', system_info.computer_name, 'Hostname', system_info.hostname)
-    _print_columns('Public IP', system_info.public_ip, 'Mail', _get_unopened_mail())
-    _print_columns('System Load', _get_load_average(), 'Processes', _get_process_count())
-    _print_columns('Usage of /', _get_root_partition_usage(), 'Users Logged In', _get_user_count())
-
-    if len(system_info.network_infos) == 0:
-        _print_columns('Memory Usage', _get_virtual_memory_usage(), '', '')
-        _print_columns('Swap Usage', _get_swap_memory_usage(), '', '')
-    for i, network_info in enumerate(system_info.network_infos):
-        if i == 0:
-            _print_columns('Memory Usage', _get_virtual_memory_usage(), f'{network_info.name} IP', network_info.ip)
-            _print_columns('Swap Usage', _get_swap_memory_usage(), f'{network_info.name} MAC', network_info.mac)
-        else:
-            _print_columns('', '', f'{network_info.name} IP', network_info.ip)
-            _print_columns('', '', f'{network_info.name} MAC', network_info.mac)
-
-    _print_packages_available(_get_packages_available())
-    _print_quote(_get_quote())
-    _print_reboot_required(_is_reboot_required())
+PENDING = 'pending'
+UNAVAILABLE = 'Unavailable'
+# the whole banner should be on screen within this many seconds no matter how slow the network is
+DEFAULT_DEADLINE = 0.15
+
+
+class ProbeCollector:
+    '''Runs every probe on its own daemon thread so the slow ones (network, subprocesses) overlap.
+
+    wait() returns whatever has finished by the deadline, probes still running are simply abandoned (they are daemon
+    threads so they never hold up the exit of the process).
+    '''
+    def __init__(self, probes):
+        self._condition = threading.Condition()
+        self._results = {}
+        self._errors = {}
+        self.timings = {}
+        self._count = len(probes)
+        self._start = time.perf_counter()
+        for name, probe in probes.items():
+            threading.Thread(target=self._run, args=(name, probe), name=f'probe-{name}', daemon=True).start()
+
+    def _run(self, name, probe):
+        start = time.perf_counter()
+        try:
+            value, error = probe(), None
+        except Exception as err:
+            value, error = UNAVAILABLE, err
+        with self._condition:
+            self._results[name] = value
+            if error is not None:
+                self._errors[name] = error
+            self.timings[name] = time.perf_counter() - start
+            self._condition.notify_all()
+
+    def wait(self, deadline):
+        '''Blocks until every probe is done or deadline seconds after the probes started, whichever is first.'''
+        with self._condition:
+            while len(self._results) < self._count:
+                remaining = self._start + deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return dict(self._results), dict(self._errors)
+
+    def is_running(self, name):
+        '''True while the probe name started by this collector has not finished, abandoned or not.'''
+        with self._condition:
+            return name not in self._results
+
+
+def _get_network_infos():
+    import network_info
+    return list(network_info.NetworkInfos())
+
+
+def _get_public_ip():
+    import location_info
+    return location_info.get_ip_address()
+
+
+def get_cacheable_probes(location=None):
+    '''The probes worth caching by cache_motd_info, the weather is looked up for location when it is given.'''
+    return {'weather': lambda: _get_weather_info(location),
+            'public-ip': _get_public_ip,
+            'packages': _get_packages_available,
+            'quote': _get_quote}
+
+
+def get_system_probes():
+    '''The probes of the system information block, the fields login_info_fleet agents report.'''
+    return {'boot-time': _get_boot_time,
+            'system-load': _get_load_average,
+            'processes': _get_process_count,
+            'root-usage': _get_root_partition_usage,
+            'users-logged-in': _get_user_count,
+            'memory-usage': _get_virtual_memory_usage,
+            'swap-usage': _get_swap_memory_usage,
+            'network-infos': _get_network_infos}
+
+
+def _get_login_info_probes():
+    return {'greeting': _get_time_of_day_greeting,
+            'weather': _get_weather_info,
+            'last-login': _get_last_login,
+            'boot-time': _get_boot_time,
+            'public-ip': _get_public_ip,
+            'mail': _get_unopened_mail,
+            'system-load': _get_load_average,
+            'processes': _get_process_count,
+            'root-usage': _get_root_partition_usage,
+            'users-logged-in': _get_user_count,
+            'memory-usage': _get_virtual_memory_usage,
+            'swap-usage': _get_swap_memory_usage,
+            'network-infos': _get_network_infos,
+            'packages': _get_packages_available,
+            'quote': _get_quote,
+            'reboot-required': _is_reboot_required}
+
+
+def collect_login_info(deadline=DEFAULT_DEADLINE, timings=None, motd_database=None):
+    '''Returns a dict of every login info field, fields which did not arrive before the deadline are PENDING.
+
+    Fresh fields from the cache_motd_info cache are used as they are.  Stale ones are collected live but the stale
+    value is still shown if the live one misses the deadline.  When timings is a dict it is filled with the seconds
+    every field took, None for fields served from the cache and PENDING for those which missed the deadline.
+    motd_database is the cache to read when cache_motd_info writes one other than the config's (its -d).
+    '''
+    probes = _get_login_info_probes()
+    cached = cache_motd_info.read_cached_fields(db_path=motd_database)
+    fresh = {name: value for name, (value, is_fresh) in cached.items() if is_fresh and name in probes}
+    collector = ProbeCollector({name: probe for name, probe in probes.items() if name not in fresh})
+    results, errors = collector.wait(deadline)
+    for name, (value, is_fresh) in cached.items():
+        if name in probes and name not in results:
+            results[name] = value
+    if 'weather' in results and isinstance(results['weather'], list):
+        results['weather'] = tuple(results['weather'])
+    # a probe which fails does so on every login, its field already shows it is unavailable
+    for name, err in errors.items():
+        app_settings.debug(f'{name} failed: {err}')
+    for name, elapsed in sorted(collector.timings.items(), key=lambda item: item[1], reverse=True):
+        app_settings.debug(f'{name} took {elapsed * 1000.0:.1f} ms')
+    for name in probes:
+        if name not in results:
+            app_settings.info(f'{name} is still pending after {deadline} seconds')
+    if timings is not None:
+        timings.update({name: None if name in fresh else collector.timings.get(name, PENDING) for name in probes})
+    return {name: results.get(name, PENDING) for name in probes}
+
+
+def _get_legacy_probes():
+    '''The subprocess based probes the native readers replaced, kept so their cost can be compared.'''
+    return {'user-name': _get_user_first_name_command,
+            'last-login': _get_last_login_command,
+            'mail': _get_macosx_available_mail if sys.platform == 'darwin' else _get_linux_available_mail_command,
+            'quote': _get_quote_command}
+
+
+def _time_probe(probe, repeat=3):
+    '''Returns the fastest of repeat runs of probe in seconds, None when it fails.'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            probe()
+        except Exception as err:
+            app_settings.debug(f'{probe.__name__} failed: {err}')
+            return None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def print_probe_timings():
+    '''Runs every probe one at a time and prints its cost, next to the cost of the subprocess it replaced.'''
+    probes = {'user-name': _get_user_first_name}
+    probes.update(_get_login_info_probes())
+    if sys.platform != 'darwin':
+        probes['mail'] = _get_linux_available_mail
+    legacy_probes = _get_legacy_probes()
+    format_ms = lambda elapsed: f'{elapsed * 1000.0:.2f} ms' if elapsed is not None else 'failed'
+    print(f'  {"probe":<16} {"before":>12} {"after":>12}')
+    total_before = total_after = 0.0
+    for name, probe in probes.items():
+        after = _time_probe(probe)
+        before = _time_probe(legacy_probes[name]) if name in legacy_probes else after
+        total_before += before or 0.0
+        total_after += after or 0.0
+        print(f'  {name:<16} {format_ms(before):>12} {format_ms(after):>12}')
+    print(f'  {"total":<16} {format_ms(total_before):>12} {format_ms(total_after):>12}')
+
+
+def print_startup_profile(field_timings, collect_time, render_time, min_import_time=0.001):
+    '''Prints where the time between the start of the script and the banner went, on stderr so it can be redirected.
+
+    Imports are nested like python -X importtime, nested imports quicker than min_import_time are left out.
+    '''
+    format_ms = lambda elapsed: f'{elapsed * 1000.0:8.2f} ms'
+    if _IMPORT_TIMER is not None:
+        print('imports:', file=sys.stderr)
+        for depth, name, elapsed in _IMPORT_TIMER.timings:
+            if depth == 0 or elapsed >= min_import_time:
+                print(f'  {format_ms(elapsed)}  {"  " * depth}{name}', file=sys.stderr)
+    print('fields:', file=sys.stderr)
+    ordered = sorted(field_timings.items(), key=lambda item: item[1] if isinstance(item[1], float) else -1.0, reverse=True)
+    for name, elapsed in ordered:
+        timing = format_ms(elapsed) if isinstance(elapsed, float) else f'{"cached" if elapsed is None else elapsed:>11}'
+        print(f'  {timing}  {name}', file=sys.stderr)
+    print('totals:', file=sys.stderr)
+    print(f'  {format_ms(_IMPORTS_DONE_TIME - _STARTUP_TIME)}  module imports', file=sys.stderr)
+    print(f'  {format_ms(collect_time)}  collect', file=sys.stderr)
+    print(f'  {format_ms(render_time)}  render', file=sys.stderr)
+    print(f'  {format_ms(time.perf_counter() - _STARTUP_TIME)}  total', file=sys.stderr)
+
+
+OUTPUT_FORMATS = ['ansi', 'plain', 'json']
+
+_banner_templates = {}
+
+
+def _get_banner_template(output_format):
+    '''Returns the compiled template for ansi or plain output, compiled on first use.'''
+    if output_format not in _banner_templates:
+        styles = login_info_template.styles_from_markup(am, user_tags) if output_format == 'ansi' else None
+        _banner_templates[output_format] = login_info_template.BannerTemplate(styles, (PENDING, UNAVAILABLE))
+    return _banner_templates[output_format]
+
+
+def _get_banner_fields(info):
+    '''Returns the collected fields plus the ones which are only known when the banner is rendered.'''
+    fields = dict(info)
+    if fields['greeting'] in (PENDING, UNAVAILABLE):
+        fields['greeting'] = _get_greeting(getpass.getuser())
+    if fields['last-login'] == []:
+        # no wtmp records is normal in containers and on fresh hosts
+        fields['last-login'] = 'No previous login'
+    fields['system-time'] = _get_system_information_time()
+    fields['hostname'] = socket.gethostname()
+    fields['computer-name'] = fields['hostname'].split('.')[0]
+    return fields
+
+
+def format_login_info(info, output_format='ansi'):
+    '''Returns the banner for the fields returned by collect_login_info as ansi or plain text, or as json.'''
+    fields = _get_banner_fields(info)
+    if output_format == 'json':
+        return login_info_template.render_json(fields, (PENDING, UNAVAILABLE))
+    return _get_banner_template(output_format).render(fields)
+
+
+def render_login_info(info, output_format='ansi'):
+    sys.stdout.write(format_login_info(info, output_format))
+
+
+def output_login_info(deadline=DEFAULT_DEADLINE, profile=False, output_format='ansi', motd_database=None):
+    start = time.perf_counter()
+    field_timings = {}
+    info = collect_login_info(deadline, field_timings, motd_database)
+    collect_time = time.perf_counter() - start
+    render_login_info(info, output_format)
+    if profile:
+        sys.stdout.flush()
+        print_startup_profile(field_timings, collect_time, time.perf_counter() - start - collect_time)
 
 
 def _parse_args():
     parser = argparse.ArgumentParser(description='Replacement for standard Linux banner for both OS X and Linux')
     parser.add_argument('-v', '--verbose', action='count', default=0, help='increase output verbosity')
+    parser.add_argument('-T', '--timing', action='store_true', help='print the cost of every probe instead of the banner')
+    parser.add_argument('-f', '--format', dest='output_format', choices=OUTPUT_FORMATS, default='ansi', help='render the banner with colors, as plain text or as json')
+    parser.add_argument('--profile-startup', action='store_true', help='print where the startup time went (imports, fields, render) after the banner')
+    parser.add_argument('-t', '--deadline', type=float, default=DEFAULT_DEADLINE, metavar='<SECONDS>', help='render whatever has been collected after this long')
+    parser.add_argument('-m', '--motd-database', default=None, metavar='<DB PATH>', help='cache_motd_info database to read (the one given to its -d, default the one in its config)')
     args = parser.parse_args()
     app_settings.update(vars(args))
     app_settings.print_settings(print_always=False)
@@ -538,12 +826,22 @@ def _parse_args():
 
 def main():
     _parse_args()
+    # '--profile-startup' may only have been the value of another option, then there is nothing to profile
+    if _IMPORT_TIMER is not None and not app_settings.profile_startup:
+        _IMPORT_TIMER.uninstall()
     try:
-        output_login_info()
+        if app_settings.timing:
+            print_probe_timings()
+        else:
+            output_login_info(app_settings.deadline, app_settings.profile_startup, app_settings.output_format,
+                              app_settings.motd_database)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
         return 1
+    finally:
+        if _IMPORT_TIMER is not None:
+            _IMPORT_TIMER.uninstall()
     return 0
 
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# vim: awa:sts=4:ts=4:sw=4:et:cin:fdm=manual:tw=120:ft=python
+
+# this runs on every new terminal so it only imports what talking to the socket needs, login_info (and everything it
+# imports) is only loaded when the server is not running
+import os
+import socket
+import sys
+
+CONNECT_TIMEOUT = 0.05
+RESPONSE_TIMEOUT = 1.0
+
+
+def get_socket_path():
+    '''$LOGIN_INFO_SOCKET, otherwise login_info.sock in $XDG_RUNTIME_DIR or ~/.cache/login_info.'''
+    if 'LOGIN_INFO_SOCKET' in os.environ:
+        return os.environ['LOGIN_INFO_SOCKET']
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'login_info')
+    return os.path.join(runtime_dir, 'login_info.sock')
+
+
+def request_banner(socket_path=None, request=b'banner'):
+    '''Returns the banner rendered by login_info_server as bytes, None when the server is not there or does not answer.'''
+    socket_path = socket_path if socket_path else get_socket_path()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(CONNECT_TIMEOUT)
+            client.connect(socket_path)
+            client.settimeout(RESPONSE_TIMEOUT)
+            client.sendall(request + b'\n')
+            chunks = []
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+    except OSError:
+        return None
+    return b''.join(chunks)
+
+
+def main():
+    # the only argument is the output format, argparse alone would cost more than the whole request
+    output_format = sys.argv[1] if len(sys.argv) > 1 else 'ansi'
+    if output_format not in ('ansi', 'plain', 'json'):
+        print(f'usage: {os.path.basename(sys.argv[0])} [ansi|plain|json]', file=sys.stderr)
+        return 2
+    try:
+        banner = request_banner(request=b'banner ' + output_format.encode('ascii'))
+    except KeyboardInterrupt:
+        return 1
+    # an empty reply is a server which closed the connection without answering, the banner is collected here then
+    if banner:
+        sys.stdout.buffer.write(banner)
+        sys.stdout.flush()
+        return 0
+    import login_info
+    try:
+        login_info.output_login_info(output_format=output_format)
+    except:
+        import traceback
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# vim: awa:sts=4:ts=4:sw=4:et:cin:fdm=manual:tw=120:ft=python
+
+from app_settings import app_settings
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import glob
+import json
+import os
+import re
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+import login_info
+import login_info_template
+
+_COMMAND_AGENT = 'agent'
+_COMMAND_AGGREGATE = 'aggregate'
+
+DEFAULT_INTERVAL = 30.0
+DEFAULT_DEADLINE = 5.0
+DEFAULT_MAX_AGE = 300.0
+
+# the agent answers socket requests with its latest snapshot, a client which never reads does not hold a thread
+_REQUEST_TIMEOUT = 1.0
+_SOCKET_TIMEOUT = 2.0
+
+_SNAPSHOT_SUFFIX = '.json'
+
+# sort choice to the field sorted on (by its leading number), None sorts by host name
+SORT_KEYS = {'load': 'system-load',
+             'disk': 'root-usage',
+             'memory': 'memory-usage',
+             'swap': 'swap-usage',
+             'processes': 'processes',
+             'host': None}
+
+# heading, field, width
+_COLUMNS = [('LOAD', 'system-load', 7),
+            ('PROCS', 'processes', 6),
+            ('DISK', 'root-usage', 18),
+            ('MEM', 'memory-usage', 5),
+            ('SWAP', 'swap-usage', 5),
+            ('USERS', 'users-logged-in', 5)]
+
+_PERCENT_REGEX = re.compile(r'^\s*(?P<value>\d+(?:\.\d+)?)%')
+
+
+def collect_snapshot(host, deadline=DEFAULT_DEADLINE, interval=DEFAULT_INTERVAL, running=None):
+    '''Runs the login_info system probes and returns the host's snapshot as a json serializable dict.
+
+    running maps the probes abandoned by earlier snapshots to their collector, it is updated in place.  A probe which
+    is still running is not started again (a hung one would leak a thread every interval), its field is pending.
+    '''
+    running = {} if running is None else running
+    for name, collector in list(running.items()):
+        if not collector.is_running(name):
+            del running[name]
+    probes = login_info.get_system_probes()
+    started = {name: probe for name, probe in probes.items() if name not in running}
+    for name in probes.keys() - started.keys():
+        app_settings.debug(f'{name} is still running from an earlier snapshot')
+    collector = login_info.ProbeCollector(started)
+    results, errors = collector.wait(deadline)
+    for name in started.keys() - results.keys():
+        running[name] = collector
+    for name, err in errors.items():
+        app_settings.error(f'{name} failed: {err}')
+    fields = {name: results.get(name, login_info.PENDING) for name in probes}
+    snapshot = login_info_template.to_json_document(fields, (login_info.PENDING, login_info.UNAVAILABLE))
+    snapshot.update({'host': host, 'time': time.time(), 'interval': interval})
+    return snapshot
+
+
+def write_snapshot(directory, snapshot):
+    '''Writes <host>.json in directory, replaced atomically so the aggregator never reads half a snapshot.'''
+    path = os.path.join(directory, snapshot['host'] + _SNAPSHOT_SUFFIX)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(temp_path, path)
+    return path
+
+
+class _SnapshotHandler(socketserver.StreamRequestHandler):
+    timeout = _REQUEST_TIMEOUT
+
+    def handle(self):
+        with self.server.lock:
+            data = self.server.snapshot
+        self.wfile.write(data)
+
+
+class _SnapshotServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        self.lock = threading.Lock()
+        self.snapshot = b'{}'
+        super().__init__(socket_path, _SnapshotHandler)
+
+    def set_snapshot(self, snapshot):
+        data = json.dumps(snapshot).encode('utf-8')
+        with self.lock:
+            self.snapshot = data
+
+
+def run_agent(host, directory=None, socket_path=None, interval=DEFAULT_INTERVAL, deadline=DEFAULT_DEADLINE, once=False):
+    '''Collects a snapshot every interval seconds and writes it to directory and/or serves it on socket_path.'''
+    server = None
+    if socket_path:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_path)
+        server = _SnapshotServer(socket_path)
+        threading.Thread(target=server.serve_forever, name='snapshot-server', daemon=True).start()
+        app_settings.info(f'serving snapshots on {socket_path}')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # stopped by a service manager the socket file is still removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    running = {}
+    try:
+        while True:
+            start = time.monotonic()
+            snapshot = collect_snapshot(host, deadline, interval, running)
+            if directory:
+                app_settings.debug(f'wrote {write_snapshot(directory, snapshot)}')
+            if server is not None:
+                server.set_snapshot(snapshot)
+            if once:
+                return
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            with contextlib.suppress(OSError):
+                os.remove(socket_path)
+
+
+def _read_snapshot_file(path):
+    with open(path) as snapshot_file:
+        return json.load(snapshot_file)
+
+
+def _read_snapshot_socket(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(_SOCKET_TIMEOUT)
+        client.connect(socket_path)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def read_snapshots(directories=(), socket_paths=(), workers=16):
+    '''Reads every snapshot in the directories and from the agent sockets concurrently, the newest one of a host seen
+    more than once is kept and unreadable ones are reported and skipped.'''
+    sources = [(_read_snapshot_file, path) for directory in directories
+               for path in sorted(glob.glob(os.path.join(directory, '*' + _SNAPSHOT_SUFFIX)))]
+    sources.extend((_read_snapshot_socket, socket_path) for socket_path in socket_paths)
+    if not sources:
+        return []
+
+    def read(source):
+        reader, name = source
+        try:
+            return reader(name)
+        except (OSError, ValueError) as err:
+            app_settings.error(f'unable to read the snapshot from {name}: {err}')
+            return None
+
+    newest = {}
+    with ThreadPoolExecutor(max_workers=min(workers, len(sources))) as executor:
+        for snapshot in executor.map(read, sources):
+            if not snapshot or 'host' not in snapshot:
+                continue
+            host = snapshot['host']
+            if host not in newest or snapshot.get('time', 0) > newest[host].get('time', 0):
+                newest[host] = snapshot
+    return list(newest.values())
+
+
+def _parse_number(value):
+    '''Returns the leading percentage (or plain number) of a formatted field, None when there is none.'''
+    if not isinstance(value, str):
+        return value if isinstance(value, (int, float)) else None
+    match = _PERCENT_REGEX.match(value)
+    if match:
+        return float(match.group('value'))
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def sort_snapshots(snapshots, sort_by='load'):
+    '''Busiest host first (hosts missing the field last), or by host name.'''
+    field = SORT_KEYS[sort_by]
+    by_host = sorted(snapshots, key=lambda snapshot: snapshot['host'])
+    if field is None:
+        return by_host
+    def key(snapshot):
+        number = _parse_number(snapshot['fields'].get(field))
+        return (number is None, -(number or 0.0))
+    return sorted(by_host, key=key)
+
+
+def _format_age(seconds):
+    if seconds < 120:
+        return f'{seconds:.0f}s'
+    if seconds < 7200:
+        return f'{seconds / 60:.0f}m'
+    return f'{seconds / 3600:.0f}h'
+
+
+def _format_addresses(network_infos):
+    if not isinstance(network_infos, list):
+        return '-'
+    return ' '.join(f'{info["name"]}={info["ip"]}' for info in network_infos)
+
+
+def print_snapshot_table(snapshots, max_age=DEFAULT_MAX_AGE, now=None):
+    now = now if now is not None else time.time()
+    host_width = max([len('HOST')] + [len(snapshot['host']) for snapshot in snapshots])
+    headings = ' '.join(f'{heading:>{width}}' for heading, _, width in _COLUMNS)
+    print(f'{"HOST":<{host_width}} {"AGE":>4} {headings}  ADDRESSES')
+    for snapshot in snapshots:
+        age = now - snapshot.get('time', 0)
+        stale = '*' if age > max_age else ''
+        fields = snapshot['fields']
+        values = ' '.join(f'{str(fields.get(field) if fields.get(field) is not None else "-"):>{width}}'
+                          for _, field, width in _COLUMNS)
+        print(f'{snapshot["host"]:<{host_width}} {_format_age(age) + stale:>4} {values}  '
+              f'{_format_addresses(fields.get("network-infos"))}')
+    if any(now - snapshot.get('time', 0) > max_age for snapshot in snapshots):
+        print(f'* older than {max_age:.0f} seconds, the agent may not be running')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Collects the login_info system information from many hosts: agents write json snapshots, the aggregator tabulates them')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='increase output verbosity')
+    sub_parsers = parser.add_subparsers(help='commands', dest='command')
+    sub_parsers.required = True
+
+    agent = sub_parsers.add_parser(_COMMAND_AGENT, help='collect this host\'s snapshot periodically')
+    agent.add_argument('-d', '--directory', default=None, metavar='<DIR>', help='shared directory the snapshot is written to as <host>.json')
+    agent.add_argument('-s', '--socket', default=None, metavar='<SOCKET PATH>', help='unix socket the latest snapshot is served on')
+    agent.add_argument('-n', '--name', default=socket.gethostname(), help='host name to report (default the hostname)')
+    agent.add_argument('-i', '--interval', type=float, default=DEFAULT_INTERVAL, metavar='<SECONDS>', help='seconds between snapshots')
+    agent.add_argument('-t', '--deadline', type=float, default=DEFAULT_DEADLINE, metavar='<SECONDS>', help='how long a snapshot waits for the probes')
+    agent.add_argument('-1', '--once', action='store_true', help='write one snapshot and exit (for cron)')
+
+    aggregate = sub_parsers.add_parser(_COMMAND_AGGREGATE, help='print the hosts\' snapshots as a table')
+    aggregate.add_argument('-d', '--directory', dest='directories', action='append', default=[], metavar='<DIR>', help='directory of snapshots (repeatable)')
+    aggregate.add_argument('-s', '--socket', dest='sockets', action='append', default=[], metavar='<SOCKET PATH>', help='agent socket to ask (repeatable)')
+    aggregate.add_argument('-S', '--sort', choices=sorted(SORT_KEYS), default='load', help='column to sort by, busiest first')
+    aggregate.add_argument('-a', '--max-age', type=float, default=DEFAULT_MAX_AGE, metavar='<SECONDS>', help='snapshots older than this are flagged')
+    aggregate.add_argument('-j', '--json', action='store_true', help='print the sorted snapshots as json instead of a table')
+
+    args = parser.parse_args()
+    if args.command == _COMMAND_AGENT and not args.directory and not args.socket:
+        parser.error('the agent needs a --directory and/or a --socket')
+    if args.command == _COMMAND_AGGREGATE and not args.directories and not args.sockets:
+        parser.error('the aggregator needs a --directory and/or a --socket')
+    app_settings.update(vars(args))
+    app_settings.print_settings(print_always=False)
+
+
+def main():
+    _parse_args()
+    try:
+        if app_settings.command == _COMMAND_AGENT:
+            run_agent(app_settings.name, app_settings.directory, app_settings.socket, app_settings.interval,
+                      app_settings.deadline, app_settings.once)
+        else:
+            snapshots = sort_snapshots(read_snapshots(app_settings.directories, app_settings.sockets), app_settings.sort)
+            if app_settings.json:
+                print(json.dumps(snapshots, indent=2))
+            else:
+                print_snapshot_table(snapshots, app_settings.max_age)
+    except KeyboardInterrupt:
+        return 0
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
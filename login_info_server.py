@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# vim: awa:sts=4:ts=4:sw=4:et:cin:fdm=manual:tw=120:ft=python
+
+from app_settings import app_settings
+import argparse
+import contextlib
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+import login_info
+from login_info_client import get_socket_path
+
+DEFAULT_INTERVAL = 15.0
+DEFAULT_COLLECT_DEADLINE = 10.0
+
+# a client which connects and never sends its request does not hold a handler thread for long
+_REQUEST_TIMEOUT = 1.0
+
+
+class LoginInfoState:
+    '''The most recently collected login info fields, refreshed on a background thread.
+
+    Only collection happens in the background, the banner is rendered for every request (from the compiled
+    template) so the greeting and the "as of" time are never older than the request.
+    '''
+    def __init__(self, interval=DEFAULT_INTERVAL, deadline=DEFAULT_COLLECT_DEADLINE, motd_database=None):
+        self.interval = interval
+        self.deadline = deadline
+        self.motd_database = motd_database
+        self.requests = 0
+        self._info = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def count_request(self):
+        # every request is handled on its own thread
+        with self._lock:
+            self.requests += 1
+
+    def refresh(self):
+        start = time.perf_counter()
+        info = login_info.collect_login_info(self.deadline, motd_database=self.motd_database)
+        with self._lock:
+            self._info = info
+        app_settings.debug(f'collected login info in {time.perf_counter() - start:.3f} seconds')
+
+    def run_refresher(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as err:
+                app_settings.error(f'refreshing the login info failed: {err}')
+
+    def stop(self):
+        self._stopped.set()
+
+    def render(self, output_format='ansi'):
+        with self._lock:
+            info = self._info
+        return login_info.format_login_info(info, output_format)
+
+
+class LoginInfoHandler(socketserver.StreamRequestHandler):
+    timeout = _REQUEST_TIMEOUT
+
+    def handle(self):
+        try:
+            request = self.rfile.readline().strip()
+        except socket.timeout:
+            return
+        state = self.server.state
+        state.count_request()
+        # banner [ansi|plain|json]
+        command, _, output_format = request.decode('utf-8', 'replace').partition(' ')
+        output_format = output_format if output_format else 'ansi'
+        if command == 'banner' and output_format in login_info.OUTPUT_FORMATS:
+            self.wfile.write(state.render(output_format).encode('utf-8'))
+        elif command == 'ping':
+            self.wfile.write(b'pong\n')
+        else:
+            app_settings.warn(f'unknown request {request!r}')
+
+
+class LoginInfoServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, state):
+        self.state = state
+        super().__init__(socket_path, LoginInfoHandler)
+
+
+def _remove_stale_socket(socket_path):
+    '''Removes the socket file a server which died left behind, raises if a server is still listening on it.'''
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+            return
+    raise RuntimeError(f'a login info server is already listening on {socket_path}')
+
+
+def serve(socket_path, interval=DEFAULT_INTERVAL, deadline=DEFAULT_COLLECT_DEADLINE, motd_database=None):
+    import network_info
+    # interface changes arrive as rtnetlink events so the network fields never need to be rediscovered on a timer
+    if network_info.start_network_monitor() is None:
+        app_settings.info('network changes are not monitored, the interfaces are rediscovered periodically')
+    state = LoginInfoState(interval, deadline, motd_database)
+    state.refresh()
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), mode=0o700, exist_ok=True)
+    _remove_stale_socket(socket_path)
+    # the banner shows who is logged in and from where so only the owner may connect
+    old_umask = os.umask(0o177)
+    try:
+        server = LoginInfoServer(socket_path, state)
+    finally:
+        os.umask(old_umask)
+    refresher = threading.Thread(target=state.run_refresher, name='refresher', daemon=True)
+    refresher.start()
+    app_settings.info(f'listening on {socket_path}')
+    # terminated from a service manager the socket file is still cleaned up
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    finally:
+        state.stop()
+        server.server_close()
+        with contextlib.suppress(OSError):
+            os.remove(socket_path)
+        app_settings.info(f'served {state.requests} requests')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Keeps the login info warm and serves the rendered banner to login_info_client over a unix socket')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='increase output verbosity')
+    parser.add_argument('-s', '--socket', default=get_socket_path(), metavar='<SOCKET PATH>', help='unix socket to listen on')
+    parser.add_argument('-i', '--interval', type=float, default=DEFAULT_INTERVAL, metavar='<SECONDS>', help='how often the fields are collected')
+    parser.add_argument('-t', '--deadline', type=float, default=DEFAULT_COLLECT_DEADLINE, metavar='<SECONDS>', help='how long a collection waits for the slow fields')
+    parser.add_argument('-m', '--motd-database', default=None, metavar='<DB PATH>', help='cache_motd_info database to read (the one given to its -d, default the one in its config)')
+    args = parser.parse_args()
+    app_settings.update(vars(args))
+    app_settings.print_settings(print_always=False)
+
+
+def main():
+    _parse_args()
+    try:
+        serve(app_settings.socket, app_settings.interval, app_settings.deadline, app_settings.motd_database)
+    except KeyboardInterrupt:
+        return 0
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# vim: awa:sts=4:ts=4:sw=4:et:cin:fdm=manual:tw=120:ft=python
+
+import json
+
+COLUMN_LH_WIDTH_1 = 15
+COLUMN_RH_WIDTH_1 = 20
+COLUMN_LH_WIDTH_2 = 25
+COLUMN_RH_WIDTH_2 = 14
+
+# label 1, field 1, label 2, field 2 of the rows which are always there
+_COLUMN_ROWS = [('Computer Name', 'computer-name', 'Hostname', 'hostname'),
+                ('Public IP', 'public-ip', 'Mail', 'mail'),
+                ('System Load', 'system-load', 'Processes', 'processes'),
+                ('Usage of /', 'root-usage', 'Users Logged In', 'users-logged-in')]
+
+# the trailing messages in the order they are shown, each is left out when it is empty or missing
+_MESSAGES = [('packages', 'apt'), ('quote', 'quote'), ('reboot-required', 'reboot')]
+
+_LOGIN_PREFIXES = ('Log in:', 'Log out:')
+
+_SENTINEL = '\x00'
+
+
+def styles_from_markup(markup, names):
+    '''Returns name to (prefix, suffix) escape sequences for every ansimarkup tag name, parsed once.'''
+    styles = {}
+    for name in names:
+        prefix, suffix = str(markup.ansistring(f'<{name}>{_SENTINEL}</{name}>')).split(_SENTINEL)
+        styles[name] = (prefix, suffix)
+    return styles
+
+
+def _label(label):
+    return label + ':' if len(label) > 0 else label
+
+
+class BannerTemplate:
+    '''The banner layout with its styles compiled into format strings once, rendered from a dict of fields.
+
+    styles is name to (prefix, suffix), no styles renders plain text.  Fields whose value is one of missing_values
+    are shown as that value, except the trailing messages which are left out.
+    '''
+    def __init__(self, styles=None, missing_values=()):
+        self._styles = styles if styles else {}
+        self._missing_values = missing_values
+        wrap = self._wrap
+        self._greeting = wrap('greeting', '{0}') + '\n\n'
+        self._system_time = '  ' + wrap('sysinfo', '{0}') + '\n\n'
+        self._weather = ('  ' + wrap('location', f'{{0:<{COLUMN_LH_WIDTH_1}}}') + ' ' +
+                         wrap('weather', f'{{1:<{COLUMN_RH_WIDTH_1}}}') + '\n')
+        self._last_login_first = '  ' + wrap('label', _label('Last Login').ljust(COLUMN_LH_WIDTH_1)) + ' {0}\n'
+        self._last_login_next = ' ' * (COLUMN_LH_WIDTH_1 + 3) + '{0}\n'
+        self._login_prefixes = {prefix: wrap('loginout', prefix) for prefix in _LOGIN_PREFIXES}
+        self._value = wrap('value', '{0}')
+        self._boot_time = ('  ' + wrap('label', _label('Boot Time').ljust(COLUMN_LH_WIDTH_1)) + ' ' +
+                           wrap('value', f'{{0:<{COLUMN_RH_WIDTH_1}}}') + '\n\n')
+        self._row_start = ('  ' + wrap('label', f'{{0:<{COLUMN_LH_WIDTH_1}}}') + ' ' +
+                           wrap('value', f'{{1:<{COLUMN_RH_WIDTH_1}}}') + '   ' +
+                           wrap('label', f'{{2:<{COLUMN_LH_WIDTH_2}}}') + ' ')
+        self._row = self._row_start + wrap('value', f'{{3:<{COLUMN_RH_WIDTH_2}}}') + '\n'
+        self._mail = wrap('value', wrap('mail', '{0}') + ' Unread Mail Items{1}')
+        self._messages = [(name, '\n' + wrap(style, '{0}') + '\n') for name, style in _MESSAGES]
+
+    def _wrap(self, style, text):
+        prefix, suffix = self._styles.get(style, ('', ''))
+        return prefix + text + suffix
+
+    def _is_missing(self, value):
+        return isinstance(value, str) and value in self._missing_values
+
+    def _row_line(self, label1, value1, label2, value2):
+        return self._row.format(_label(label1), str(value1), _label(label2), str(value2))
+
+    def _last_login_value(self, value):
+        for prefix in _LOGIN_PREFIXES:
+            if value.startswith(prefix):
+                rest = value[len(prefix):].lstrip()
+                padding = ' ' * max(0, COLUMN_RH_WIDTH_1 - len(prefix) - 1 - len(rest))
+                return self._login_prefixes[prefix] + ' ' + self._value.format(rest + padding)
+        return self._value.format(value.ljust(COLUMN_RH_WIDTH_1))
+
+    def _mail_row(self, label1, value1, mail):
+        # the count is styled on its own so the cell is padded by hand rather than by the format string
+        if self._is_missing(mail) or mail == 0:
+            return self._row_line(label1, value1, 'Mail', mail if self._is_missing(mail) else '0 Unread Mail Items')
+        padding = ' ' * max(0, COLUMN_RH_WIDTH_2 - len(f'{mail} Unread Mail Items'))
+        return self._row_start.format(_label(label1), str(value1), _label('Mail')) + self._mail.format(mail, padding) + '\n'
+
+    def _network_lines(self, fields):
+        network_infos = fields['network-infos']
+        memory, swap = fields['memory-usage'], fields['swap-usage']
+        if not isinstance(network_infos, list):
+            return [self._row_line('Memory Usage', memory, 'Network', network_infos),
+                    self._row_line('Swap Usage', swap, '', '')]
+        if len(network_infos) == 0:
+            return [self._row_line('Memory Usage', memory, '', ''), self._row_line('Swap Usage', swap, '', '')]
+        lines = []
+        for i, network_info in enumerate(network_infos):
+            lines.append(self._row_line('Memory Usage' if i == 0 else '', memory if i == 0 else '',
+                                        f'{network_info.name} IP', network_info.ip))
+            lines.append(self._row_line('Swap Usage' if i == 0 else '', swap if i == 0 else '',
+                                        f'{network_info.name} MAC', network_info.mac))
+        return lines
+
+    def render(self, fields):
+        '''Returns the banner for fields (the collected login info plus hostname, computer-name and system-time).'''
+        lines = [self._greeting.format(str(fields['greeting'])), self._system_time.format(str(fields['system-time']))]
+
+        weather = fields['weather']
+        location, weather = weather if isinstance(weather, tuple) else ('Weather', weather)
+        lines.append(self._weather.format(_label(location), str(weather)))
+        last_login = fields['last-login']
+        for i, value in enumerate(last_login if isinstance(last_login, list) else [last_login]):
+            lines.append((self._last_login_next if i else self._last_login_first).format(self._last_login_value(str(value))))
+        lines.append(self._boot_time.format(str(fields['boot-time'])))
+
+        for label1, name1, label2, name2 in _COLUMN_ROWS:
+            if name2 == 'mail':
+                lines.append(self._mail_row(label1, fields[name1], fields[name2]))
+            else:
+                lines.append(self._row_line(label1, fields[name1], label2, fields[name2]))
+        lines.extend(self._network_lines(fields))
+
+        for name, message in self._messages:
+            value = fields[name]
+            if value and not self._is_missing(value):
+                lines.append(message.format(value))
+        return ''.join(lines)
+
+
+def _json_value(value):
+    if isinstance(value, tuple) and len(value) == 2:
+        return {'location': value[0], 'weather': value[1]}
+    if isinstance(value, list):
+        return [_json_value(item) for item in value]
+    if hasattr(value, 'mac'):
+        return {'name': value.name, 'ip': value.ip, 'mac': value.mac}
+    return value
+
+
+def to_json_document(fields, missing_values=()):
+    '''Returns the fields as a json serializable dict, a field which is one of missing_values is null and listed under
+    "missing".'''
+    document = {'fields': {}, 'missing': {}}
+    for name, value in fields.items():
+        if isinstance(value, str) and value in missing_values:
+            document['fields'][name] = None
+            document['missing'][name] = value
+        else:
+            document['fields'][name] = _json_value(value)
+    return document
+
+
+def render_json(fields, missing_values=()):
+    return json.dumps(to_json_document(fields, missing_values), ensure_ascii=False, indent=2) + '\n'
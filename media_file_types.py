@@ -71,3 +71,9 @@ var1 = {
 '.wv' :	'format for wavpack file http://www.wavpack.com/flash/wavpack.htm',
 '.webm' : 'Royalty-free format created for HTML5 video.',
 }
+
+# the extension sets classifiers look names up in, built once from the tables above
+VIDEO_EXTENSIONS = frozenset(var2)
+AUDIO_EXTENSIONS = frozenset(var1)
+MEDIA_EXTENSIONS = VIDEO_EXTENSIONS | AUDIO_EXTENSIONS
+SUBTITLE_EXTENSIONS = frozenset(['.srt', '.idx', '.sub', '.smi', '.ass', '.ssa'])
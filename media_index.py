@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# vim:softtabstop=4:ts=4:sw=4:expandtab:tw=120
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from pymediainfo import MediaInfo
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+DEFAULT_DB_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'media_index', 'media.db')
+
+TRACK_TYPES = ['General', 'Video', 'Audio']
+
+MEDIA_EXTENSIONS = ['.webm', '.mpg', '.mp2', '.mpeg', '.mpe', '.mpv', '.ogg', '.mp4', '.m4p', '.m4v', '.avi', '.wmv',
+                    '.mov', '.qt', '.flv', '.swf', '.avchd', '.mkv', '.mp3', '.wav', '.wma', '.m4a', '.m4b', '.flac']
+
+_COMMIT_INTERVAL = 200
+
+# the columns the queries need are copied out of the track data so they can be indexed
+_CREATE_TABLES = ['''CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    scanned REAL NOT NULL,
+    error TEXT,
+    width INTEGER,
+    height INTEGER,
+    bit_rate INTEGER,
+    general_title TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT NOT NULL,
+    track_index INTEGER NOT NULL,
+    track_type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (path, track_index))''',
+    'CREATE INDEX IF NOT EXISTS files_directory ON files (directory)',
+    'CREATE INDEX IF NOT EXISTS files_height ON files (height)']
+
+# bumped when _summarize changes, the copied out columns of an older index are recomputed from its track data
+_SUMMARY_VERSION = 1
+
+class IndexedTrack(object):
+    '''Stands in for a pymediainfo Track built from the stored data.'''
+    def __init__(self, track_type, data):
+        self.track_type = track_type
+        self._data = data
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._data.get(name)
+
+    def to_data(self):
+        return dict(self._data)
+
+class IndexedMediaInfo(object):
+    '''Stands in for a pymediainfo MediaInfo, so code written against MediaInfo.parse can read the index.'''
+    def __init__(self, tracks):
+        self.tracks = [IndexedTrack(track_type, data) for track_type, data in tracks]
+
+def is_media_file(file_name):
+    return os.path.splitext(file_name)[1].lower() in MEDIA_EXTENSIONS
+
+def _to_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def _parse_file(path):
+    '''Runs in a worker process, returns (path, stat, tracks, error) where tracks is [(track type, data)].'''
+    try:
+        st = os.stat(path)
+    except OSError as err:
+        return path, None, [], str(err)
+    try:
+        media_info = MediaInfo.parse(path)
+        tracks = [(track.track_type, track.to_data()) for track in media_info.tracks if track.track_type in TRACK_TYPES]
+        return path, (st.st_size, st.st_mtime_ns), tracks, None
+    except Exception as err:
+        return path, (st.st_size, st.st_mtime_ns), [], '{0}: {1}'.format(type(err).__name__, err)
+
+def _summarize(tracks):
+    '''Returns the (width, height, bit rate, general title) columns for the track data.'''
+    width = height = bit_rate = overall_bit_rate = title = None
+    for track_type, data in tracks:
+        if track_type == 'Video' and height is None:
+            width, height = _to_int(data.get('width')), _to_int(data.get('height'))
+        elif track_type == 'Audio' and bit_rate is None:
+            bit_rate = _to_int(data.get('bit_rate'))
+        elif track_type == 'General':
+            title = data.get('title') or data.get('title_name')
+            overall_bit_rate = _to_int(data.get('overall_bit_rate'))
+    # the General track comes first, its overall bit rate is only used when the audio track does not have one
+    return width, height, bit_rate if bit_rate is not None else overall_bit_rate, title
+
+class MediaIndex(object):
+    '''MediaInfo track data (General, Video and Audio) stored in sqlite keyed by path and validated by size and mtime_ns.
+
+    refresh() only parses the files which are new or changed, on a process pool.  get_media_info() returns an object
+    which looks like the result of MediaInfo.parse, parsing the file first when the index does not have it.
+    '''
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        if db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.parsed = 0
+        self.unchanged = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pending_writes = 0
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in _CREATE_TABLES:
+            self._connection.execute(statement)
+        if self._connection.execute('PRAGMA user_version').fetchone()[0] < _SUMMARY_VERSION:
+            self._update_summaries()
+        self._connection.commit()
+
+    def _update_summaries(self):
+        tracks = {}
+        for path, track_type, data in self._connection.execute('SELECT path, track_type, data FROM tracks '
+                                                               'ORDER BY path, track_index'):
+            tracks.setdefault(path, []).append((track_type, json.loads(data)))
+        self._connection.executemany('UPDATE files SET width = ?, height = ?, bit_rate = ?, general_title = ? '
+                                     'WHERE path = ?',
+                                     [_summarize(path_tracks) + (path,) for path, path_tracks in tracks.items()])
+        self._connection.execute('PRAGMA user_version = {0}'.format(_SUMMARY_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __str__(self):
+        return 'media index {0}: {1} parsed, {2} unchanged, {3} failed'.format(
+            self.db_path, self.parsed, self.unchanged, self.failed)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.commit()
+                self._connection.close()
+                self._connection = None
+
+    def _is_current(self, path, st):
+        with self._lock:
+            row = self._connection.execute('SELECT size, mtime_ns FROM files WHERE path = ?', (path,)).fetchone()
+        return row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns
+
+    def _store(self, path, stat, tracks, error):
+        '''Replaces everything stored for path; commits in batches so a big refresh is not one fsync per file.'''
+        width, height, bit_rate, title = _summarize(tracks)
+        with self._lock:
+            self._connection.execute('DELETE FROM tracks WHERE path = ?', (path,))
+            self._connection.execute('INSERT OR REPLACE INTO files (path, directory, size, mtime_ns, scanned, error, width, '
+                                     'height, bit_rate, general_title) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (path, os.path.dirname(path), stat[0], stat[1], time.time(), error, width, height,
+                                      bit_rate, title))
+            self._connection.executemany('INSERT INTO tracks (path, track_index, track_type, data) VALUES (?, ?, ?, ?)',
+                                         [(path, index, track_type, json.dumps(data))
+                                          for index, (track_type, data) in enumerate(tracks)])
+            self._pending_writes += 1
+            if self._pending_writes >= _COMMIT_INTERVAL:
+                self._connection.commit()
+                self._pending_writes = 0
+
+    def _record(self, result):
+        path, stat, tracks, error = result
+        if stat is None:
+            self.failed += 1
+            return
+        self._store(path, stat, tracks, error)
+        if error is None:
+            self.parsed += 1
+        else:
+            self.failed += 1
+
+    def refresh(self, paths, workers=None, on_parsed=None):
+        '''Parses the paths which are not indexed or changed since, returns the number parsed.'''
+        changed = []
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if self._is_current(path, st):
+                self.unchanged += 1
+            else:
+                changed.append(path)
+        if not changed:
+            return 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(_parse_file, changed, chunksize=8):
+                self._record(result)
+                if on_parsed is not None:
+                    on_parsed(result[0], result[3])
+        with self._lock:
+            self._connection.commit()
+            self._pending_writes = 0
+        return len(changed)
+
+    def refresh_directory(self, directory, workers=None, on_parsed=None):
+        paths = (os.path.join(root, file_name) for root, dirs, files in os.walk(directory)
+                 for file_name in files if is_media_file(file_name))
+        return self.refresh(paths, workers, on_parsed)
+
+    def get_tracks(self, path):
+        '''Returns [(track type, data)] for path, parsing (and storing) it first when the index is missing or stale.'''
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        if self._is_current(path, st):
+            self.unchanged += 1
+        else:
+            self._record(_parse_file(path))
+        with self._lock:
+            error = self._connection.execute('SELECT error FROM files WHERE path = ?', (path,)).fetchone()
+            rows = self._connection.execute('SELECT track_type, data FROM tracks WHERE path = ? ORDER BY track_index',
+                                            (path,)).fetchall()
+        if error is not None and error[0] is not None:
+            raise RuntimeError('MediaInfo could not parse {0}: {1}'.format(path, error[0]))
+        return [(track_type, json.loads(data)) for track_type, data in rows]
+
+    def get_media_info(self, path):
+        return IndexedMediaInfo(self.get_tracks(path))
+
+    def get_tag_info(self, path):
+        '''Returns the tags pydub.utils.mediainfo would (bit_rate, track, artist, title, album) from the index.'''
+        info = {}
+        overall_bit_rate = None
+        for track_type, data in self.get_tracks(path):
+            if track_type == 'General':
+                info.setdefault('track', str(data.get('track_name_position', '')))
+                info.setdefault('artist', data.get('performer', ''))
+                info.setdefault('title', data.get('track_name') or data.get('title', ''))
+                info.setdefault('album', data.get('album', ''))
+                overall_bit_rate = data.get('overall_bit_rate')
+            elif track_type == 'Audio' and 'bit_rate' in data:
+                info.setdefault('bit_rate', str(data['bit_rate']))
+        # like _summarize, the overall bit rate stands in when the audio track does not have one
+        if 'bit_rate' not in info and overall_bit_rate is not None:
+            info['bit_rate'] = str(overall_bit_rate)
+        return info
+
+    def files_above_resolution(self, min_height=1080):
+        '''Returns (path, width, height) of the video files taller than min_height, 1080 means "above 1080p".'''
+        with self._lock:
+            return self._connection.execute('SELECT path, width, height FROM files WHERE height > ? ORDER BY path',
+                                            (min_height,)).fetchall()
+
+    def files_with_general_title(self):
+        '''Returns (path, title) of the video files with General:title metadata, the kind remove_movie_metadata strips.'''
+        with self._lock:
+            return self._connection.execute('SELECT path, general_title FROM files WHERE general_title IS NOT NULL '
+                                            'AND height IS NOT NULL ORDER BY path').fetchall()
+
+    def albums_with_mixed_bitrates(self):
+        '''Returns (directory, [kbps]) of the directories whose audio files were not all encoded at one bit rate.'''
+        with self._lock:
+            rows = self._connection.execute('SELECT directory, GROUP_CONCAT(DISTINCT bit_rate / 1000) FROM files '
+                                            'WHERE bit_rate IS NOT NULL AND width IS NULL GROUP BY directory '
+                                            'HAVING COUNT(DISTINCT bit_rate / 1000) > 1 ORDER BY directory').fetchall()
+        return [(directory, sorted(int(kbps) for kbps in rates.split(','))) for directory, rates in rows]
+
+    def prune(self):
+        '''Removes the files which no longer exist or changed since they were indexed, returns how many.'''
+        with self._lock:
+            rows = self._connection.execute('SELECT path, size, mtime_ns FROM files').fetchall()
+        stale = []
+        for path, size, mtime_ns in rows:
+            try:
+                st = os.stat(path)
+                if st.st_size == size and st.st_mtime_ns == mtime_ns:
+                    continue
+            except OSError:
+                pass
+            stale.append((path,))
+        with self._lock:
+            self._connection.executemany('DELETE FROM tracks WHERE path = ?', stale)
+            self._connection.executemany('DELETE FROM files WHERE path = ?', stale)
+            self._connection.commit()
+            self._pending_writes = 0
+        return len(stale)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+_QUERIES = ['above-1080p', 'general-title', 'mixed-bitrates']
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Maintains and queries the MediaInfo index shared by the media scripts')
+    parser.add_argument('-d', '--database', default=DEFAULT_DB_PATH, metavar='<DB PATH>', help='media index database')
+    parser.add_argument('-u', '--update', dest='directories', action='append', default=[], metavar='<DIR>', help='index the new and changed media files in this directory (repeatable)')
+    parser.add_argument('-p', '--prune', action='store_true', help='remove entries for files which no longer exist or changed')
+    parser.add_argument('-q', '--query', choices=_QUERIES, default=None, help='print the files (or albums) matching a query')
+    parser.add_argument('-H', '--min-height', type=int, default=1080, help='height the above-1080p query compares with')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='processes parsing files (default every core)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every file as it is parsed')
+    args = parser.parse_args()
+    return args.database, args.directories, args.prune, args.query, args.min_height, args.workers, args.verbose
+
+def main():
+    db_path, directories, prune, query, min_height, workers, verbose = _parse_args()
+    def on_parsed(path, error):
+        if error is not None:
+            print('ERROR: {0}: {1}'.format(path, error), file=sys.stderr)
+        elif verbose:
+            print('parsed {0}'.format(path))
+    try:
+        with MediaIndex(db_path) as index:
+            if prune:
+                print('pruned {0} entries'.format(index.prune()))
+            for directory in directories:
+                index.refresh_directory(directory, workers, on_parsed)
+            if query == 'above-1080p':
+                for path, width, height in index.files_above_resolution(min_height):
+                    print('{0}x{1} {2}'.format(width, height, path))
+            elif query == 'general-title':
+                for path, title in index.files_with_general_title():
+                    print('{0}: {1}'.format(path, title))
+            elif query == 'mixed-bitrates':
+                for directory, rates in index.albums_with_mixed_bitrates():
+                    print('{0}: {1} kbps'.format(directory, ', '.join(str(rate) for rate in rates)))
+            print('{0} ({1} entries)'.format(index, len(index)), file=sys.stderr)
+        return 0
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,18 +4,20 @@
 
 from ansimarkup import AnsiMarkup, parse
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import ipaddress
 import os
-import psutil
 import re
+import select
 import shlex
 import socket
+import struct
 import subprocess
 import sys
+import threading
+import time
 import traceback
 
-import location_info
-
 user_tags = {
     'info'        : parse('<bold><green>'),    # bold green
     'error'       : parse('<bold><red>'),      # bold red
@@ -71,15 +73,205 @@ class NetworkInfo:
     def mac(self):
         return self._mac
 
+# seconds a discovery is reused when no NetworkMonitor is keeping it up to date
+DISCOVERY_MAX_AGE = 60.0
+
+_IPV4_ADDRESS_REGEX = r'\b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)'
+
+# rtnetlink multicast groups and message types, see linux/rtnetlink.h
+_RTMGRP_LINK = 0x1
+_RTMGRP_IPV4_IFADDR = 0x10
+_RTMGRP_IPV6_IFADDR = 0x100
+_RTM_NEWLINK = 16
+_RTM_DELLINK = 17
+_RTM_NEWADDR = 20
+_RTM_DELADDR = 21
+_NLMSGHDR_STRUCT = struct.Struct('=LHHLL')
+
+# a link going up sends a burst of messages, they are collected for this long and handled with one discovery
+_EVENT_SETTLE_TIME = 0.1
+
+_discovery_lock = threading.Lock()
+_discovered = None
+_monitor = None
+
+def _darwin_get_all_network_devices():
+    output = _call_external_command('networksetup -listallhardwareports')
+    name, mac = None, None
+    for line in output:
+        port_match = re.search(r'^Hardware Port:\s*(?P<port>.*)', line.strip())
+        if port_match:
+            name = port_match.group('port').strip()
+        mac_match = re.search(r'^Ethernet Address:\s*(?P<mac>.*)', line.strip())
+        if mac_match:
+            mac = mac_match.group('mac').strip()
+        if name and mac:
+            yield (name, mac)
+            name, mac = None, None
+
+def _darwin_get_ip_address(service_name):
+    command = f'networksetup -getinfo \"{service_name}\"'
+    output = _call_external_command(command)
+    ip, router = None, None
+    for line in output:
+        ip_match = re.search(f'^IP address:\\s*(?P<ip>{_IPV4_ADDRESS_REGEX})', line.strip())
+        if ip_match:
+            ip = ipaddress.ip_address(ip_match.group('ip'))
+        router_match = re.search(f'^Router:\\s*(?P<router>{_IPV4_ADDRESS_REGEX})', line.strip())
+        if router_match:
+            router = ipaddress.ip_address(router_match.group('router'))
+    return ip if ip and router else None
+
+def _darwin_find_network_devices():
+    devices = list(_darwin_get_all_network_devices())
+    if not devices:
+        return []
+    # one networksetup per port, they are run at the same time rather than one after the other
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        ips = list(executor.map(_darwin_get_ip_address, [name for name, mac in devices]))
+    return [NetworkInfo(name, ip, mac) for (name, mac), ip in zip(devices, ips) if ip]
+
+def _linux_find_network_devices():
+    # psutil is only needed on linux and is slow to import, it is imported here rather than by everything using this
+    import psutil
+    infos = []
+    nics = psutil.net_if_addrs()
+    for name, addresses in nics.items():
+        _verbose_print(f'name: {name}')
+        ip, mac = None, None
+        for address in addresses:
+            _verbose_print(f'address: {address}')
+            ip_type = ''
+            try:
+                if address.family == socket.AF_INET:
+                    ip_type = 'IPv4'
+                    address_str = address.address if '%' not in address.address else address.address[:address.address.find('%')]
+                    ip = ipaddress.ip_address(address_str) if not address_str.startswith('127.') else None
+                if address.family == socket.AF_INET6 and not ip:
+                    ip_type = 'IPv6'
+                    address_str = address.address
+                    if '%' in address.address:
+                        address_str = address.address[:address.address.find('%')]
+                    ip = ipaddress.ip_address(address_str) if not address_str.startswith('::1') else None
+                if address.family == psutil.AF_LINK:
+                    mac = address.address
+            except ValueError as e:
+                _error_print(f'{address.address} is not a valid {ip_type} address')
+            if name and ip and mac:
+                infos.append(NetworkInfo(name, ip, mac))
+                break
+        _verbose_print('')
+    return infos
+
+def discover_network_infos(refresh=False):
+    '''Returns the NetworkInfo of every interface with an address, reusing the last discovery while it is current.
+
+    The last discovery is current for DISCOVERY_MAX_AGE seconds, or for as long as a running NetworkMonitor has not
+    seen a change.  Threads asking at the same time share one discovery.
+    '''
+    global _discovered
+    with _discovery_lock:
+        monitored = _monitor is not None and _monitor.running
+        current = _discovered is not None and (monitored or time.monotonic() - _discovered[0] < DISCOVERY_MAX_AGE)
+        if refresh or not current:
+            infos = _darwin_find_network_devices() if sys.platform == 'darwin' else _linux_find_network_devices()
+            _discovered = (time.monotonic(), infos)
+            _verbose_print(f'number of network devices: {len(infos)}')
+        return list(_discovered[1])
+
+def _parse_netlink_message_types(data):
+    offset = 0
+    while offset + _NLMSGHDR_STRUCT.size <= len(data):
+        length, message_type, flags, sequence, pid = _NLMSGHDR_STRUCT.unpack_from(data, offset)
+        if length < _NLMSGHDR_STRUCT.size:
+            break
+        yield message_type
+        # messages are aligned to 4 bytes
+        offset += (length + 3) & ~3
+
+class NetworkMonitor:
+    '''Keeps the discovered interfaces current from rtnetlink link and address events instead of polling (linux only).
+
+    Every change triggers one discovery whose result is passed to callback.  While the monitor runs
+    discover_network_infos keeps returning the last discovery no matter how old it is.
+    '''
+    def __init__(self, callback=None):
+        self._callback = callback
+        self._socket = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def is_supported():
+        return hasattr(socket, 'AF_NETLINK')
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self._socket.bind((0, _RTMGRP_LINK | _RTMGRP_IPV4_IFADDR | _RTMGRP_IPV6_IFADDR))
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='network-monitor', daemon=True)
+        self._thread.start()
+        # anything which changed before the socket was bound is picked up by a fresh discovery
+        discover_network_infos(refresh=True)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _read_changes(self, timeout):
+        '''Returns True when a link or address message arrived within timeout seconds.'''
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        if not readable:
+            return False
+        data = self._socket.recv(65536)
+        changed = any(message_type in (_RTM_NEWLINK, _RTM_DELLINK, _RTM_NEWADDR, _RTM_DELADDR)
+                      for message_type in _parse_netlink_message_types(data))
+        _verbose_print(f'rtnetlink message of {len(data)} bytes, changed: {changed}')
+        return changed
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if not self._read_changes(0.5):
+                    continue
+                while self._read_changes(_EVENT_SETTLE_TIME):
+                    pass
+                infos = discover_network_infos(refresh=True)
+            except OSError as err:
+                _error_print(f'network monitor failed: {err}')
+                return
+            if self._callback is not None:
+                self._callback(infos)
+
+def start_network_monitor(callback=None):
+    '''Starts the process wide NetworkMonitor, returns it or None when rtnetlink is not available.'''
+    global _monitor
+    if _monitor is not None and _monitor.running:
+        return _monitor
+    if not NetworkMonitor.is_supported():
+        return None
+    monitor = NetworkMonitor(callback)
+    try:
+        monitor.start()
+    except OSError as err:
+        _error_print(f'unable to listen for network changes: {err}')
+        return None
+    _monitor = monitor
+    return _monitor
+
 class NetworkInfos:
-    def __init__(self):
-        self._infos = []
+    def __init__(self, refresh=False):
+        self._infos = discover_network_infos(refresh)
         self._index = -1
-        if sys.platform != 'darwin':
-            self.__linux_find_network_devices()
-        else:
-            self.__darwin_find_network_devices()
-        _verbose_print(f'number of networ devices: {len(self._infos)}')
 
     def __iter__(self):
         if len(self._infos) > 0:
@@ -97,69 +289,6 @@ class NetworkInfos:
     def __len__(self):
         return len(self._infos)
 
-    def __darwin_get_all_network_devices(self):
-        output = _call_external_command('networksetup -listallhardwareports')
-        name, mac = None, None
-        for line in output:
-            port_match = re.search(r'^Hardware Port:\s*(?P<port>.*)', line.strip())
-            if port_match:
-                name = port_match.group('port').strip()
-            mac_match = re.search(r'^Ethernet Address:\s*(?P<mac>.*)', line.strip())
-            if mac_match:
-                mac = mac_match.group('mac').strip()
-            if name and mac:
-                yield (name, mac)
-                name, mac = None, None
-
-    def __darwin_get_ip_address(self, service_name):
-        command = f'networksetup -getinfo \"{service_name}\"'
-        output = _call_external_command(command)
-        IPv4_ADDRESS_REGEX = r'\b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)'
-        ip, router = None, None
-        for line in output:
-            ip_match = re.search(f'^IP address:\s*(?P<ip>{IPv4_ADDRESS_REGEX})', line.strip())
-            if ip_match:
-                ip = ipaddress.ip_address(ip_match.group('ip'))
-            router_match = re.search(f'^Router:\s*(?P<router>{IPv4_ADDRESS_REGEX})', line.strip())
-            if router_match:
-                router = ipaddress.ip_address(router_match.group('router'))
-        return ip if ip and router else None
-
-    def __darwin_find_network_devices(self):
-        for (name, mac) in self.__darwin_get_all_network_devices():
-            ip = self.__darwin_get_ip_address(name)
-            if not ip:
-                continue
-            self._infos.append(NetworkInfo(name, ip, mac))
-
-    def __linux_find_network_devices(self):
-        nics = psutil.net_if_addrs()
-        for name, addresses in nics.items():
-            _verbose_print(f'name: {name}')
-            ip, mac = None, None
-            for address in addresses:
-                _verbose_print(f'address: {address}')
-                ip_type = ''
-                try:
-                    if address.family == socket.AF_INET:
-                        ip_type = 'IPv4'
-                        address_str = address.address if '%' not in address.address else address.address[:address.address.find('%')]
-                        ip = ipaddress.ip_address(address_str) if not address_str.startswith('127.') else None
-                    if address.family == socket.AF_INET6 and not ip:
-                        ip_type = 'IPv6'
-                        address_str = address.address
-                        if '%' in address.address:
-                            address_str = address.address[:address.address.find('%')]
-                        ip = ipaddress.ip_address(address_str) if not address_str.startswith('::1') else None
-                    if address.family == psutil.AF_LINK:
-                        mac = address.address
-                except ValueError as e:
-                    _error_print(f'{address.address} is not a valid {ip_type} address')
-                if name and ip and mac:
-                    self._infos.append(NetworkInfo(name, ip, mac))
-                    break
-            _verbose_print('')
-
     def __str__(self):
         s = ''
         for info in self._infos:
@@ -169,7 +298,7 @@ class NetworkInfos:
 class SystemInfo:
     def __init__(self):
         self._hostname = socket.gethostname()
-        self._public_ip = location_info.get_ip_address()
+        self._public_ip = None
         self._network_infos = NetworkInfos()
 
     @property
@@ -187,6 +316,10 @@ class SystemInfo:
 
     @property
     def public_ip(self):
+        # looked up on first use, the lookup is a network call and most callers only want the interfaces
+        if self._public_ip is None:
+            import location_info
+            self._public_ip = location_info.get_ip_address()
         return str(self._public_ip)
 
     @property
@@ -207,12 +340,13 @@ def _get_label(label_str):
 def _get_value(value_str):
     return am.ansistring(f'<value>{value_str}</value>')
 
-def _get_formatted_system_info():
+def _get_formatted_system_info(public_ip=True):
     system_info = SystemInfo()
     info = []
     info.append((_get_label('Hostname:'), _get_value(system_info.hostname)))
     info.append((_get_label('Computer Name:'), _get_value(system_info.computer_name)))
-    info.append((_get_label('Public IP:'), _get_value(system_info.public_ip)))
+    if public_ip:
+        info.append((_get_label('Public IP:'), _get_value(system_info.public_ip)))
     for network_info in system_info.network_infos:
         info.append((_get_label(f'IP Address {network_info.name}:'), _get_value(network_info.ip)))
         info.append((_get_label(f'IP Address {network_info.name}:'), _get_value(network_info.mac)))
@@ -221,17 +355,38 @@ def _get_formatted_system_info():
 def _parse_args():
     parser = argparse.ArgumentParser(description='Output or return various IP and Mac address info on the current system')
     parser.add_argument('-v', '--verbose', action="store_true", help='increase output verbosity')
+    parser.add_argument('-w', '--watch', action="store_true", help='keep running and print the interfaces again whenever they change')
     args = parser.parse_args()
     global _VERBOSE
     _VERBOSE = args.verbose
+    return args.watch
+
+def _print_system_info(public_ip=True):
+    infos = _get_formatted_system_info(public_ip)
+    max_label_width = max([len(am.strip(label)) for (label, value) in infos])
+    for (label, value) in infos:
+        print(f'{label:{max_label_width}} {value}')
+
+def _watch_network_infos():
+    changed = threading.Event()
+    if start_network_monitor(lambda infos: changed.set()) is None:
+        _error_print('watching for network changes needs rtnetlink (linux)')
+        return 1
+    try:
+        while True:
+            changed.wait()
+            changed.clear()
+            print('')
+            _print_system_info(public_ip=False)
+    except KeyboardInterrupt:
+        return 0
 
 def main():
-    _parse_args()
+    watch = _parse_args()
     try:
-        infos = _get_formatted_system_info()
-        max_label_width = max([len(am.strip(label)) for (label, value) in infos])
-        for (label, value) in infos:
-            print(f'{label:{max_label_width}} {value}')
+        _print_system_info()
+        if watch:
+            return _watch_network_infos()
     except:
         _error_print('network_info failed -- uncomment traceback info to fix')
         #exc_type, exc_value, exc_traceback = sys.exc_info()
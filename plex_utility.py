@@ -2,13 +2,16 @@
 # vim:softtabstop=4:ts=4:sw=4:expandtab:tw=120
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 import sys
 import re
-import tempfile
 import traceback
 
+import custom_utils
+import media_file_types
+
 gVerbose = 0
 
 def enum(**enums):
@@ -60,152 +63,121 @@ def _parse_args():
     parser.add_argument('-v', '--verbose', action='count', default=0, help='output verbose debugging information')
     parser.add_argument('-d', '--media_dir', metavar='<dir>', default=os.getcwd(), type=_is_directory, help='directory where media files exist')
     parser.add_argument('-r', '--recurse', default=False, action='store_true', help='Switch whether it traverses sub directories')
+    parser.add_argument('-c', '--clean', default=False, action='store_true', help='remove the .DS_Store and ._ junk files')
+    parser.add_argument('-n', '--dry-run', default=False, action='store_true', help='with --clean only report what would be removed')
     args = parser.parse_args()
     global gVerbose
     gVerbose = args.verbose
     _validate_log_severity(gVerbose)
-    log(LogSeverity.INFO, 'Arguments:\n verbose: %d\n media directory: %s\n recurse: %s', gVerbose, args.media_dir, args.recurse)
-    return args.media_dir, args.recurse
-
-def IsDsStore(filename):
-    with open(filename, 'r+b') as store:
-        store.seek(0x54, os.SEEK_SET)
-        signature = bytearray(store.read(4))
-        #print(signature.decode("utf-8"))
-        #print(len(signature.decode("utf-8")))
-        ret = signature.decode("utf-8") == 'ATTR'
-        if not ret:
-            log(LogSeverity.ERROR, 'The name is correct but it doesn\'t have ATTR in data ({})'.format(filename))
-        return ret
-
-def IsDataStore(filename):
-    with open(filename, 'r+b') as store:
-        store.seek(0x04, os.SEEK_CUR)
-        signature = bytearray(store.read(4))
-        #print(signature.decode("utf-8"))
-        #print(len(signature).decode("utf-8"))
-        ret = signature.decode("utf-8") == 'Bud1'
-        if not ret:
-            log(LogSeverity.ERROR, 'The name is correct but it doesn\'t have Bud1 in data ({})'.format(filename))
-        return ret
-
-def _is_os_meta_file(filename):
-    if os.path.basename(filename).startswith('.DS_Store'):
-        return IsDataStore(filename)
-    elif os.path.basename(filename).startswith('._') or os.path.basename(filename).startswith('._.DS_Store'):
-        return IsDsStore(filename)
-
-def _is_media_file(filename):
-    return (filename.endswith('.mkv') or filename.endswith('.mp4') or filename.endswith('.m4v') or
-            filename.endswith('.avi') or filename.endswith('.srt') or filename.endswith('.idx') or
-            filename.endswith('.sub') or filename.endswith('.smi')) and not _is_os_meta_file(filename)
-
-def _dump_lists_to_file(media_files1, non_media_files1, media_files2, non_media_files2):
-    with tempfile.NamedTemporaryFile(mode='w+t', suffix='.txt', delete=True) as debug_file:
-        log(LogSeverity.INFO, 'Creating a temporary file %s with the input data' % debug_file.name)
-        debug_file.writelines(['MEDIA_FILES1', '\n'])
-        filenames = [filename + '\n' for filename in media_files1]
-        debug_file.writelines(filenames)
-        debug_file.writelines(['\n', '\n', 'MEDIA_FILES2', '\n'])
-        filenames = [filename + '\n' for filename in media_files2]
-        debug_file.writelines(filenames)
-        debug_file.writelines(['\n', '\n', 'NON_MEDIA_FILES1', '\n'])
-        filenames = [filename + '\n' for filename in non_media_files1]
-        debug_file.writelines(filenames)
-        debug_file.writelines(['\n', '\n', 'NON_MEDIA_FILES2', '\n'])
-        filenames = [filename + '\n' for filename in non_media_files2]
-        debug_file.writelines(filenames)
-
-def _validate_os_meta_file_finder(media_files1, non_media_files1, media_files2, non_media_files2):
-    if _get_log_severity() >= LogSeverity.DEBUG:
-        _dump_lists_to_file(media_files1, non_media_files1, media_files2, non_media_files2)
-
-    media_files1_count, media_files2_count = len(media_files1), len(media_files2)
-    count = max(media_files1_count, media_files2_count)
-    for i in range(count):
-        if i >= media_files1_count:
-            raise RuntimeError('Iterated directory and found more media files (%d, %d)' % (media_files1_count, media_files2_count))
-        if i >= media_files2_count:
-            raise RuntimeError('generated media files found more media files (%d, %d)' % (media_files1_count, media_files2_count))
-
-        media_file1, media_file2 = media_files1[i], media_files2[i]
-        if media_file1 != media_file2:
-            raise RuntimeError('media file at index %d are not equal (%s, %s)' % (i, media_file1, media_file2))
-
-    log(LogSeverity.INFO, 'the media files are what we expect')
-
-    non_media_files1_count, non_media_files2_count = len(non_media_files1), len(non_media_files2)
-    count = max(non_media_files1_count, non_media_files2_count)
-    for i in range(count):
-        if i >= non_media_files1_count:
-            raise RuntimeError('Iterated directory and found more meta files (%d, %d)' % (non_media_files1_count, non_media_files2_count))
-        if i >= non_media_files2_count:
-            raise RuntimeError('generated meta files found more meta files (%d, %d)' % (non_media_files1_count, non_media_files2_count))
-
-        non_media_file1, non_media_file2 = non_media_files1[i], non_media_files2[i]
-        if non_media_file1 != non_media_file2:
-            raise RuntimeError('meta file at index %d are not equal (%s, %s)' % (i, non_media_file1, non_media_file2))
-    
-    log(LogSeverity.INFO, 'the meta files are what we expect')
-
-
-def _get_valid_media_files(media_dir, recurse):
-    media_files = []
-    non_media_files = []
-    if recurse:
-        for root, dirs, files in os.walk(media_dir):
-            for filename in files:
-                if _is_media_file(os.path.join(root, filename)):
-                    media_files.append(os.path.join(root, filename))
-                else:
-                    non_media_files.append(os.path.join(root, filename))
-    else:
-        for filename in os.listdir(media_dir):
-            if _is_media_file(os.path.join(media_dir, filename)):
-                media_files.append(os.path.join(media_dir, filename))
-            else:
-                non_media_files.append(os.path.join(media_dir, filename))
-    media_files.sort()
-    non_media_files.sort()
-    return media_files, non_media_files
-
-
-def _get_media_files(media_dir, recurse):
-    media_files = []
-    non_media_files = []
-    if recurse:
-        for root, dirs, files in os.walk(media_dir):
-            for filename in files:
-                if _is_os_meta_file(os.path.join(root, filename)):
-                    non_media_files.append(os.path.join(root, filename))
-                else:
-                    media_files.append(os.path.join(root, filename))
-    else:
-        for filename in os.listdir(media_dir):
-            if _is_os_meta_file(os.path.join(media_dir, filename)):
-                non_media_files.append(os.path.join(media_dir, filename))
-            else:
-                media_files.append(os.path.join(media_dir, filename))
+    log(LogSeverity.INFO, 'Arguments:\n verbose: %d\n media directory: %s\n recurse: %s\n clean: %s\n dry run: %s', gVerbose, args.media_dir, args.recurse, args.clean, args.dry_run)
+    return args.media_dir, args.recurse, args.clean, args.dry_run
 
-    media_files.sort()
-    non_media_files.sort()
+# plex reads these next to the media, everything else which is not media or junk is left alone and listed as other
+SIDECAR_EXTENSIONS = media_file_types.SUBTITLE_EXTENSIONS | frozenset(['.nfo', '.jpg', '.jpeg', '.png', '.tbn'])
 
-    media_files_check, non_media_files_check = _get_valid_media_files(media_dir, recurse)
+_APPLE_DOUBLE_MAGIC = b'\x00\x05\x16\x07'
+_DS_STORE_MAGIC = b'\x00\x00\x00\x01Bud1'
+_MAGIC_SIZE = 8
+_JUNK_BATCH_SIZE = 256
 
-    _validate_os_meta_file_finder(media_files, non_media_files, media_files_check, non_media_files_check)
+def _read_magic(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.pread(fd, _MAGIC_SIZE, 0)
+    finally:
+        os.close(fd)
 
-    return media_files, non_media_files
+def _is_junk_candidate(name):
+    return name.startswith('._') or name == '.DS_Store'
+
+def _is_junk_file(path, name):
+    '''The finder's .DS_Store and the AppleDouble ._ files it leaves on non apple file systems, told apart from files
+    which only have the name by their magic bytes.'''
+    try:
+        magic = _read_magic(path)
+    except OSError as err:
+        log(LogSeverity.ERROR, 'unable to read %s: %s', path, err)
+        return False
+    if name == '.DS_Store':
+        is_junk = magic == _DS_STORE_MAGIC
+    else:
+        is_junk = magic.startswith(_APPLE_DOUBLE_MAGIC)
+    if not is_junk:
+        log(LogSeverity.ERROR, 'The name is correct but it doesn\'t have the expected signature (%s)', path)
+    return is_junk
+
+class LibraryScan(object):
+    '''The files of a media directory by kind, each a list of (path, size).'''
+    def __init__(self):
+        self.media = []
+        self.sidecars = []
+        self.junk = []
+        self.other = []
+
+def scan_library(media_dir, recurse):
+    '''Classifies every file below media_dir in one walk, by extension, and only the junk candidates are opened.'''
+    scan = LibraryScan()
+    # nothing is pruned, the os meta files are exactly what gets checked
+    for entry in custom_utils.walk_directory(media_dir, prune=None, max_depth=None if recurse else 1, sort=True,
+                                             stat=True, workers=4):
+        if entry.is_dir():
+            continue
+        name = entry.name
+        item = (entry.path, entry.stat().st_size)
+        if _is_junk_candidate(name):
+            (scan.junk if _is_junk_file(entry.path, name) else scan.other).append(item)
+            continue
+        extension = os.path.splitext(name)[1].lower()
+        if extension in media_file_types.MEDIA_EXTENSIONS:
+            scan.media.append(item)
+        elif extension in SIDECAR_EXTENSIONS:
+            scan.sidecars.append(item)
+        else:
+            scan.other.append(item)
+    return scan
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError as err:
+        log(LogSeverity.ERROR, 'unable to remove %s: %s', path, err)
+        return False
+
+def remove_junk_files(junk, dry_run=False, batch_size=_JUNK_BATCH_SIZE):
+    '''Removes the junk files a batch at a time, each batch concurrently (they are usually on a network share where
+    every unlink is a round trip).  Returns the number of files and bytes removed.'''
+    removed_count, removed_size = 0, 0
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for start in range(0, len(junk), batch_size):
+            batch = junk[start:start + batch_size]
+            if dry_run:
+                results = [True] * len(batch)
+            else:
+                results = list(executor.map(_remove_file, [path for path, _ in batch]))
+            removed_count += results.count(True)
+            removed_size += sum(size for (_, size), removed in zip(batch, results) if removed)
+            log(LogSeverity.INFO, '%s %d of %d junk files', 'would remove' if dry_run else 'removed',
+                start + len(batch), len(junk))
+    return removed_count, removed_size
+
+def _print_files(title, files):
+    print('\n%s:' % title)
+    for filename, size in files:
+        print('{} - {}'.format(filename, sizeof_fmt(size)))
+    print('%d files, %s' % (len(files), sizeof_fmt(sum(size for _, size in files))))
 
 def main():
-    media_dir, recurse = _parse_args()
+    media_dir, recurse, clean, dry_run = _parse_args()
     try:
-        media_files, non_media_files = _get_media_files(media_dir, True)
-        print('\nMedia Files:')
-        for filename in media_files:
-            print(filename)
-        print('\nNON Media Files:')
-        for filename in non_media_files:
-            print('{} - {}'.format(filename, sizeof_fmt(os.stat(filename).st_size)))
+        scan = scan_library(media_dir, recurse)
+        _print_files('Media Files', scan.media)
+        _print_files('Sidecar Files', scan.sidecars)
+        _print_files('Junk Files', scan.junk)
+        _print_files('Other Files', scan.other)
+        if clean:
+            count, size = remove_junk_files(scan.junk, dry_run)
+            print('\n%s %d junk files, %s' % ('Would remove' if dry_run else 'Removed', count, sizeof_fmt(size)))
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stdout)
@@ -2,14 +2,33 @@
 # vim: aw:sts=4:ts=4:sw=4:et:cin:fdm=manual:tw=120:ft=python
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
+from pymediainfo import MediaInfo
 import re
-import shlex
-import subprocess
 import sys
 import traceback
 
 from app_settings import app_settings
+import custom_utils
+
+_SUBTITLE_EXTENSIONS = {'.srt', '.ass', '.ssa'}
+_VIDEO_EXTENSIONS = {'.mkv', '.mp4', '.m4v', '.avi', '.mov', '.wmv', '.mpg', '.mpeg', '.webm'}
+
+# the old check wanted 1000 lines, about 250 cues, it is only used when there is no video to compare the cues with
+_MIN_CUES_WITHOUT_VIDEO = 250
+# a subtitle for the video ends somewhere in its second half and not more than a minute after it
+_MIN_COVERAGE = 0.5
+_MAX_OVERRUN_SECONDS = 60.0
+# ass events do not have to be in order so only srt cues are checked for starting before the previous one
+_MAX_DISORDERED_FRACTION = 0.05
+_MAX_BAD_TIMING_FRACTION = 0.05
+
+_SRT_TIMING_REGEX = re.compile(r'^\s*(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})\s*-->\s*'
+                               r'(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})')
+_ASS_DIALOGUE_REGEX = re.compile(r'^Dialogue:\s*[^,]*,\s*(\d+):(\d{1,2}):(\d{1,2})\.(\d{1,3})\s*,\s*'
+                                 r'(\d+):(\d{1,2}):(\d{1,2})\.(\d{1,3})')
 
 def _is_valid_directory(dir_name):
     if os.path.isdir(dir_name):
@@ -20,46 +39,150 @@ def _parse_args():
     parser = argparse.ArgumentParser(description='Find all of the subtitle files which are invalid')
     parser.add_argument('-v', '--verbose', action='count', default=0, help='increase output verbosity')
     parser.add_argument('-l', '--live-run', action="store_true", help='remove all of the invalid subtitle')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of subtitles checked at once')
     parser.add_argument('directories', metavar='PATH', type=_is_valid_directory, nargs='+', help='one or more directories to search for invalid subtitles')
     args = parser.parse_args()
     app_settings.update(vars(args))
     app_settings.print_settings(print_always=False)
 
-def _get_subtitle_filenames(dir_name):
-    for root, dirs, files in os.walk(dir_name):
-        for file_name in files:
-            _, ext = os.path.splitext(file_name)
-            if ext == '.srt':
-                yield os.path.abspath(os.path.join(root, file_name))
-
-def _get_subtitle_line_count(filename):
-    args = shlex.split('wc -l "{}"'.format(filename))
-    process = subprocess.Popen(args, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
-    if process.wait() != 0:
-        app_settings.error(f'{error} while getting line count on {filename}')
-    match = re.match(r'^(?P<count>\d+)\s+.*$', output.strip())
-    line_count = int(match.group('count')) if match else 0
-    return line_count
+def _get_extension(name):
+    return os.path.splitext(name)[1].lower()
+
+def _is_subtitle_or_video_entry(entry):
+    ext = _get_extension(entry.name)
+    return ext in _SUBTITLE_EXTENSIONS or ext in _VIDEO_EXTENSIONS
+
+def _get_subtitle_and_video_filenames(dir_name):
+    '''Returns the subtitle files and, by directory, the video files found in one walk.'''
+    subtitles = []
+    videos = {}
+    for entry in custom_utils.walk_directory(dir_name, predicate=_is_subtitle_or_video_entry):
+        filename = os.path.abspath(entry.path)
+        if _get_extension(entry.name) in _SUBTITLE_EXTENSIONS:
+            subtitles.append(filename)
+        else:
+            videos.setdefault(os.path.dirname(filename), []).append(filename)
+    return subtitles, videos
+
+def _is_name_of(video_name, subtitle_name):
+    return subtitle_name == video_name or subtitle_name.startswith(video_name + '.')
+
+def _find_video_filename(filename, videos):
+    '''The video whose name starts the subtitle's name up to a dot ("Movie.mkv" for "Movie.en.srt" but not for
+    "Movie 2.en.srt"), the longest one if several do, otherwise the only video in the directory.'''
+    candidates = videos.get(os.path.dirname(filename), [])
+    name = os.path.splitext(os.path.basename(filename))[0]
+    matches = [video for video in candidates if _is_name_of(os.path.splitext(os.path.basename(video))[0], name)]
+    if matches:
+        return max(matches, key=len)
+    return candidates[0] if len(candidates) == 1 else None
+
+@functools.lru_cache(maxsize=1024)
+def _get_video_duration(filename):
+    '''Returns the video's length in seconds, None when MediaInfo does not know it.'''
+    try:
+        media_info = MediaInfo.parse(filename)
+    except Exception as err:
+        app_settings.error(f'{err} while getting the duration of {filename}')
+        return None
+    for track in media_info.tracks:
+        if track.track_type == 'General' and track.duration is not None:
+            try:
+                return float(track.duration) / 1000.0
+            except ValueError:
+                app_settings.error(f'{filename} has an unreadable duration {track.duration!r}')
+                return None
+    return None
+
+def _open_subtitle(filename):
+    with open(filename, 'rb') as subtitle_file:
+        bom = subtitle_file.read(2)
+    encoding = 'utf-16' if bom in (b'\xff\xfe', b'\xfe\xff') else 'utf-8-sig'
+    # only the timings are read so text in some other codepage does not matter
+    return open(filename, encoding=encoding, errors='replace')
+
+def _to_seconds(hours, minutes, seconds, fraction):
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(fraction) / 10 ** len(fraction)
+
+class SubtitleStats:
+    def __init__(self, filename):
+        self.filename = filename
+        self.cues = 0
+        self.disordered = 0
+        self.bad_timings = 0
+        self.last_end = 0.0
+        self._previous_start = None
+
+    def add_cue(self, start, end):
+        self.cues += 1
+        if end < start:
+            self.bad_timings += 1
+        if self._previous_start is not None and start < self._previous_start:
+            self.disordered += 1
+        self._previous_start = start
+        self.last_end = max(self.last_end, end)
+
+def parse_subtitle(filename):
+    '''Reads the cue timings of an srt or ass/ssa file line by line into a SubtitleStats.'''
+    stats = SubtitleStats(filename)
+    regex = _SRT_TIMING_REGEX if _get_extension(filename) == '.srt' else _ASS_DIALOGUE_REGEX
+    with _open_subtitle(filename) as subtitle_file:
+        for line in subtitle_file:
+            match = regex.match(line)
+            if match:
+                groups = match.groups()
+                stats.add_cue(_to_seconds(*groups[:4]), _to_seconds(*groups[4:]))
+    return stats
+
+def _get_invalid_reason(stats, video_duration):
+    '''Returns why the subtitle is invalid, None when it looks like a complete subtitle for the video.'''
+    if stats.cues == 0:
+        return 'no cues'
+    if stats.bad_timings > stats.cues * _MAX_BAD_TIMING_FRACTION:
+        return f'{stats.bad_timings} of {stats.cues} cues end before they start'
+    if _get_extension(stats.filename) == '.srt' and stats.disordered > stats.cues * _MAX_DISORDERED_FRACTION:
+        return f'{stats.disordered} of {stats.cues} cues start before the previous one'
+    if video_duration is None:
+        if stats.cues < _MIN_CUES_WITHOUT_VIDEO:
+            return f'only {stats.cues} cues and no video to compare them with'
+        return None
+    if stats.last_end < video_duration * _MIN_COVERAGE:
+        return f'the cues end at {stats.last_end:.0f}s of the {video_duration:.0f}s video'
+    if stats.last_end > video_duration + _MAX_OVERRUN_SECONDS:
+        return f'the cues run until {stats.last_end:.0f}s, after the {video_duration:.0f}s video ends'
+    return None
+
+def check_subtitle(filename, video_filename=None):
+    '''Returns (filename, reason), the reason is None for a valid subtitle.'''
+    try:
+        stats = parse_subtitle(filename)
+    except OSError as err:
+        return filename, f'unreadable, {err}'
+    video_duration = _get_video_duration(video_filename) if video_filename else None
+    app_settings.debug(f'File: {filename}\n    : {stats.cues} cues ({stats.disordered} out of order) ending at '
+                       f'{stats.last_end:.0f}s, video: {video_filename} {video_duration}s')
+    return filename, _get_invalid_reason(stats, video_duration)
 
 def _get_invalid_subtitle_filenames(dir_name):
-    for filename in _get_subtitle_filenames(dir_name):
-        app_settings.debug(f'File: {filename}')
-        line_count = _get_subtitle_line_count(filename)
-        app_settings.debug(f'File: {filename}\n    : {line_count} lines')
-        if line_count < 1000:
-            app_settings.info(f'{line_count} - {filename} INVALID')
-            yield filename
+    subtitles, videos = _get_subtitle_and_video_filenames(dir_name)
+    with ThreadPoolExecutor(max_workers=app_settings.jobs) as executor:
+        futures = [executor.submit(check_subtitle, filename, _find_video_filename(filename, videos))
+                   for filename in subtitles]
+        for future in futures:
+            filename, reason = future.result()
+            if reason is not None:
+                app_settings.info(f'{filename} INVALID: {reason}')
+                yield filename
 
 def remove_invalid_subtitles(dir_name):
     for filename in _get_invalid_subtitle_filenames(dir_name):
         if app_settings.live_run:
             try:
                 app_settings.info(f'{filename} live run -- deleting')
-                os.remove(path)
+                os.remove(filename)
                 app_settings.info(f'{filename} live run -- deleted')
             except OSError as e:
-                app_settings.error(f'{e.code} - {e.stderr} file: {filename}')
+                app_settings.error(f'{e} file: {filename}')
         else:
             app_settings.info(f'{filename} dry run -- doing nothing')
 
@@ -3,6 +3,7 @@
 
 from ansimarkup import AnsiMarkup, parse
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import json
 import os
 from pymediainfo import MediaInfo
@@ -11,8 +12,12 @@ import shlex
 import shutil
 import subprocess
 import sys
+import threading
+import time
 import traceback
 
+import media_index
+
 user_tags = {
     'info'   : parse('<bold><cyan>'),
     'text'   : parse('<bold><white>'),
@@ -24,6 +29,10 @@ am = AnsiMarkup(tags=user_tags)
 
 _COUNTER_WIDTH = 2
 _VERBOSE = False
+# MediaInfo.parse is cpu bound so the scan uses every core, the remux is disk bound and two ffmpeg copies already
+# saturate most single disks
+_DEFAULT_SCAN_WORKERS = os.cpu_count() or 1
+_DEFAULT_REMUX_WORKERS = 2
 _EXTENSIONS = ['.webm', '.mpg', '.mp2', '.mpeg',
                '.mpe', '.mpv', '.ogg', '.mp4',
                '.m4p', '.m4v', '.avi', '.wmv',
@@ -58,7 +67,9 @@ def _call_external_process(command, dry_run):
             _status_print(f'dry-run skipping: \'{command}\'')
         else:
             _verbose_print(f'executing \'{command}\'')
-            subprocess.run(args, check=True, encoding='utf-8', stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            # several ffmpeg run at once, none of them may read (and steal) the terminal's input
+            subprocess.run(args, check=True, encoding='utf-8', stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
         return True
     except subprocess.SubprocessError as err:
         _error_print(f'error executing \'{command}\', {err}')
@@ -96,6 +107,7 @@ def _parse_args():
     parser = argparse.ArgumentParser(description='Given a directory or list of files it will remove the metadata in various video files')
     parser.add_argument('-V', '--version', action='version', version='%(prog)s 0.0.16')
     parser.add_argument('-v', '--verbose', action="store_true", help='increase output verbosity')
+    parser.add_argument('-i', '--index', nargs='?', const=media_index.DEFAULT_DB_PATH, default=None, metavar='<DB PATH>', help=f'read the metadata from the media index (default {media_index.DEFAULT_DB_PATH}), only new or changed files are parsed')
 
     subparsers = parser.add_subparsers(metavar="{action}", dest='subcommand', required=True, help='commands to show/remove movie metadata')
 
@@ -106,6 +118,8 @@ def _parse_args():
     remove_metadata_parser = subparsers.add_parser('remove', description=remove_metadata_description, help='remove movie metadata')
     remove_metadata_parser.add_argument('-s', '--simulated-run', dest='dry_run', action="store_true", help='identify extraneous metadata but DO NOT remove it')
     remove_metadata_parser.add_argument('-F', '--force', dest='force', action="store_true", help='force all files to be re-written using ffmpeg')
+    remove_metadata_parser.add_argument('-j', '--scan-jobs', dest='scan_workers', type=int, default=_DEFAULT_SCAN_WORKERS, help=f'processes scanning for metadata (default {_DEFAULT_SCAN_WORKERS})')
+    remove_metadata_parser.add_argument('-r', '--remux-jobs', dest='remux_workers', type=int, default=_DEFAULT_REMUX_WORKERS, help=f'ffmpeg processes rewriting files at once, size it to the disk bandwidth (default {_DEFAULT_REMUX_WORKERS})')
 
     sources_group = parser.add_mutually_exclusive_group(required=True)
     sources_group.add_argument('-d', '--dir', dest='dirs', type=_is_valid_directory, action='append', help='source directory to locate movie files')
@@ -121,8 +135,10 @@ def _parse_args():
             file_paths += [file_path for file_path in _find_video_files(dir)]
     dry_run = False if args.subcommand == 'show' else args.dry_run
     force = False if args.subcommand == 'show' else args.force
+    scan_workers = 1 if args.subcommand == 'show' else max(1, args.scan_workers)
+    remux_workers = 1 if args.subcommand == 'show' else max(1, args.remux_workers)
 
-    return args.subcommand, file_paths, dry_run, force
+    return args.subcommand, file_paths, dry_run, force, scan_workers, remux_workers, args.index
 
 class MediaMetadataParser:
     # Video & Audio Tracks will often have a title or title_name metadata field. This will indicate the type
@@ -134,8 +150,9 @@ class MediaMetadataParser:
     NonGeneralMetadataFields = {'movie', 'movie_name', 'season', 'part', 'performer', 'composer', 'genre', 'contenttype', 'description', 'comment'}
     TrackNames = ['General', 'Video', 'Audio']
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, index=None):
         self._file_path = file_path
+        self._index = index
         self._media_info = None
         self._metadata = {}
         self._json_metadata = None
@@ -173,10 +190,13 @@ class MediaMetadataParser:
 
     def _parse(self):
         try:
-            self._media_info = MediaInfo.parse(self._file_path)
+            if self._index is not None:
+                self._media_info = self._index.get_media_info(str(self._file_path))
+            else:
+                self._media_info = MediaInfo.parse(self._file_path)
             return True
         except Exception as ex:
-            _error_print('MediaInfo parse raised exception {ex}')
+            _error_print(f'MediaInfo parse raised exception {ex}')
             return False
 
     def _are_all_expected_tracks_available(self):
@@ -237,20 +257,127 @@ class MediaMetadataParser:
         else:
             return self._json_metadata if self._json_metadata else ''
 
-def get_files_with_metadata(file_paths, force):
+class PipelineStats:
+    '''Counters and per stage timings of remove_metadata_from_files, updated from the scan and remux threads.'''
+    def __init__(self, total):
+        self.total = total
+        self.scanned = 0
+        self.with_metadata = 0
+        self.scan_failures = 0
+        self.rewritten = 0
+        self.remux_failures = 0
+        self.bytes_written = 0
+        self.scan_seconds = 0.0
+        self.remux_seconds = 0.0
+        self.scan_wall_seconds = 0.0
+        self.remux_wall_seconds = 0.0
+        self.lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._remux_start = None
+
+    def counter(self, count, total=None):
+        total = total if total is not None else self.total
+        width = max(_COUNTER_WIDTH, len(str(self.total)))
+        return f'[{count:>{width}}/{total}]'
+
+    def scan_done(self, has_metadata, failed, seconds):
+        with self.lock:
+            self.scanned += 1
+            self.with_metadata += int(has_metadata)
+            self.scan_failures += int(failed)
+            self.scan_seconds += seconds
+            return self.scanned
+
+    def remux_started(self):
+        with self.lock:
+            if self._remux_start is None:
+                self._remux_start = time.perf_counter()
+
+    def remux_done(self, bytes_written, seconds):
+        with self.lock:
+            if bytes_written is None:
+                self.remux_failures += 1
+            else:
+                self.rewritten += 1
+                self.bytes_written += bytes_written
+            self.remux_seconds += seconds
+            self.remux_wall_seconds = time.perf_counter() - self._remux_start
+            return self.rewritten + self.remux_failures
+
+    def scan_finished(self):
+        self.scan_wall_seconds = time.perf_counter() - self._start
+
+    def print_summary(self):
+        elapsed = time.perf_counter() - self._start
+        _status_print('summary:', True)
+        _status_print(f'  files scanned:       {self.scanned} of {self.total} ({self.scan_failures} failed)')
+        _status_print(f'  files with metadata: {self.with_metadata}')
+        _status_print(f'  files rewritten:     {self.rewritten} ({self.remux_failures} failed)')
+        _status_print(f'  bytes written:       {self.bytes_written:,}')
+        _status_print(f'  scan:                {self.scan_wall_seconds:.1f} sec ({self.scan_seconds:.1f} sec across workers)')
+        _status_print(f'  remux:               {self.remux_wall_seconds:.1f} sec ({self.remux_seconds:.1f} sec across workers)')
+        _status_print(f'  total:               {elapsed:.1f} sec')
+
+def _init_scan_worker(verbose):
+    # spawned (rather than forked) workers do not inherit the flag
+    global _VERBOSE
+    _VERBOSE = verbose
+
+def _scan_file(file_path):
+    '''Runs in a scan worker process, returns (file path, has metadata, printable metadata, seconds).'''
+    start = time.perf_counter()
+    media_metadata_parser = MediaMetadataParser(file_path)
+    has_metadata = media_metadata_parser.has_metadata()
+    return file_path, has_metadata, str(media_metadata_parser), time.perf_counter() - start
+
+def _scan_files_from_index(file_paths, index, workers):
+    '''Same results as the scan workers, read from the index once its new and changed files have been parsed.'''
+    index.refresh([str(file_path) for file_path in file_paths], workers)
+    _verbose_print(str(index))
     for file_path in file_paths:
-        _status_print(f'checking: "{file_path}"', True)
-        if force:
+        start = time.perf_counter()
+        media_metadata_parser = MediaMetadataParser(file_path, index)
+        has_metadata = media_metadata_parser.has_metadata()
+        yield file_path, has_metadata, str(media_metadata_parser), time.perf_counter() - start
+
+def get_files_with_metadata(file_paths, force, stats=None, workers=_DEFAULT_SCAN_WORKERS, index=None):
+    '''Yields the files which have extra metadata as the scan workers find them (every file when forced).'''
+    stats = stats if stats is not None else PipelineStats(len(file_paths))
+    if force:
+        for file_path in file_paths:
+            stats.scan_done(True, False, 0.0)
             _status_print(f'forced: "{file_path}"')
             yield file_path
-        else:
-            media_metadata_parser = MediaMetadataParser(file_path)
-            if not media_metadata_parser.has_metadata():
-                _status_print(f'NO extra metadata: "{file_path}"')
+        stats.scan_finished()
+        return
+    if index is not None:
+        for file_path, has_metadata, metadata, seconds in _scan_files_from_index(file_paths, index, workers):
+            count = stats.scan_done(has_metadata, False, seconds)
+            if not has_metadata:
+                _status_print(f'{stats.counter(count)} NO extra metadata: "{file_path}"')
                 continue
-            _status_print(f'HAS extra metadata: "{file_path}"')
-            _verbose_print(f'  metadata: {media_metadata_parser}')
+            _status_print(f'{stats.counter(count)} HAS extra metadata: "{file_path}"')
+            _verbose_print(f'  metadata: {metadata}')
             yield file_path
+        stats.scan_finished()
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_scan_worker, initargs=(_VERBOSE,)) as executor:
+        futures = {executor.submit(_scan_file, file_path): file_path for file_path in file_paths}
+        for future in as_completed(futures):
+            try:
+                file_path, has_metadata, metadata, seconds = future.result()
+            except Exception as err:
+                count = stats.scan_done(False, True, 0.0)
+                _error_print(f'{stats.counter(count)} scanning "{futures[future]}" failed, {err}')
+                continue
+            count = stats.scan_done(has_metadata, False, seconds)
+            if not has_metadata:
+                _status_print(f'{stats.counter(count)} NO extra metadata: "{file_path}"')
+                continue
+            _status_print(f'{stats.counter(count)} HAS extra metadata: "{file_path}"')
+            _verbose_print(f'  metadata: {metadata}')
+            yield file_path
+    stats.scan_finished()
 
 def _create_temp_path(file_path):
     updated_extension = f'.new{file_path.suffix}'
@@ -270,60 +397,94 @@ def _clean_up_on_error(file_path):
         _error_print(f'  unable to remove "{file_path}"', prefix=False)
 
 def _remove_metadata_from_file(file_path, dry_run):
+    '''Returns the number of bytes written (0 on a dry run), None when ffmpeg failed.  Raises OSError when the new
+    file cannot replace the original, the new file is removed first.'''
     _verbose_print(f'removing metadata: "{file_path}"')
     new_file_path = _create_temp_path(file_path)
     _verbose_print(f'temporary file: "{new_file_path}"')
-    command = f'ffmpeg -i "{file_path}" -map_chapters -1 -map_metadata -1 -c:v copy -c:a copy "{new_file_path}"'
+    command = f'ffmpeg -nostdin -i "{file_path}" -map_chapters -1 -map_metadata -1 -c:v copy -c:a copy "{new_file_path}"'
     if not _call_external_process(command, dry_run):
         _clean_up_on_error(new_file_path)
-        return False
+        return None
     _verbose_print(f'created "{new_file_path}" and removed the metadata')
+    bytes_written = 0
     if not dry_run:
-        shutil.move(new_file_path, file_path)
+        try:
+            bytes_written = os.path.getsize(new_file_path)
+            shutil.move(new_file_path, file_path)
+        except OSError:
+            _clean_up_on_error(new_file_path)
+            raise
     _verbose_print(f'moved "{new_file_path}" over top of "{file_path}"')
-    _status_print(f'removed metadata: "{file_path}"')
-    return True
+    return bytes_written
 
-def show_metadata_from_files(file_paths):
+def show_metadata_from_files(file_paths, index=None):
     for file_path in file_paths:
         _verbose_print(f'gathing metadata: "{file_path}"')
-        media_metadata_parser = MediaMetadataParser(file_path)
+        media_metadata_parser = MediaMetadataParser(file_path, index)
         if not media_metadata_parser.find_all_metadata():
             continue
         metadata_str = str(media_metadata_parser).replace('\n', '\n' + ' ' * 7)
         _status_print(f'metadata: "{file_path}"')
         _status_print(f'\n{" ":{7}}{metadata_str}')
 
-def remove_metadata_from_files(file_paths, force, dry_run):
-    retval = True
-    first = True
-    for file_path in get_files_with_metadata(file_paths, force):
-        if first: first = False
-        if not _remove_metadata_from_file(file_path, dry_run):
-            retval = False
-    return retval
+def _remux_file(file_path, dry_run, stats):
+    stats.remux_started()
+    start = time.perf_counter()
+    try:
+        bytes_written = _remove_metadata_from_file(file_path, dry_run)
+    except Exception as err:
+        # the file could not be moved over the original, it counts as a failed remux rather than ending the run
+        _error_print(f'unable to replace "{file_path}", {err}')
+        bytes_written = None
+    count = stats.remux_done(bytes_written, time.perf_counter() - start)
+    if bytes_written is not None:
+        # out of the files found with metadata so far, the scan may still be finding more
+        _status_print(f'{stats.counter(count, stats.with_metadata)} removed metadata: "{file_path}"')
+    return bytes_written is not None
+
+def remove_metadata_from_files(file_paths, force, dry_run, scan_workers=_DEFAULT_SCAN_WORKERS,
+                               remux_workers=_DEFAULT_REMUX_WORKERS, index=None):
+    '''Scans the files on a process pool and remuxes the ones with metadata on a separate, smaller thread pool as
+    soon as the scan finds them, so the disk is kept busy while the rest are still being scanned.'''
+    file_paths = list(file_paths)
+    stats = PipelineStats(len(file_paths))
+    with ThreadPoolExecutor(max_workers=remux_workers) as remux_executor:
+        remux_futures = [remux_executor.submit(_remux_file, file_path, dry_run, stats)
+                         for file_path in get_files_with_metadata(file_paths, force, stats, scan_workers, index)]
+        retval = all(future.result() for future in remux_futures)
+    stats.print_summary()
+    return retval and stats.scan_failures == 0
 
 def main():
-    command_name, file_paths, dry_run, force = _parse_args()
+    command_name, file_paths, dry_run, force, scan_workers, remux_workers, index_path = _parse_args()
     movie_files_str = ('\n' + ' ' * 15).join(map(str, file_paths))
     _verbose_print(f'args:\n' \
                    f'  sub-command: {command_name}\n'
                    f'  movie files: {movie_files_str}\n' \
                    f'  verbose: {_is_verbose_mode_on()}\n'
                    f'  dry run: {dry_run}\n' \
-                   f'  force: {force}')
+                   f'  force: {force}\n'
+                   f'  scan workers: {scan_workers}\n'
+                   f'  remux workers: {remux_workers}')
     retval = 0
+    index = None
     try:
+        if index_path:
+            index = media_index.MediaIndex(index_path)
         if command_name == 'show':
-            if not show_metadata_from_files(file_paths):
+            if not show_metadata_from_files(file_paths, index):
                 retval = 1
         elif command_name == 'remove':
-            if not remove_metadata_from_files(file_paths, force, dry_run):
+            if not remove_metadata_from_files(file_paths, force, dry_run, scan_workers, remux_workers, index):
                retval = 1
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
         retval = 1
+    finally:
+        if index is not None:
+            index.close()
     return retval
 
 if __name__ == '__main__':
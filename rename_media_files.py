@@ -18,9 +18,10 @@ def _parse_args():
     parser = argparse.ArgumentParser('rename media files')
     parser.add_argument('directory', metavar='<DIRECTORY>', type=_is_directory, help='directory to scan for media')
     parser.add_argument('-s', '--simulated', default=False, action='store_true', help='dry run the rename operation on the directory hierarchy')
+    parser.add_argument('-i', '--index', nargs='?', const=True, default=None, metavar='<DB PATH>', help='read the tags from the media index (default ~/.cache/media_index/media.db), only new or changed files are parsed')
     args = parser.parse_args()
     print('directory: {0}, simulated: {1}'.format(args.directory, args.simulated))
-    return args.directory, args.simulated
+    return args.directory, args.simulated, args.index
 
 def _find_media_files(directory):
     all_files = []
@@ -42,8 +43,8 @@ def _get_track_number(track_num):
     else:
         return int(track_num)
 
-def rename_media_file(filename, simulated):
-    info = mediainfo(filename)
+def rename_media_file(filename, simulated, index=None):
+    info = index.get_tag_info(filename) if index is not None else mediainfo(filename)
     track = _get_track_number(info['track'])
     artist = info['artist']
     title = info['title']
@@ -57,14 +58,24 @@ def rename_media_file(filename, simulated):
         print('no need to mv "{0}"'.format(os.path.basename(filename)))
 
 def main():
-    directory, simulated = _parse_args()
+    directory, simulated, index_path = _parse_args()
+    index = None
     try:
-        for filename in _find_media_files(directory):
-            rename_media_file(filename, simulated)
+        files = _find_media_files(directory)
+        if index_path:
+            # pymediainfo is only needed when the index is used
+            import media_index
+            index = media_index.MediaIndex(index_path if index_path is not True else media_index.DEFAULT_DB_PATH)
+            index.refresh(files)
+        for filename in files:
+            rename_media_file(filename, simulated, index)
     except Exception:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stdout)
         return 1
+    finally:
+        if index is not None:
+            index.close()
     return 0
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+import os, shutil, sys, tempfile, unittest
+
+sys.path.append( os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) )
+import custom_utils
+
+class TestPrunePatterns(unittest.TestCase):
+    def IsPruned(self, patterns, relpath, is_dir=False):
+        compiled = custom_utils.compile_prune_patterns(patterns)
+        return custom_utils._is_pruned(compiled, relpath.rsplit('/', 1)[-1], relpath, is_dir)
+
+    def testName(self):
+        self.assertTrue(self.IsPruned(['*.pyc'], 'a/b/c.pyc'))
+        self.assertTrue(self.IsPruned(['.DS_Store'], 'photos/.DS_Store'))
+        self.assertFalse(self.IsPruned(['*.pyc'], 'a/b/c.py'))
+
+    def testStarStopsAtSlash(self):
+        self.assertTrue(self.IsPruned(['doc/*.txt'], 'doc/a.txt'))
+        self.assertFalse(self.IsPruned(['doc/*.txt'], 'doc/sub/a.txt'))
+
+    def testDoubleStar(self):
+        self.assertTrue(self.IsPruned(['**/build'], 'build', True))
+        self.assertTrue(self.IsPruned(['**/build'], 'a/b/build', True))
+        self.assertTrue(self.IsPruned(['doc/**/*.txt'], 'doc/a.txt'))
+        self.assertTrue(self.IsPruned(['doc/**/*.txt'], 'doc/sub/deeper/a.txt'))
+        self.assertTrue(self.IsPruned(['logs/**'], 'logs/2020/a.log'))
+        self.assertFalse(self.IsPruned(['doc/**/*.txt'], 'other/doc/a.txt'))
+
+    def testAnchored(self):
+        self.assertTrue(self.IsPruned(['/build'], 'build', True))
+        self.assertFalse(self.IsPruned(['/build'], 'src/build', True))
+        self.assertTrue(self.IsPruned(['build'], 'src/build', True))
+        self.assertTrue(self.IsPruned(['src/build'], 'src/build', True))
+        self.assertFalse(self.IsPruned(['src/build'], 'a/src/build', True))
+
+    def testDirectoryOnly(self):
+        self.assertTrue(self.IsPruned(['cache/'], 'a/cache', True))
+        self.assertFalse(self.IsPruned(['cache/'], 'a/cache', False))
+
+    def testNegationLastMatchWins(self):
+        self.assertFalse(self.IsPruned(['*.log', '!keep.log'], 'a/keep.log'))
+        self.assertTrue(self.IsPruned(['*.log', '!keep.log'], 'a/other.log'))
+        self.assertTrue(self.IsPruned(['!keep.log', '*.log'], 'a/keep.log'))
+
+    def testCommentsAndBlankLines(self):
+        self.assertEqual(1, len(custom_utils.compile_prune_patterns(['# comment', '', '   ', '*.tmp\n'])))
+
+    def testCharacterClass(self):
+        self.assertTrue(self.IsPruned(['file[0-9].txt'], 'file3.txt'))
+        self.assertFalse(self.IsPruned(['file[!0-9].txt'], 'file3.txt'))
+        self.assertTrue(self.IsPruned(['file[!0-9].txt'], 'filex.txt'))
+
+class TestWalkDirectory(unittest.TestCase):
+    def setUp(self):
+        self.mDir = tempfile.mkdtemp()
+        # a directory sorts as if its name ended in a / so a-b and a.txt come before the files in a
+        for relpath in ['a-b', 'a.txt', 'ab', 'B', 'a/b/c', 'a/b-c', 'a/b.d/e', 'a/b0', 'c-d/x', 'z/y/x/w',
+                        'skip/me', 'keep/skip.log', 'keep/keep.log']:
+            path = os.path.join(self.mDir, *relpath.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.mDir)
+
+    def SortedWalk(self):
+        return sorted(os.path.join(root, name) for root, dirs, files in os.walk(self.mDir) for name in files)
+
+    def testSortedLikeOsWalk(self):
+        for workers in [1, 4]:
+            paths = [entry.path for entry in custom_utils.walk_directory(self.mDir, prune=None, sort=True, workers=workers)]
+            self.assertEqual(self.SortedWalk(), paths)
+
+    def testPrune(self):
+        paths = [entry.relpath for entry in custom_utils.walk_directory(self.mDir, prune=['/skip/', '*.log', '!keep.log'],
+                                                                      sort=True)]
+        self.assertNotIn('skip/me', paths)
+        self.assertNotIn('keep/skip.log', paths)
+        self.assertIn('keep/keep.log', paths)
+
+    def testMaxDepth(self):
+        paths = [entry.relpath for entry in custom_utils.walk_directory(self.mDir, prune=None, max_depth=1, sort=True)]
+        self.assertEqual(['B', 'a-b', 'a.txt', 'ab'], paths)
+
+if __name__ == '__main__':
+    unittest.main()
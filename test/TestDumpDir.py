@@ -0,0 +1,76 @@
+import os, shutil, sys, tempfile, unittest
+
+sys.path.append( os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) )
+import dump_dir
+
+class TestDiffManifests(unittest.TestCase):
+    def setUp(self):
+        self.mDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.mDir)
+
+    def Manifest(self, name, rows, algorithm='md5'):
+        '''rows are (path, size, mtime_ns, chksum), the manifest is reopened for reading like a previous run's.'''
+        db_path = os.path.join(self.mDir, name + '.db')
+        with dump_dir.Manifest(db_path, create=True, algorithm=algorithm, root=self.mDir) as manifest:
+            for path, size, mtime_ns, chksum in rows:
+                manifest.add(dump_dir.DumpEntry(path, size, mtime_ns, chksum, path))
+        return dump_dir.Manifest(db_path)
+
+    def Diff(self, old_rows, new_rows, algorithm='md5'):
+        old, new = self.Manifest('old', old_rows, algorithm), self.Manifest('new', new_rows, algorithm)
+        try:
+            return dump_dir.diff_manifests(old, new)
+        finally:
+            old.close()
+            new.close()
+
+    def testUnchanged(self):
+        rows = [('a', 1, 10, 'aa'), ('b/c', 2, 20, 'cc')]
+        self.assertEqual({'added': [], 'removed': [], 'modified': [], 'renamed': []}, self.Diff(rows, rows))
+
+    def testAddedRemovedModified(self):
+        diff = self.Diff([('a', 1, 10, 'aa'), ('b', 2, 20, 'bb'), ('d', 4, 40, 'dd')],
+                         [('a', 1, 11, 'aa'), ('b', 2, 20, 'b2'), ('c', 3, 30, 'cc'), ('e', 5, 50, 'ee')])
+        self.assertEqual(['c', 'e'], diff['added'])
+        self.assertEqual(['d'], diff['removed'])
+        # with chksums a new mtime alone is not a modification
+        self.assertEqual(['b'], diff['modified'])
+        self.assertEqual([], diff['renamed'])
+
+    def testRenamedByChksum(self):
+        diff = self.Diff([('dir/a', 1, 10, 'aa'), ('z', 9, 90, 'zz')], [('moved/a', 1, 99, 'aa'), ('z', 9, 90, 'zz')])
+        self.assertEqual([('dir/a', 'moved/a')], diff['renamed'])
+        self.assertEqual([], diff['added'])
+        self.assertEqual([], diff['removed'])
+
+    def testRenamedOneOfTwoIdentical(self):
+        diff = self.Diff([('a', 5, 10, 'same'), ('b', 5, 10, 'same')], [('a', 5, 10, 'same'), ('c', 5, 10, 'same')])
+        self.assertEqual([('b', 'c')], diff['renamed'])
+        self.assertEqual([], diff['added'])
+        self.assertEqual([], diff['removed'])
+        self.assertEqual([], diff['modified'])
+
+    def testRenamedWithoutChksums(self):
+        diff = self.Diff([('a', 1, 10, None), ('b', 2, 20, None)],
+                         [('a', 1, 11, None), ('c', 2, 20, None), ('d', 2, 21, None)], algorithm=None)
+        self.assertEqual(['a'], diff['modified'])
+        self.assertEqual([('b', 'c')], diff['renamed'])
+        self.assertEqual(['d'], diff['added'])
+        self.assertEqual([], diff['removed'])
+
+    def testDifferentAlgorithms(self):
+        # md5 and crc32 chksums can not be compared, the size and mtime are
+        old = self.Manifest('old', [('a', 1, 10, 'aa'), ('b', 2, 20, 'bb')], 'md5')
+        new = self.Manifest('new', [('a', 1, 10, '01'), ('c', 2, 20, '02')], 'crc32')
+        try:
+            diff = dump_dir.diff_manifests(old, new)
+        finally:
+            old.close()
+            new.close()
+        self.assertEqual([], diff['modified'])
+        self.assertEqual([('b', 'c')], diff['renamed'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import os, shutil, sys, tempfile, unittest
+
+sys.path.append( os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) )
+import media_index
+
+class TestGetTagInfo(unittest.TestCase):
+    def setUp(self):
+        self.mDir = tempfile.mkdtemp()
+        self.mIndex = media_index.MediaIndex(':memory:')
+
+    def tearDown(self):
+        self.mIndex.close()
+        shutil.rmtree(self.mDir)
+
+    def Store(self, name, tracks):
+        path = os.path.join(self.mDir, name)
+        open(path, 'w').close()
+        st = os.stat(path)
+        self.mIndex._store(path, (st.st_size, st.st_mtime_ns), tracks, None)
+        return path
+
+    def testAudioBitRate(self):
+        path = self.Store('song.mp3', [('General', {'overall_bit_rate': 262144, 'performer': 'Artist'}),
+                                       ('Audio', {'bit_rate': 256000})])
+        info = self.mIndex.get_tag_info(path)
+        self.assertEqual('256000', info['bit_rate'])
+        self.assertEqual('Artist', info['artist'])
+
+    def testNoAudioBitRate(self):
+        path = self.Store('song.flac', [('General', {'overall_bit_rate': 900000}), ('Audio', {'format': 'FLAC'})])
+        self.assertEqual('900000', self.mIndex.get_tag_info(path)['bit_rate'])
+
+class TestSummarize(unittest.TestCase):
+    def testPrefersAudioBitRate(self):
+        summary = media_index._summarize([('General', {'overall_bit_rate': 262144, 'title': 'Title'}),
+                                          ('Video', {'width': 1920, 'height': 1080}),
+                                          ('Audio', {'bit_rate': 256000})])
+        self.assertEqual((1920, 1080, 256000, 'Title'), summary)
+
+    def testOverallBitRate(self):
+        self.assertEqual(262144, media_index._summarize([('General', {'overall_bit_rate': 262144})])[2])
+
+if __name__ == '__main__':
+    unittest.main()
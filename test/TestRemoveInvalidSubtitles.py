@@ -0,0 +1,143 @@
+import os, shutil, sys, tempfile, unittest
+
+sys.path.append( os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) )
+import remove_invalid_subtitles
+
+_SRT = '''1
+00:00:01,000 --> 00:00:02,500
+First
+
+2
+00:00:03,000 --> 00:00:04,000
+Second
+
+3
+00:01:40,000 --> 00:01:45,250
+Last
+'''
+
+_ASS = '''[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+Dialogue: 0,0:00:05.00,0:00:06.50,Default,,0,0,0,,Later
+Dialogue: 0,0:00:01.00,0:00:02.00,Default,,0,0,0,,Earlier
+'''
+
+class TestParseSubtitle(unittest.TestCase):
+    def setUp(self):
+        self.mDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.mDir)
+
+    def Write(self, name, data, encoding='utf-8'):
+        filename = os.path.join(self.mDir, name)
+        with open(filename, 'w', encoding=encoding) as subtitle_file:
+            subtitle_file.write(data)
+        return filename
+
+    def testSrt(self):
+        stats = remove_invalid_subtitles.parse_subtitle(self.Write('movie.srt', _SRT))
+        self.assertEqual(3, stats.cues)
+        self.assertEqual(0, stats.disordered)
+        self.assertEqual(0, stats.bad_timings)
+        self.assertAlmostEqual(105.25, stats.last_end)
+
+    def testUtf16Srt(self):
+        stats = remove_invalid_subtitles.parse_subtitle(self.Write('movie.srt', _SRT, 'utf-16'))
+        self.assertEqual(3, stats.cues)
+
+    def testAss(self):
+        stats = remove_invalid_subtitles.parse_subtitle(self.Write('movie.ass', _ASS))
+        self.assertEqual(2, stats.cues)
+        self.assertEqual(1, stats.disordered)
+        self.assertAlmostEqual(6.5, stats.last_end)
+
+class TestGetInvalidReason(unittest.TestCase):
+    def Stats(self, name, cues):
+        stats = remove_invalid_subtitles.SubtitleStats(name)
+        for start, end in cues:
+            stats.add_cue(start, end)
+        return stats
+
+    def testNoCues(self):
+        self.assertEqual('no cues', remove_invalid_subtitles._get_invalid_reason(self.Stats('a.srt', []), 100.0))
+
+    def testBadTimings(self):
+        stats = self.Stats('a.srt', [(10.0, 5.0), (20.0, 30.0)])
+        self.assertIn('end before they start', remove_invalid_subtitles._get_invalid_reason(stats, 30.0))
+
+    def testDisorderedSrt(self):
+        stats = self.Stats('a.srt', [(50.0, 60.0), (10.0, 20.0)])
+        self.assertIn('start before the previous one', remove_invalid_subtitles._get_invalid_reason(stats, 60.0))
+        # ass events do not have to be in order
+        stats = self.Stats('a.ass', [(50.0, 60.0), (10.0, 20.0)])
+        self.assertIsNone(remove_invalid_subtitles._get_invalid_reason(stats, 60.0))
+
+    def testCoverage(self):
+        stats = self.Stats('a.srt', [(1.0, 2.0), (30.0, 40.0)])
+        self.assertIn('the cues end at', remove_invalid_subtitles._get_invalid_reason(stats, 100.0))
+        self.assertIsNone(remove_invalid_subtitles._get_invalid_reason(stats, 60.0))
+        stats = self.Stats('a.srt', [(1.0, 2.0), (190.0, 200.0)])
+        self.assertIn('after the', remove_invalid_subtitles._get_invalid_reason(stats, 100.0))
+
+    def testWithoutVideo(self):
+        stats = self.Stats('a.srt', [(i, i + 1.0) for i in range(10)])
+        self.assertIn('no video', remove_invalid_subtitles._get_invalid_reason(stats, None))
+        stats = self.Stats('a.srt', [(i, i + 1.0) for i in range(remove_invalid_subtitles._MIN_CUES_WITHOUT_VIDEO)])
+        self.assertIsNone(remove_invalid_subtitles._get_invalid_reason(stats, None))
+
+class TestGetVideoDuration(unittest.TestCase):
+    class Track(object):
+        def __init__(self, duration):
+            self.track_type = 'General'
+            self.duration = duration
+
+    class MediaInfo(object):
+        def __init__(self, duration):
+            self.tracks = [TestGetVideoDuration.Track(duration)]
+
+    def setUp(self):
+        self.mMediaInfo = remove_invalid_subtitles.MediaInfo
+        self.mError = remove_invalid_subtitles.app_settings.error
+        remove_invalid_subtitles.app_settings.error = lambda message: None
+        remove_invalid_subtitles._get_video_duration.cache_clear()
+
+    def tearDown(self):
+        remove_invalid_subtitles.MediaInfo = self.mMediaInfo
+        remove_invalid_subtitles.app_settings.error = self.mError
+        remove_invalid_subtitles._get_video_duration.cache_clear()
+
+    def Duration(self, duration):
+        remove_invalid_subtitles.MediaInfo = type('MediaInfo', (object,), {'parse': staticmethod(lambda filename: self.MediaInfo(duration))})
+        return remove_invalid_subtitles._get_video_duration('movie.mkv')
+
+    def testDuration(self):
+        self.assertAlmostEqual(5400.5, self.Duration('5400500'))
+
+    def testOddDuration(self):
+        self.assertIsNone(self.Duration('5400500 / 5400000'))
+
+class TestFindVideoFilename(unittest.TestCase):
+    def Find(self, subtitle, videos):
+        directory = os.path.join(os.sep, 'media')
+        return remove_invalid_subtitles._find_video_filename(
+            os.path.join(directory, subtitle), {directory: [os.path.join(directory, video) for video in videos]})
+
+    def testExactAndLanguage(self):
+        self.assertEqual(os.path.join(os.sep, 'media', 'Movie.mkv'), self.Find('Movie.srt', ['Movie.mkv', 'Other.mkv']))
+        self.assertEqual(os.path.join(os.sep, 'media', 'Movie.mkv'), self.Find('Movie.en.srt', ['Movie.mkv', 'Other.mkv']))
+
+    def testNeedsBoundary(self):
+        self.assertIsNone(self.Find('Movie 2.en.srt', ['Movie.mkv', 'Other.mkv']))
+        self.assertEqual(os.path.join(os.sep, 'media', 'Movie 2.mkv'), self.Find('Movie 2.en.srt', ['Movie.mkv', 'Movie 2.mkv']))
+
+    def testLongestMatch(self):
+        self.assertEqual(os.path.join(os.sep, 'media', 'Show.S01E01.mkv'),
+                         self.Find('Show.S01E01.en.srt', ['Show.mkv', 'Show.S01E01.mkv']))
+
+    def testOnlyVideo(self):
+        self.assertEqual(os.path.join(os.sep, 'media', 'Film.mkv'), self.Find('Movie 2.en.srt', ['Film.mkv']))
+        self.assertIsNone(self.Find('Movie.srt', []))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os, shutil, stat, sys, tempfile, unittest
+
+sys.path.append( os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) )
+import transcode_queue
+
+# writes its --output like HandBrakeCLI would and reports its progress, leaves a mark so a skipped job can be told apart
+_STUB_ENCODER = '''#!/usr/bin/env python3
+import sys
+args = sys.argv[1:]
+output = args[args.index('--output') + 1]
+open(output + '.ran', 'w').close()
+sys.stdout.write('Encoding: task 1 of 1, 50.00 %\\r')
+sys.stdout.write('Encoding: task 1 of 1, 99.00 % (120.50 fps, avg 110.25 fps, ETA 00h00m01s)\\r')
+with open(output, 'w') as output_file:
+    output_file.write('encoded')
+'''
+
+class TestParseProgress(unittest.TestCase):
+    def testSettled(self):
+        progress = transcode_queue.parse_progress('Encoding: task 1 of 1, 42.50 % (120.50 fps, avg 110.25 fps, ETA 00h01m02s)')
+        self.assertEqual({'percent': 42.5, 'fps': 120.5, 'avg_fps': 110.25, 'eta': '00h01m02s'}, progress)
+
+    def testStarting(self):
+        progress = transcode_queue.parse_progress('Encoding: task 1 of 1, 0.10 %')
+        self.assertAlmostEqual(0.1, progress['percent'])
+        self.assertIsNone(progress['fps'])
+        self.assertIsNone(progress['eta'])
+
+    def testSecondPass(self):
+        progress = transcode_queue.parse_progress('Encoding: task 2 of 2, 50.00 %')
+        self.assertAlmostEqual(75.0, progress['percent'])
+
+    def testOtherLine(self):
+        self.assertIsNone(transcode_queue.parse_progress('x264 [info]: using cpu capabilities'))
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.mDir = tempfile.mkdtemp()
+        self.mQueuePath = os.path.join(self.mDir, 'queue.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.mDir)
+
+    def Output(self, name):
+        return os.path.join(self.mDir, name + '.m4v')
+
+    def testRecover(self):
+        queue = transcode_queue.JobQueue(self.mQueuePath)
+        for name in ['running', 'failed', 'done']:
+            queue.add(name + '.mkv', self.Output(name))
+        queue.save()
+        states = {self.Output('running'): transcode_queue.RUNNING,
+                  self.Output('failed'): transcode_queue.FAILED,
+                  self.Output('done'): transcode_queue.DONE}
+        for job in queue.jobs:
+            queue.finish(job, states[job['output']])
+        partial = transcode_queue.partial_path(self.Output('running'))
+        open(partial, 'w').close()
+
+        queue = transcode_queue.JobQueue(self.mQueuePath)
+        self.assertEqual(1, queue.recover())
+        self.assertFalse(os.path.exists(partial))
+        self.assertEqual(1, queue.recover(retry_failed=True))
+        states = {job['output']: job['state'] for job in transcode_queue.JobQueue(self.mQueuePath).jobs}
+        self.assertEqual(transcode_queue.PENDING, states[self.Output('running')])
+        self.assertEqual(transcode_queue.PENDING, states[self.Output('failed')])
+        self.assertEqual(transcode_queue.DONE, states[self.Output('done')])
+
+    def testAddDuringRun(self):
+        running = transcode_queue.JobQueue(self.mQueuePath)
+        with running.transaction():
+            running.add('first.mkv', self.Output('first'))
+        job = running.claim()
+
+        adding = transcode_queue.JobQueue(self.mQueuePath)
+        with adding.transaction():
+            self.assertTrue(adding.add('second.mkv', self.Output('second')))
+        running.finish(job, transcode_queue.DONE)
+
+        states = {job['output']: job['state'] for job in transcode_queue.JobQueue(self.mQueuePath).jobs}
+        self.assertEqual({self.Output('first'): transcode_queue.DONE, self.Output('second'): transcode_queue.PENDING},
+                         states)
+        self.assertEqual(self.Output('second'), running.claim()['output'])
+
+class TestTranscoder(unittest.TestCase):
+    def setUp(self):
+        self.mDir = tempfile.mkdtemp()
+        self.mEncoder = os.path.join(self.mDir, 'encoder')
+        with open(self.mEncoder, 'w') as encoder_file:
+            encoder_file.write(_STUB_ENCODER)
+        os.chmod(self.mEncoder, os.stat(self.mEncoder).st_mode | stat.S_IXUSR)
+        self.mInput = os.path.join(self.mDir, 'movie.mkv')
+        open(self.mInput, 'w').close()
+        self.mOutput = os.path.join(self.mDir, 'out', 'movie.m4v')
+        self.mDurations = {}
+        self.mMediaDuration = transcode_queue.media_duration
+        transcode_queue.media_duration = lambda path, index=None: self.mDurations.get(path)
+
+    def tearDown(self):
+        transcode_queue.media_duration = self.mMediaDuration
+        shutil.rmtree(self.mDir)
+
+    def Run(self):
+        queue = transcode_queue.JobQueue(os.path.join(self.mDir, 'queue.json'))
+        with queue.transaction():
+            queue.add(self.mInput, self.mOutput)
+        transcode_queue.Transcoder(queue, workers=1, encoder=self.mEncoder, status_interval=60.0).run()
+        return queue.jobs[0]
+
+    def testEncode(self):
+        job = self.Run()
+        self.assertEqual(transcode_queue.DONE, job['state'])
+        self.assertAlmostEqual(99.0, job['progress']['percent'])
+        with open(self.mOutput) as output_file:
+            self.assertEqual('encoded', output_file.read())
+        self.assertFalse(os.path.exists(transcode_queue.partial_path(self.mOutput)))
+
+    def testSkipMatchingDuration(self):
+        os.makedirs(os.path.dirname(self.mOutput))
+        open(self.mOutput, 'w').close()
+        self.mDurations = {self.mInput: 100.0, self.mOutput: 100.5}
+        job = self.Run()
+        self.assertEqual(transcode_queue.SKIPPED, job['state'])
+        self.assertFalse(os.path.exists(transcode_queue.partial_path(self.mOutput) + '.ran'))
+
+    def testEncodeDifferentDuration(self):
+        os.makedirs(os.path.dirname(self.mOutput))
+        open(self.mOutput, 'w').close()
+        self.mDurations = {self.mInput: 100.0, self.mOutput: 50.0}
+        job = self.Run()
+        self.assertEqual(transcode_queue.DONE, job['state'])
+        self.assertTrue(os.path.exists(transcode_queue.partial_path(self.mOutput) + '.ran'))
+
+if __name__ == '__main__':
+    unittest.main()
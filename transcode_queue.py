@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# vim:softtabstop=4:ts=4:sw=4:expandtab:tw=120
+import argparse
+import collections
+import contextlib
+import fcntl
+import fnmatch
+import glob
+import json
+import os
+from pymediainfo import MediaInfo
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+DEFAULT_QUEUE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'transcode_queue', 'queue.json')
+DEFAULT_ENCODER = 'HandBrakeCLI'
+DEFAULT_PRESET = 'AppleTV 2'
+DEFAULT_EXTENSION = '.m4v'
+# x264 already spreads one encode over several cores but stops scaling at around four, so the rest of the machine is
+# filled with more encodes rather than more threads
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+DEFAULT_DURATION_TOLERANCE = 1.0
+DEFAULT_STATUS_INTERVAL = 5.0
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+STATES = [PENDING, RUNNING, DONE, FAILED, SKIPPED]
+
+# the lines HandBrakeCLI rewrites in place (with \r) while it encodes, the rates and ETA come once it has settled
+_PROGRESS_REGEX = re.compile(r'Encoding: task (?P<task>\d+) of (?P<tasks>\d+), (?P<percent>\d+(?:\.\d+)?) %'
+                             r'(?: \((?P<fps>\d+(?:\.\d+)?) fps, avg (?P<avg_fps>\d+(?:\.\d+)?) fps, '
+                             r'ETA (?P<eta>\d+h\d+m\d+s)\))?')
+_LINE_SEPARATOR_REGEX = re.compile(rb'[\r\n]')
+_LOG_LINES = 500
+_READ_SIZE = 65536
+
+def parse_progress(line):
+    '''Returns {percent, fps, avg_fps, eta} from an encoder progress line (fps, avg_fps and eta may be None) or None.'''
+    match = _PROGRESS_REGEX.search(line)
+    if not match:
+        return None
+    tasks = int(match.group('tasks'))
+    # a two pass encode reports each pass as a task, the job is only as far along as all of its passes
+    percent = ((int(match.group('task')) - 1) * 100.0 + float(match.group('percent'))) / tasks
+    fps = match.group('fps')
+    avg_fps = match.group('avg_fps')
+    return {'percent': percent,
+            'fps': float(fps) if fps else None,
+            'avg_fps': float(avg_fps) if avg_fps else None,
+            'eta': match.group('eta')}
+
+def media_duration(path, index=None):
+    '''Returns the General duration of path in seconds, None when it is unknown or the file cannot be parsed.'''
+    try:
+        media_info = index.get_media_info(path) if index is not None else MediaInfo.parse(path)
+    except Exception:
+        return None
+    for track in media_info.tracks:
+        if track.track_type == 'General' and track.duration is not None:
+            try:
+                return float(track.duration) / 1000.0
+            except ValueError:
+                return None
+    return None
+
+def partial_path(output):
+    '''The encoder writes here and the file is renamed to output once it is complete, the extension is kept because
+    HandBrakeCLI picks the container from it.'''
+    base, extension = os.path.splitext(output)
+    return '{0}.partial{1}'.format(base, extension)
+
+def output_path(input_path, destination, suffix='', extension=DEFAULT_EXTENSION):
+    return os.path.join(destination, os.path.splitext(os.path.basename(input_path))[0] + suffix + extension)
+
+def find_inputs(patterns, index=None, min_height=0):
+    '''Returns the sorted files matching the glob patterns (** recurses).  With a media index the patterns are matched
+    against the indexed video files (at least min_height tall) instead of walking the file system.'''
+    if index is not None:
+        patterns = [os.path.abspath(os.path.expanduser(pattern)) for pattern in patterns]
+        return sorted(path for path, width, height in index.files_above_resolution(min_height - 1)
+                      if any(fnmatch.fnmatch(path, pattern) for pattern in patterns))
+    paths = set()
+    for pattern in patterns:
+        paths.update(os.path.abspath(path) for path in glob.glob(os.path.expanduser(pattern), recursive=True)
+                     if os.path.isfile(path))
+    return sorted(paths)
+
+class JobQueue(object):
+    '''The jobs persisted as json, every change is written (atomically) so a crash loses at most the running encodes.
+
+    A job is a dict of input, output, preset, args (extra encoder arguments) and its state, attempts, error and the
+    last progress the encoder reported.  "add" and "run" may use the queue at the same time, so every save re-reads the
+    file under a lock and only replaces the jobs this queue added or changed, the others are taken from the file.
+    '''
+    def __init__(self, path=DEFAULT_QUEUE_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._file_lock_file = None
+        self._file_lock_depth = 0
+        # the outputs of the jobs this queue added or changed, their state here is newer than the file's
+        self._owned = set()
+        self.jobs = self._read()
+
+    def _read(self):
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path) as queue_file:
+            return json.load(queue_file)['jobs']
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        '''Excludes the other processes' load-modify-save of the queue, the queue file itself is replaced by every save
+        so a separate file is locked.  Nested uses (claim saving) only lock once.'''
+        with self._lock:
+            if self._file_lock_depth == 0:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file_lock_file = open(self.path + '.save.lock', 'w')
+                fcntl.flock(self._file_lock_file, fcntl.LOCK_EX)
+            self._file_lock_depth += 1
+            try:
+                yield
+            finally:
+                self._file_lock_depth -= 1
+                if self._file_lock_depth == 0:
+                    self._file_lock_file.close()
+                    self._file_lock_file = None
+
+    def _merge(self):
+        '''Takes the jobs this queue does not own from the file, including the ones another process added.'''
+        jobs = {job['output']: job for job in self.jobs}
+        merged = []
+        for job in self._read():
+            merged.append(jobs.pop(job['output']) if job['output'] in self._owned else job)
+            jobs.pop(job['output'], None)
+        self.jobs = merged + list(jobs.values())
+
+    def _write(self):
+        data = json.dumps({'jobs': self.jobs}, indent=2)
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as queue_file:
+            queue_file.write(data)
+        os.replace(temp_path, self.path)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Brings the jobs up to date with the file and saves them afterwards, all under the file lock.'''
+        with self._file_lock():
+            self._merge()
+            yield self
+            self._write()
+
+    def save(self):
+        with self.transaction():
+            pass
+
+    def add(self, input_path, output, preset=DEFAULT_PRESET, args=()):
+        '''Queues input_path to be encoded to output, returns False when output is already queued.  Use it in a
+        transaction() so the check sees the jobs other processes queued.'''
+        with self._lock:
+            if any(job['output'] == output for job in self.jobs):
+                return False
+            self.jobs.append({'input': input_path, 'output': output, 'preset': preset, 'args': list(args),
+                              'state': PENDING, 'attempts': 0, 'error': None, 'progress': None, 'seconds': None})
+            self._owned.add(output)
+            return True
+
+    def claim(self):
+        '''Marks the next pending job running and returns it, None once there are none left.  The jobs queued since
+        the run started are picked up too.'''
+        with self.transaction():
+            for job in self.jobs:
+                if job['state'] == PENDING:
+                    job['state'] = RUNNING
+                    job['attempts'] += 1
+                    job['error'] = None
+                    job['progress'] = None
+                    self._owned.add(job['output'])
+                    return job
+        return None
+
+    def finish(self, job, state, error=None, seconds=None):
+        with self._lock:
+            job['state'] = state
+            job['error'] = error
+            job['seconds'] = seconds
+            self._owned.add(job['output'])
+            self.save()
+
+    def set_progress(self, job, progress):
+        with self._lock:
+            job['progress'] = progress
+            self._owned.add(job['output'])
+
+    def recover(self, retry_failed=False):
+        '''Puts the jobs a crashed (or interrupted) run left running back in the queue and removes their partial
+        outputs, also the failed ones with retry_failed.  Returns how many were requeued.'''
+        requeued = 0
+        with self.transaction():
+            for job in self.jobs:
+                if job['state'] == RUNNING or (retry_failed and job['state'] == FAILED):
+                    job['state'] = PENDING
+                    job['progress'] = None
+                    self._owned.add(job['output'])
+                    requeued += 1
+                    if os.path.exists(partial_path(job['output'])):
+                        os.remove(partial_path(job['output']))
+        return requeued
+
+    def counts(self):
+        with self._lock:
+            counter = collections.Counter(job['state'] for job in self.jobs)
+        return [(state, counter[state]) for state in STATES]
+
+    def running(self):
+        with self._lock:
+            return [dict(job) for job in self.jobs if job['state'] == RUNNING]
+
+    def __len__(self):
+        return len(self.jobs)
+
+class Transcoder(object):
+    '''Runs the queued jobs on workers concurrent encoder processes.'''
+    def __init__(self, queue, workers=DEFAULT_WORKERS, encoder=DEFAULT_ENCODER, index=None,
+                 tolerance=DEFAULT_DURATION_TOLERANCE, status_interval=DEFAULT_STATUS_INTERVAL, verbose=False):
+        self.queue = queue
+        self.workers = workers
+        self.encoder = encoder
+        self.index = index
+        self.tolerance = tolerance
+        self.status_interval = status_interval
+        self.verbose = verbose
+        self._stopping = threading.Event()
+        self._processes_lock = threading.Lock()
+        self._processes = set()
+
+    def _durations_match(self, first, second):
+        return first is not None and second is not None and abs(first - second) <= self.tolerance
+
+    def _is_already_encoded(self, job):
+        # the output is only ever created by renaming a complete encode, the duration check also catches the ones
+        # made by hand or by the old scripts
+        if not os.path.isfile(job['output']):
+            return False
+        return self._durations_match(media_duration(job['input'], self.index), media_duration(job['output']))
+
+    def _encoder_command(self, job):
+        command = [self.encoder, '--input', job['input'], '--output', partial_path(job['output'])]
+        if job['preset']:
+            command.extend(['--preset', job['preset']])
+        return command + job['args']
+
+    def _read_output(self, process, job):
+        '''Follows the encoder's output for its progress, returns the last lines of everything else for the log.'''
+        log = collections.deque(maxlen=_LOG_LINES)
+        buffer = b''
+        while True:
+            chunk = process.stdout.read1(_READ_SIZE)
+            if not chunk:
+                break
+            lines = _LINE_SEPARATOR_REGEX.split(buffer + chunk)
+            buffer = lines.pop()
+            for line in lines:
+                line = line.decode('utf-8', 'replace')
+                progress = parse_progress(line)
+                if progress is not None:
+                    self.queue.set_progress(job, progress)
+                elif line:
+                    log.append(line)
+        if buffer:
+            log.append(buffer.decode('utf-8', 'replace'))
+        return log
+
+    def _save_log(self, job, command, log):
+        log_path = os.path.splitext(job['output'])[0] + '.log'
+        with open(log_path, 'w') as log_file:
+            log_file.write('{0}\n'.format(subprocess.list2cmdline(command)))
+            log_file.write('\n'.join(log) + '\n')
+        return log_path
+
+    def _encode(self, job):
+        '''Returns (state, error) once the job's encoder exits.'''
+        if self._is_already_encoded(job):
+            return SKIPPED, None
+        os.makedirs(os.path.dirname(os.path.abspath(job['output'])), exist_ok=True)
+        command = self._encoder_command(job)
+        if self.verbose:
+            print('executing {0}'.format(subprocess.list2cmdline(command)))
+        # its own session so a ^C reaches only this script, which stops the encoders itself and requeues their jobs
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+        with self._processes_lock:
+            self._processes.add(process)
+        try:
+            log = self._read_output(process, job)
+            returncode = process.wait()
+        finally:
+            with self._processes_lock:
+                self._processes.discard(process)
+        if self._stopping.is_set():
+            return RUNNING, None
+        partial = partial_path(job['output'])
+        error = None
+        if returncode != 0:
+            error = 'the encoder exited with {0}'.format(returncode)
+        elif not os.path.isfile(partial):
+            error = 'the encoder did not write {0}'.format(partial)
+        else:
+            input_duration, output_duration = media_duration(job['input'], self.index), media_duration(partial)
+            if input_duration is not None and output_duration is not None and \
+               not self._durations_match(input_duration, output_duration):
+                error = 'the output is {0:.1f} seconds long, the input {1:.1f}'.format(output_duration, input_duration)
+        if error is not None:
+            error = '{0}, see {1}'.format(error, self._save_log(job, command, log))
+            if os.path.exists(partial):
+                os.remove(partial)
+            return FAILED, error
+        os.replace(partial, job['output'])
+        return DONE, None
+
+    def _work(self):
+        while not self._stopping.is_set():
+            job = self.queue.claim()
+            if job is None:
+                return
+            print('encoding {0} -> {1}'.format(job['input'], job['output']))
+            start = time.monotonic()
+            try:
+                state, error = self._encode(job)
+            except Exception as err:
+                state, error = FAILED, str(err)
+            if state == RUNNING:
+                # stopped, recover() puts it back in the queue
+                return
+            seconds = time.monotonic() - start
+            self.queue.finish(job, state, error, seconds)
+            if state == FAILED:
+                print('ERROR: {0}: {1}'.format(job['input'], error), file=sys.stderr)
+            else:
+                print('{0} {1} ({2:.0f} seconds)'.format(state, job['output'], seconds))
+
+    def print_status(self):
+        for job in self.queue.running():
+            progress = job['progress']
+            if progress is None:
+                print('  {0}: starting'.format(os.path.basename(job['input'])))
+            elif progress['fps'] is None:
+                print('  {0}: {1:5.1f}%'.format(os.path.basename(job['input']), progress['percent']))
+            else:
+                print('  {0}: {1:5.1f}% {2:.1f} fps (avg {3:.1f}) ETA {4}'.format(
+                    os.path.basename(job['input']), progress['percent'], progress['fps'], progress['avg_fps'],
+                    progress['eta']))
+
+    def stop(self):
+        self._stopping.set()
+        with self._processes_lock:
+            processes = list(self._processes)
+        for process in processes:
+            process.terminate()
+
+    def run(self):
+        '''Encodes until the queue is empty, interrupted the running jobs are stopped and requeued.'''
+        requeued = self.queue.recover()
+        if requeued:
+            print('requeued {0} jobs an earlier run did not finish'.format(requeued))
+        threads = [threading.Thread(target=self._work, name='encoder-{0}'.format(i)) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            next_status = time.monotonic() + self.status_interval
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.5)
+                if time.monotonic() >= next_status:
+                    self.print_status()
+                    # the progress is saved too so "status" in another terminal shows it
+                    self.queue.save()
+                    next_status = time.monotonic() + self.status_interval
+        finally:
+            if any(thread.is_alive() for thread in threads):
+                self.stop()
+                for thread in threads:
+                    thread.join()
+            self.queue.recover()
+
+def print_queue(queue):
+    for job in queue.jobs:
+        detail = ''
+        if job['state'] == RUNNING and job['progress'] is not None:
+            progress = job['progress']
+            detail = ' {0:.1f}%'.format(progress['percent'])
+            if progress['fps'] is not None:
+                detail += ' {0:.1f} fps ETA {1}'.format(progress['fps'], progress['eta'])
+        elif job['state'] == FAILED:
+            detail = ' {0}'.format(job['error'])
+        elif job['seconds'] is not None:
+            detail = ' ({0:.0f} seconds)'.format(job['seconds'])
+        print('{0:<8} {1}{2}'.format(job['state'], job['input'], detail))
+    print(', '.join('{0} {1}'.format(count, state) for state, count in queue.counts()))
+
+def queue_and_run(input_paths, destination, preset=DEFAULT_PRESET, suffix='', encoder_args=(), simulated=False,
+                  verbose=False, queue_path=DEFAULT_QUEUE_PATH):
+    '''Adds the inputs to the queue and encodes it, simulated only prints the jobs.  For the old one preset scripts.'''
+    queue = JobQueue(queue_path)
+    if simulated:
+        for input_path in input_paths:
+            queue.add(os.path.abspath(input_path), os.path.abspath(output_path(input_path, destination, suffix)),
+                      preset, encoder_args)
+        print_queue(queue)
+        return
+    # nothing is queued when another run has the queue, the jobs would wait for a run nobody started
+    lock_file = _lock_queue(queue_path)
+    try:
+        with queue.transaction():
+            for input_path in input_paths:
+                output = os.path.abspath(output_path(input_path, destination, suffix))
+                if queue.add(os.path.abspath(input_path), output, preset, encoder_args) and verbose:
+                    print('queued {0} -> {1}'.format(input_path, output))
+        Transcoder(queue, verbose=verbose).run()
+    finally:
+        lock_file.close()
+    print_queue(queue)
+
+def _lock_queue(queue_path):
+    '''Holds an exclusive lock on the queue for this process' lifetime, a second run would requeue the first one's
+    running jobs as crashed.'''
+    os.makedirs(os.path.dirname(os.path.abspath(queue_path)), exist_ok=True)
+    lock_file = open(queue_path + '.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError('another run is already encoding the queue {0}'.format(queue_path))
+    return lock_file
+
+def _open_index(index_path):
+    if not index_path:
+        return None
+    # the index module is only needed when it is asked for
+    import media_index
+    return media_index.MediaIndex(index_path if index_path is not True else media_index.DEFAULT_DB_PATH)
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Queues media files for HandBrakeCLI and encodes them concurrently, a queue which is interrupted resumes where it stopped')
+    parser.add_argument('-q', '--queue', default=DEFAULT_QUEUE_PATH, metavar='<QUEUE PATH>', help='job queue file')
+    parser.add_argument('-i', '--index', nargs='?', const=True, default=None, metavar='<DB PATH>', help='use the media index (default ~/.cache/media_index/media.db) for inputs and durations')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the encoder commands')
+    sub_parsers = parser.add_subparsers(help='commands', dest='command')
+    sub_parsers.required = True
+
+    add = sub_parsers.add_parser('add', help='queue the files matching glob patterns (or the indexed videos matching them)')
+    add.add_argument('-o', '--output', required=True, metavar='<DIR>', help='destination directory')
+    add.add_argument('-p', '--preset', default=DEFAULT_PRESET, help='HandBrake preset, empty for none')
+    add.add_argument('-s', '--suffix', default='', help='appended to the output file names')
+    add.add_argument('-x', '--extension', default=DEFAULT_EXTENSION, help='output extension (picks the container)')
+    add.add_argument('-H', '--min-height', type=int, default=0, help='with --index only queue videos at least this tall')
+    add.add_argument('-a', '--encoder-args', default='', metavar='<ARGS>', help='extra encoder arguments')
+    add.add_argument('patterns', nargs='+', metavar='<PATTERN>', help='glob pattern, ** recurses')
+
+    run = sub_parsers.add_parser('run', help='encode the queued jobs')
+    run.add_argument('-j', '--jobs', type=int, default=DEFAULT_WORKERS, help='concurrent encoders (default {0})'.format(DEFAULT_WORKERS))
+    run.add_argument('-e', '--encoder', default=DEFAULT_ENCODER, help='encoder executable')
+    run.add_argument('-t', '--tolerance', type=float, default=DEFAULT_DURATION_TOLERANCE, help='seconds an output may differ in duration from its input and still count as encoded')
+    run.add_argument('-r', '--retry', action='store_true', help='queue the failed jobs again')
+    run.add_argument('-S', '--status-interval', type=float, default=DEFAULT_STATUS_INTERVAL, metavar='<SECONDS>', help='how often the progress is printed')
+
+    sub_parsers.add_parser('status', help='print the jobs with their progress')
+    return parser.parse_args()
+
+def main():
+    args = _parse_args()
+    index = None
+    try:
+        queue = JobQueue(args.queue)
+        index = _open_index(args.index)
+        if args.command == 'add':
+            encoder_args = shlex.split(args.encoder_args)
+            input_paths = find_inputs(args.patterns, index, args.min_height)
+            added = 0
+            # a run may be saving the queue meanwhile, the jobs are added to what is in the file under its lock
+            with queue.transaction():
+                for input_path in input_paths:
+                    output = os.path.abspath(output_path(input_path, args.output, args.suffix, args.extension))
+                    added += queue.add(input_path, output, args.preset, encoder_args)
+            print('queued {0} jobs ({1} in the queue)'.format(added, len(queue)))
+        elif args.command == 'run':
+            lock_file = _lock_queue(args.queue)
+            if args.retry:
+                queue.recover(retry_failed=True)
+            # stopped by a service manager the running jobs are still requeued
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            Transcoder(queue, args.jobs, args.encoder, index, args.tolerance, args.status_interval, args.verbose).run()
+            print_queue(queue)
+        else:
+            print_queue(queue)
+    except KeyboardInterrupt:
+        return 1
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
+        return 1
+    finally:
+        if index is not None:
+            index.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
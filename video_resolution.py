@@ -8,22 +8,25 @@ from pathlib import Path
 import sys
 import traceback
 
+import media_index
+
 
 def _parse_args():
     parser = argparse.ArgumentParser(description='Parse input video files for resolution')
     parser.add_argument('paths', metavar='PATH', type=Path, nargs='+', help='file names for video files')
     parser.add_argument('-v', '--verbose', action="store_true", help='increase output verbosity')
+    parser.add_argument('-i', '--index', nargs='?', const=media_index.DEFAULT_DB_PATH, default=None, metavar='<DB PATH>', help=f'answer from the media index (default {media_index.DEFAULT_DB_PATH}), only new or changed files are parsed')
     args = parser.parse_args()
     print(args)
-    return args.verbose, args.paths
+    return args.verbose, args.paths, args.index
 
 
-def get_video_resolution(path, verbose):
+def get_video_resolution(path, verbose, index=None):
     if not path.is_file():
         print(f'ERROR: the path is not a regular file or symlink pointing to a file "{path}"')
         return None
     path = path.resolve(strict=True)
-    media_info = MediaInfo.parse(str(path))
+    media_info = index.get_media_info(str(path)) if index is not None else MediaInfo.parse(str(path))
     for track in media_info.tracks:
         if track.track_type == 'Video':
             return (track.width, track.height)
@@ -32,12 +35,16 @@ def get_video_resolution(path, verbose):
 
 
 def main():
-    verbose, video_paths = _parse_args()
+    verbose, video_paths, index_path = _parse_args()
     paths_str = ", ".join([str(path) for path in video_paths])
     print(f'args: verbose: {verbose}, video files: [{paths_str}]')
+    index = None
     try:
+        if index_path:
+            index = media_index.MediaIndex(index_path)
+            index.refresh([str(path) for path in video_paths if path.is_file()])
         for path in video_paths:
-            resolution = get_video_resolution(path, verbose)
+            resolution = get_video_resolution(path, verbose, index)
             if resolution:
                 print(f'{path}: {resolution[0]}x{resolution[1]}')
             else:
@@ -46,6 +53,9 @@ def main():
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
         return 1
+    finally:
+        if index is not None:
+            index.close()
     return 0
 
 
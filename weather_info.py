@@ -10,6 +10,7 @@ import sys
 import time
 import traceback
 
+import http_cache
 import location_info
 
 _TIME_OUT = 5.0
@@ -25,6 +26,7 @@ def _parse_args():
     descript = 'Get the weather info for the current area or one specified'
     parser = argparse.ArgumentParser(description=descript, formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, width=120))
     parser.add_argument('-v', '--verbose', action="store_true", help='increase output verbosity')
+    parser.add_argument('-n', '--no-cache', action="store_true", help='always call wttr.in instead of using the http cache')
     parser.add_argument('-f', '--full-report', action="store_true", help='output the full 3-day weather report instead of a nice one liner')
     location = parser.add_mutually_exclusive_group()
     location.add_argument('-z', '--zip-code', type=str, default=None, metavar='00000', help='the zip code')
@@ -32,6 +34,7 @@ def _parse_args():
     args = parser.parse_args()
     global _VERBOSE
     _VERBOSE = args.verbose
+    http_cache.set_enabled(not args.no_cache)
 
     location = None
     if args.zip_code:
@@ -45,7 +48,7 @@ def _parse_args():
                    .format(args.verbose, args.full_report, args.zip_code, args.region, location))
     return location, args.full_report
 
-def _call_uri(uri):
+def _http_get(uri):
     try:
         _verbose_print('INFO: calling {} with a {} second timeout'.format(uri, _TIME_OUT))
         response = requests.get(uri, timeout=_TIME_OUT)
@@ -57,6 +60,9 @@ def _call_uri(uri):
         print('ERROR: {}'.format(e), file=sys.stderr)
         return None
 
+def _call_uri(uri):
+    return http_cache.cached_get(uri, lambda: _http_get(uri))
+
 def _sun_event(match):
     #r'Sunrise: \g<1>, Sunset: \g<2>'
     sunrise_str = match.group('sunrise')